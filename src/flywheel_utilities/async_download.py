@@ -0,0 +1,212 @@
+"""
+Asyncio counterparts of the download functions, for use from within an event loop.
+The Flywheel SDK is blocking, so each metadata or file request runs on a thread of a
+RequestLimiter, which caps the number of requests in flight. Several subjects can share a single
+limiter to apply a global cap. File selection is shared with the synchronous API.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, TypeVar
+
+from flywheel_utilities import download_bids, instrumentation, retry, snapshot, transfer
+
+if TYPE_CHECKING:
+    from flywheel.models.container_subject_output import ContainerSubjectOutput
+
+    from flywheel_utilities.metadata_cache import MetadataCache
+
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RequestLimiter:
+    """
+    Run blocking requests on a pool of threads, with at most max_in_flight at once. The limiter
+    may be reused from several event loops (e.g., consecutive asyncio.run calls).
+
+    Parameters
+    ----------
+    max_in_flight:
+        maximum number of concurrent requests
+    """
+
+    def __init__(self, max_in_flight: int = 8):
+        self.max_in_flight: int = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run func(*args) once a request slot is free
+
+        Parameters
+        ----------
+        func:
+            blocking function
+        args:
+            arguments passed to func
+
+        Returns
+        -------
+            return value of func
+        """
+
+        # A semaphore is bound to the event loop it is first used from, so the limiter keeps one
+        # per loop (e.g., when reused by consecutive asyncio.run calls)
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self) -> None:
+        """Shut down the request threads"""
+
+        self._executor.shutdown(wait=True)
+
+
+async def async_take_snapshot(
+    subject: ContainerSubjectOutput,
+    limiter: RequestLimiter,
+    cache: MetadataCache | None = None,
+) -> snapshot.SubjectSnapshot:
+    """
+    Retrieve the metadata for a subject, listing the sessions and reloading the acquisitions
+    concurrently. See snapshot.take_snapshot.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object
+    limiter:
+        limiter running the requests
+    cache:
+        metadata cache used to avoid reloading unchanged acquisitions
+
+    Returns
+    -------
+        snapshot of the subject's hierarchy
+    """
+
+    log.info(f"Retrieving metadata for subject: {subject.label}")
+
+    tree = snapshot.SubjectSnapshot(id=subject.id, label=subject.label)
+
+    with instrumentation.span("traversal", subject=subject.id) as record:
+        sessions: list[Any] = await limiter.run(retry.call, subject.sessions)
+        acq_lists: list[list[Any]] = await asyncio.gather(
+            *(limiter.run(retry.call, session.acquisitions) for session in sessions)
+        )
+        record.add(api_calls=1 + len(sessions))
+
+        # The acquisitions of all sessions are reloaded at once, then split back per session
+        results: list[tuple[snapshot.AcquisitionSnapshot, str]] = await asyncio.gather(
+            *(
+                limiter.run(snapshot.snapshot_acquisition, acq, cache)
+                for acqs in acq_lists
+                for acq in acqs
+            )
+        )
+        start: int = 0
+        for session, acqs in zip(sessions, acq_lists):
+            session_results = results[start : start + len(acqs)]
+            start += len(acqs)
+            tree.sessions.append(
+                snapshot.SessionSnapshot(
+                    id=session.id,
+                    label=session.label,
+                    acquisitions=[acq_snapshot for acq_snapshot, _ in session_results],
+                )
+            )
+            for acq_snapshot, source in session_results:
+                record.add(files=len(acq_snapshot.files), api_calls=int(source == "reloaded"))
+
+    return tree
+
+
+# pylint: disable=too-many-arguments
+async def async_download_bids_modalities(
+    subject: snapshot.SubjectLike,
+    modalities: list[str],
+    bids_dir: Path,
+    is_dry_run: bool,
+    post_populate: list[str] | None = None,
+    *,
+    limiter: RequestLimiter | None = None,
+) -> None:
+    """
+    Download the required modalities of a subject, with the metadata and file requests made
+    concurrently. See download_bids.download_bids_modalities.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    modalities:
+        list of modalities to download
+    bids_dir:
+        Path to bids directory
+    is_dry_run:
+        don't download if True
+    post_populate:
+        list of modalities to populate the IntendedFor fields with
+    limiter:
+        limiter running the requests, shared to cap requests across subjects (a limiter with
+        the default cap is used if None)
+    """
+
+    if is_dry_run:
+        log.info("Dry run: data will not be downloaded")
+    else:
+        log.info(f"Attempting to download modalities: {modalities}...")
+
+    own_limiter: bool = limiter is None
+    active: RequestLimiter = RequestLimiter() if limiter is None else limiter
+
+    try:
+        tree: snapshot.SubjectSnapshot = (
+            subject
+            if isinstance(subject, snapshot.SubjectSnapshot)
+            else await async_take_snapshot(subject, active)
+        )
+
+        log.info(f"Found {len(tree.sessions)} sessions")
+
+        downloads: list[Any] = []
+        submitted: set[Path] = set()
+        for scan, bids_path in download_bids.select_modality_files(tree, modalities):
+            # Only download if not already there (or on its way) and is not dry run
+            if (
+                not (bids_dir / bids_path).is_file()
+                and bids_path not in submitted
+                and not is_dry_run
+            ):
+                submitted.add(bids_path)
+                log.info("    downloaded", extra=transfer.log_fields(scan))
+                populate: bool = download_bids.needs_populating(bids_path, post_populate)
+                downloads.append(
+                    active.run(download_bids.download_scan, scan, bids_dir / bids_path, populate)
+                )
+
+        await asyncio.gather(*downloads)
+    finally:
+        # Wait for the requests still in flight without blocking the event loop
+        if own_limiter:
+            await asyncio.get_running_loop().run_in_executor(None, active.close)
+
+    if post_populate:
+        download_bids.post_populate_intended_for(bids_dir / ("sub-" + tree.label), post_populate)
+
+    log.info("Finished downloading modalities")
@@ -5,29 +5,136 @@ variable 'gear-log-level'.
 
 from __future__ import annotations
 
+import atexit
+import json
 import logging
-from typing import TYPE_CHECKING
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import TYPE_CHECKING, Any
+
+from flywheel_utilities import instrumentation
 
 if TYPE_CHECKING:
     from flywheel_geartoolkit_context import GearToolkitContext
 
 
+# Attributes present on every log record, anything else was passed via 'extra'
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as single line JSON objects, including any fields passed via 'extra'
+    (e.g., log.info("Downloaded", extra={"bytes": 1024}))
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+        )
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class StoppableQueueListener(QueueListener):
+    """
+    Queue listener which can be stopped more than once (e.g., by the caller and at exit). Once
+    stopped, the root logger writes records directly to the handler, rather than leaving them in
+    the queue.
+
+    Parameters
+    ----------
+    handler_in:
+        handler queuing the records
+    handler:
+        handler formatting and writing the records
+    """
+
+    def __init__(self, handler_in: QueueHandler, handler: logging.Handler):
+        super().__init__(handler_in.queue, handler, respect_handler_level=True)
+        self.handler_in: QueueHandler = handler_in
+        self.handler: logging.Handler = handler
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        super().stop()
+
+        root = logging.getLogger()
+        if self.handler_in in root.handlers:
+            root.removeHandler(self.handler_in)
+            root.addHandler(self.handler)
+
+
+def queue_handler(handler: logging.Handler) -> tuple[QueueHandler, StoppableQueueListener]:
+    """
+    Wrap a handler so records are queued by the logging thread, and formatted and written by a
+    background listener thread
+
+    Parameters
+    ----------
+    handler:
+        handler formatting and writing the records
+
+    Returns
+    -------
+    queue_handler:
+        handler to attach to loggers
+    listener:
+        started listener, which must be stopped to flush the queue
+    """
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler_in = QueueHandler(log_queue)
+    # Only merge the message arguments in the logging thread, leaving formatting to the listener
+    handler_in.setFormatter(logging.Formatter("%(message)s"))
+    listener = StoppableQueueListener(handler_in, handler)
+    listener.start()
+
+    return handler_in, listener
+
+
+# pylint: disable=too-many-arguments
 def setup_basic_logging(
     context: GearToolkitContext,
     log_format: str = "[%(asctime)s %(levelname)s] %(message)s",
     log_date: str = "%Y-%m-%d %H:%M:%S",
-) -> None:
+    *,
+    json_format: bool = False,
+    use_queue: bool = False,
+) -> StoppableQueueListener | None:
     """
-    Basic formatting for logger
+    Basic formatting for logger. Records can optionally be formatted as JSON, and written by a
+    background thread so that logging does not block (and serialise) download threads. JSON
+    records include the instrumented spans (see instrumentation.log_span) and the container ID,
+    name and size of each file downloaded.
 
     Parameters
     ----------
     context:
         Flywheel context object
     log_format:
-        desired logging print format
+        desired logging print format (ignored if json_format)
     log_date:
         desired logging date format
+    json_format:
+        format records as JSON objects?
+    use_queue:
+        write records from a background thread?
+
+    Returns
+    -------
+        queue listener if use_queue (stopped automatically at exit, may also be stopped by the
+        caller), otherwise None. As for logging.basicConfig, nothing is changed if the root
+        logger already has handlers, in which case no listener is started.
     """
 
     # Setup basic logging
@@ -39,7 +146,52 @@ def setup_basic_logging(
     else:
         log_level = logging.INFO
 
-    logging.basicConfig(level=log_level, format=log_format, datefmt=log_date)
+    handler = logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(JsonFormatter(datefmt=log_date))
+        instrumentation.add_sink(instrumentation.log_span)
+    else:
+        handler.setFormatter(logging.Formatter(log_format, datefmt=log_date))
+
+    listener: StoppableQueueListener | None = None
+    if use_queue and logging.getLogger().handlers:
+        # basicConfig leaves existing handlers in place, so a listener would never receive records
+        logging.getLogger(__name__).debug("Root logger already configured, not queuing records")
+        logging.basicConfig(level=log_level, handlers=[handler])
+    elif use_queue:
+        handler_in, listener = queue_handler(handler)
+        atexit.register(listener.stop)
+        logging.basicConfig(level=log_level, handlers=[handler_in])
+    else:
+        logging.basicConfig(level=log_level, handlers=[handler])
 
     logger = logging.getLogger()
     logger.info("Logger initialised")
+
+    return listener
+
+
+def log_instrumentation_summary(recorder: instrumentation.Recorder | None = None) -> None:
+    """
+    Log the time, counts and throughput of each instrumented phase (e.g., traversal, transfer,
+    extraction), showing whether a run was limited by API calls, the network or unzipping.
+
+    Parameters
+    ----------
+    recorder:
+        recorder to summarise (defaults to instrumentation.RECORDER)
+    """
+
+    logger = logging.getLogger()
+
+    summary = (recorder or instrumentation.RECORDER).summary()
+    if not summary:
+        return
+
+    logger.info("Phase summary:")
+    for phase, stats in sorted(summary.items(), key=lambda item: -item[1].seconds):
+        logger.info(
+            f"  {phase}: {stats.seconds:.2f} s, {stats.spans} spans, {stats.files} files, "
+            f"{stats.api_calls} API calls, {stats.bytes / 1024**2:.1f} MiB "
+            f"({stats.throughput / 1024**2:.1f} MiB/s)"
+        )
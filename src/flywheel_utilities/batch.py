@@ -0,0 +1,239 @@
+"""
+Download data for many subjects at once, e.g., to assemble a BIDS dataset for a group analysis.
+Subjects are processed by a pool of worker threads, which caps the number of subjects (and so
+transfers) in flight at any one time. A failure for one subject is recorded in its status rather
+than stopping the batch.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Sequence
+
+from flywheel_utilities import download_bids, download_dicoms, snapshot
+
+if TYPE_CHECKING:
+    from flywheel.models.container_subject_output import ContainerSubjectOutput
+    from flywheel.models.project_output import ProjectOutput
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class SubjectStatus:
+    """Outcome of the download for a single subject"""
+
+    subject_id: str
+    label: str
+    state: str = "pending"
+    error: str | None = None
+    seconds: float = 0.0
+
+
+def project_subjects(
+    project: ProjectOutput, subject_ids: list[str] | None = None
+) -> list[ContainerSubjectOutput]:
+    """
+    List the subjects of a project, optionally restricted to the given subject IDs or labels
+
+    Parameters
+    ----------
+    project:
+        Flywheel project
+    subject_ids:
+        IDs or labels of the subjects to keep (all subjects if None)
+
+    Returns
+    -------
+        list of Flywheel subjects
+    """
+
+    subjects: list[ContainerSubjectOutput] = list(project.subjects.iter())
+    if subject_ids is None:
+        return subjects
+
+    wanted: set[str] = set(subject_ids)
+    found: list[ContainerSubjectOutput] = [
+        subject for subject in subjects if subject.id in wanted or subject.label in wanted
+    ]
+    missing: set[str] = wanted - {subject.id for subject in found} - {sub.label for sub in found}
+    if missing:
+        log.warning(f"Subjects not found in project: {sorted(missing)}")
+
+    return found
+
+
+def run_subject(
+    subject: snapshot.SubjectLike, download: Callable[[snapshot.SubjectLike], Any]
+) -> SubjectStatus:
+    """
+    Run the download for a single subject, recording the outcome
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    download:
+        function downloading the data of a subject
+
+    Returns
+    -------
+        status of the subject
+    """
+
+    status = SubjectStatus(subject.id, subject.label, state="running")
+    start: float = time.perf_counter()
+    try:
+        download(subject)
+    # Some download functions exit on failure, which must not end the batch
+    except (Exception, SystemExit) as err:  # pylint: disable=broad-exception-caught
+        status.state = "failed"
+        status.error = f"{type(err).__name__}: {err}"
+    else:
+        status.state = "done"
+    status.seconds = time.perf_counter() - start
+
+    return status
+
+
+def download_subjects(
+    subjects: Sequence[snapshot.SubjectLike],
+    download: Callable[[snapshot.SubjectLike], Any],
+    max_workers: int = 4,
+) -> list[SubjectStatus]:
+    """
+    Run a download function for each subject, with at most max_workers subjects in flight
+
+    Parameters
+    ----------
+    subjects:
+        Flywheel subjects or snapshots
+    download:
+        function downloading the data of a subject
+    max_workers:
+        number of subjects downloaded concurrently
+
+    Returns
+    -------
+        status of each subject, in the order supplied
+    """
+
+    log.info(f"Downloading {len(subjects)} subjects with {max_workers} concurrent workers")
+
+    statuses: list[SubjectStatus] = [
+        SubjectStatus(subject.id, subject.label) for subject in subjects
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures: dict[Future[SubjectStatus], int] = {
+            pool.submit(run_subject, subject, download): idx for idx, subject in enumerate(subjects)
+        }
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            status: SubjectStatus = future.result()
+            statuses[futures[future]] = status
+            if status.state == "failed":
+                log.error(f"[{num_done}/{len(subjects)}] {status.label} failed: {status.error}")
+            else:
+                log.info(
+                    f"[{num_done}/{len(subjects)}] {status.label} done in {status.seconds:.1f} s"
+                )
+
+    failed: list[str] = [status.label for status in statuses if status.state == "failed"]
+    log.info(f"Batch finished: {len(subjects) - len(failed)} succeeded, {len(failed)} failed")
+    if failed:
+        log.warning(f"Failed subjects: {failed}")
+
+    return statuses
+
+
+# pylint: disable=too-many-arguments
+def batch_download_bids_modalities(
+    subjects: Sequence[snapshot.SubjectLike],
+    modalities: list[str],
+    bids_dir: Path,
+    is_dry_run: bool,
+    post_populate: list[str] | None = None,
+    *,
+    max_workers: int = 4,
+) -> list[SubjectStatus]:
+    """
+    Download the requested modalities of many subjects into a single BIDS directory.
+    See download_bids.download_bids_modalities.
+
+    Parameters
+    ----------
+    subjects:
+        Flywheel subjects or snapshots
+    modalities:
+        list of modalities to download
+    bids_dir:
+        Path to bids directory
+    is_dry_run:
+        don't download if True
+    post_populate:
+        list of modalities to populate the IntendedFor fields with
+    max_workers:
+        number of subjects downloaded concurrently
+
+    Returns
+    -------
+        status of each subject
+    """
+
+    return download_subjects(
+        subjects,
+        lambda subject: download_bids.download_bids_modalities(
+            subject, modalities, bids_dir, is_dry_run, post_populate
+        ),
+        max_workers,
+    )
+
+
+# pylint: disable=too-many-arguments
+def batch_download_all_dicoms(
+    subjects: Sequence[snapshot.SubjectLike],
+    work_dir: Path,
+    to_ignore: list[str],
+    dicom_dir: Path,
+    is_dry_run: bool,
+    *,
+    max_workers: int = 4,
+) -> list[SubjectStatus]:
+    """
+    Download all DICOM series of many subjects, each into a 'sub-<label>' folder within work_dir
+    and dicom_dir. See download_dicoms.download_all_dicoms.
+
+    Parameters
+    ----------
+    subjects:
+        Flywheel subjects or snapshots
+    work_dir:
+        Path to working directory for download
+    to_ignore:
+        list of strings used to reject DICOMS for download
+    dicom_dir:
+        directory to extract DICOM series to
+    is_dry_run:
+        download results?
+    max_workers:
+        number of subjects downloaded concurrently
+
+    Returns
+    -------
+        status of each subject
+    """
+
+    def download(subject: snapshot.SubjectLike) -> None:
+        sub_work_dir: Path = work_dir / f"sub-{subject.label}"
+        sub_dicom_dir: Path = dicom_dir / f"sub-{subject.label}"
+        sub_work_dir.mkdir(parents=True, exist_ok=True)
+        sub_dicom_dir.mkdir(parents=True, exist_ok=True)
+        download_dicoms.download_all_dicoms(
+            subject, sub_work_dir, to_ignore, sub_dicom_dir, is_dry_run
+        )
+
+    return download_subjects(subjects, download, max_workers)
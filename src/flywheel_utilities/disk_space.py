@@ -0,0 +1,130 @@
+"""
+Check the free disk space before downloading.
+The space required by a download is estimated from the sizes of the files on Flywheel, with zip
+archives assumed to expand by ZIP_EXPANSION when extracted, and compared against the free space of
+each destination's file system, so that a gear fails within seconds rather than after filling the
+disk midway through the transfer.
+"""
+
+from __future__ import annotations
+
+import errno
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import psutil
+
+if TYPE_CHECKING:
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+# Ratio of extracted to zipped size assumed for archives (DICOMs typically compress 2-3x)
+ZIP_EXPANSION: float = 3.0
+
+
+def existing_parent(path: Path) -> Path:
+    """Nearest existing directory containing path (path itself if it exists)"""
+
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def free_bytes(path: Path) -> int:
+    """
+    Free space on the file system containing path
+
+    Parameters
+    ----------
+    path:
+        Path on the file system (need not exist yet)
+
+    Returns
+    -------
+        number of bytes available
+    """
+
+    return psutil.disk_usage(str(existing_parent(path))).free
+
+
+def file_bytes(fw_file: FileEntry) -> int:
+    """Size of a file on Flywheel (zero if unknown)"""
+
+    return getattr(fw_file, "size", None) or 0
+
+
+def extracted_bytes(fw_file: FileEntry, expansion: float = ZIP_EXPANSION) -> int:
+    """Estimated size of a zip archive on Flywheel once extracted"""
+
+    return int(file_bytes(fw_file) * expansion)
+
+
+def check_free_space(required: dict[Path, int], reserve: int = 0) -> None:
+    """
+    Check there is enough free space for the bytes to be written to each destination.
+    Destinations on the same file system share its free space.
+
+    Parameters
+    ----------
+    required:
+        number of bytes to be written, by destination directory
+    reserve:
+        number of bytes to keep free on each file system
+
+    Raises
+    ------
+    OSError
+        (errno.ENOSPC) if a file system does not have enough free space
+    """
+
+    by_device: dict[int, tuple[Path, int]] = {}
+    for path, n_bytes in required.items():
+        existing: Path = existing_parent(path)
+        device: int = os.stat(existing).st_dev
+        _, total = by_device.get(device, (existing, 0))
+        by_device[device] = (existing, total + n_bytes)
+
+    for existing, total in by_device.values():
+        available: int = free_bytes(existing)
+        log.debug(
+            f"Disk space on {existing}: {total / 1024**3:.2f} GiB required, "
+            f"{available / 1024**3:.2f} GiB free"
+        )
+        if total + reserve > available:
+            raise OSError(
+                errno.ENOSPC,
+                f"Not enough disk space: {total / 1024**3:.2f} GiB required (plus "
+                f"{reserve / 1024**3:.2f} GiB reserved), {available / 1024**3:.2f} GiB free",
+                str(existing),
+            )
+
+
+def has_free_space(required: dict[Path, int], reserve: int = 0) -> bool:
+    """
+    Is there enough free space for the bytes to be written to each destination?
+    See check_free_space.
+
+    Parameters
+    ----------
+    required:
+        number of bytes to be written, by destination directory
+    reserve:
+        number of bytes to keep free on each file system
+
+    Returns
+    -------
+        True if all file systems have enough free space
+    """
+
+    try:
+        check_free_space(required, reserve)
+    except OSError as err:
+        if err.errno != errno.ENOSPC:
+            raise
+        return False
+    return True
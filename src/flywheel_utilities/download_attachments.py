@@ -10,6 +10,8 @@ from typing import TYPE_CHECKING
 
 from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
 
+from flywheel_utilities import fly_wrappers, instrumentation, transfer
+
 if TYPE_CHECKING:
     from flywheel_geartoolkit_context import GearToolkitContext
 
@@ -32,15 +34,14 @@ def download_attachment(context: GearToolkitContext, name: str, is_dry_run: bool
     """
 
     # Get the project
-    proj_id: str = context.client.get_analysis(context.destination["id"])["parents"]["project"]
-    proj = context.client.get_project(proj_id)
+    proj = fly_wrappers.get_project(context)
 
     # Search attachments for requested file
     for attach in proj.files:
         if name in attach.name:
-            logger.info(f"Located: {attach.name}")
+            logger.info(f"Located: {attach.name}", extra=transfer.log_fields(attach, proj.id))
             if not (context.work_dir / attach.name).is_file():
-                attach.download(context.work_dir / attach.name)
+                transfer.download_file(attach, context.work_dir / attach.name)
             else:
                 logger.debug("File already downloaded. Must be testing")
             break
@@ -52,5 +53,7 @@ def download_attachment(context: GearToolkitContext, name: str, is_dry_run: bool
     # pylint: disable=undefined-loop-variable
     for ext in [".tar.gz", ".bz2", ".zip"]:
         if ext in attach.name:
-            unzip_archive(context.work_dir / attach.name, context.work_dir, is_dry_run)
+            with instrumentation.span("extraction", filename=attach.name) as record:
+                unzip_archive(context.work_dir / attach.name, context.work_dir, is_dry_run)
+                record.add(files=1)
             break
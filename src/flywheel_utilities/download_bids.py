@@ -6,18 +6,39 @@ from __future__ import annotations
 
 import json
 import logging
-import re
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Iterator
+
+from flywheel_utilities import snapshot, transfer, utils
 
 if TYPE_CHECKING:
     from flywheel.models.container_acquisition_output import ContainerAcquisitionOutput
-    from flywheel.models.container_subject_output import ContainerSubjectOutput
     from flywheel.models.file_entry import FileEntry
 
 log = logging.getLogger(__name__)
 
 
+def write_sidecar(sidecar: Path, json_decoded: dict[str, Any]) -> None:
+    """
+    Replace a json sidecar, rather than modifying it in place, as the downloaded file may be
+    hardlinked to a file store (see file_store.py)
+
+    Parameters
+    ----------
+    sidecar:
+        path to json sidecar
+    json_decoded:
+        contents of the sidecar
+    """
+
+    tmp_name: Path = sidecar.with_name(sidecar.name + ".tmp")
+    with open(tmp_name, "w", encoding="utf-8") as out_json:
+        json.dump(json_decoded, out_json, sort_keys=True, indent=2)
+    os.replace(tmp_name, sidecar)
+
+
 # pylint: disable=too-many-locals
 # pylint: disable=too-many-return-statements
 def populate_intended_for(fw_file: FileEntry, sidecar: Path) -> None:
@@ -58,8 +79,7 @@ def populate_intended_for(fw_file: FileEntry, sidecar: Path) -> None:
 
     json_decoded["IntendedFor"] = intended_for
 
-    with open(sidecar, "w", encoding="utf-8") as out_json:
-        json.dump(json_decoded, out_json, sort_keys=True, indent=2)
+    write_sidecar(sidecar, json_decoded)
 
 
 def post_populate_intended_for(dir_sub: Path, post_populate: list[str]) -> None:
@@ -108,11 +128,12 @@ def post_populate_intended_for(dir_sub: Path, post_populate: list[str]) -> None:
 
             json_decoded["IntendedFor"] = intended_for
 
-            with open(sidecar, "w", encoding="utf-8") as out_json:
-                json.dump(json_decoded, out_json, sort_keys=True, indent=2)
+            write_sidecar(sidecar, json_decoded)
 
 
-def is_bidsified(scan: FileEntry, acq: ContainerAcquisitionOutput) -> bool:
+def is_bidsified(
+    scan: FileEntry, acq: ContainerAcquisitionOutput | snapshot.AcquisitionSnapshot
+) -> bool:
     """
     Check if scan has been properly BIDSified, or if "ignore" field has been checked.
 
@@ -160,21 +181,160 @@ def is_bidsified(scan: FileEntry, acq: ContainerAcquisitionOutput) -> bool:
     return True
 
 
-def download_bids_modalities(
-    subject: ContainerSubjectOutput,
+def download_scan(scan: FileEntry, download_name: Path, populate: bool = False) -> None:
+    """
+    Download a single file and, if requested, populate the IntendedFor field of the downloaded
+    fmap sidecar.
+
+    Parameters
+    ----------
+    scan:
+        file on Flywheel
+    download_name:
+        Path to save the file to
+    populate:
+        populate the IntendedFor field from the Flywheel metadata?
+    """
+
+    transfer.download_file(scan, download_name)
+    if populate:
+        populate_intended_for(scan, download_name)
+
+
+def select_modality_files(
+    tree: snapshot.SubjectSnapshot, modalities: list[str]
+) -> Iterator[tuple[FileEntry, Path]]:
+    """
+    Find the properly BIDSified files of the requested modalities, skipping ignored acquisitions.
+
+    Parameters
+    ----------
+    tree:
+        snapshot of the subject
+    modalities:
+        list of modalities to download
+
+    Yields
+    ------
+        file on Flywheel and its path relative to the BIDS directory
+    """
+
+    for session in tree.sessions:
+        log.info(f"--- Searching through session:  {session.label} ---")
+        for acq in session.acquisitions:
+            # Check if ignore is set at acquisition level
+            if acq.is_ignored():
+                continue
+
+            for scan in acq.files:
+                if not is_bidsified(scan, acq):
+                    continue
+
+                # Filter out unwanted modalities
+                if scan["info"]["BIDS"]["Folder"] not in modalities:
+                    continue
+
+                filename: str = scan["info"]["BIDS"]["Filename"]
+
+                log.info(f"Located: {filename}", extra=transfer.log_fields(scan, acq.id))
+
+                yield scan, Path(scan["info"]["BIDS"]["Path"]) / filename
+
+
+def select_bids_files(
+    tree: snapshot.SubjectSnapshot, filenames: list[str]
+) -> Iterator[tuple[FileEntry, Path]]:
+    """
+    Find the properly BIDSified files with names matching any of the requested patterns,
+    skipping ignored acquisitions. Patterns which matched no files are logged once the search is
+    complete.
+
+    Parameters
+    ----------
+    tree:
+        snapshot of the subject
+    filenames:
+        list of partial names to use as regex
+
+    Yields
+    ------
+        file on Flywheel and its path relative to the BIDS directory
+    """
+
+    # Compile the requested file names once for the whole search
+    matcher = utils.PatternMatcher(filenames)
+
+    # Loop through all sessions and acquisitions to find required files
+    for session in tree.sessions:
+        log.info(f"--- Searching through session:  {session.label} ---")
+        for acq in session.acquisitions:
+            # Check if ignore is set at acquisition level
+            if acq.is_ignored():
+                continue
+
+            for scan in acq.files:
+                if not is_bidsified(scan, acq):
+                    continue
+
+                filename: str = scan["info"]["BIDS"]["Filename"]
+
+                # Search through requested files and check for matches
+                if matcher.search(filename) is None:
+                    continue
+
+                log.info(f"Located: {filename}", extra=transfer.log_fields(scan, acq.id))
+
+                yield scan, Path(scan["info"]["BIDS"]["Path"]) / filename
+
+    unmatched: list[str] = matcher.unmatched()
+    if unmatched:
+        log.warning(f"No files found matching: {unmatched}")
+
+
+def needs_populating(bids_path: Path, post_populate: list[str] | None) -> bool:
+    """
+    Check if the IntendedFor field of a downloaded file should be populated from the metadata
+
+    Parameters
+    ----------
+    bids_path:
+        path of the file relative to the BIDS directory
+    post_populate:
+        list of modalities the IntendedFor fields will be populated with afterwards
+
+    Returns
+    -------
+        is the file an fmap sidecar to be populated?
+    """
+
+    return (
+        "fmap" in str(bids_path.parent) and bids_path.name.endswith(".json") and not post_populate
+    )
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-branches
+def iter_bids_modalities(
+    subject: snapshot.SubjectLike,
     modalities: list[str],
     bids_dir: Path,
     is_dry_run: bool,
     post_populate: list[str] | None = None,
-) -> None:
+    *,
+    max_workers: int = 1,
+) -> Iterator[tuple[Path, Path, FileEntry]]:
     """
-    Download required files by looping through all sessions, acquisitions and analyses to find
-    required files.
+    Download the required modalities, yielding each file as soon as it is on disk so that
+    processing can start while the remaining files are downloaded. If max_workers is greater than
+    one, files are yielded in the order their downloads complete. If post_populate is given, the
+    fmap sidecars are only yielded once their IntendedFor fields have been populated. Files which
+    are already present are yielded without being downloaded (and, in a dry run, all selected
+    files are yielded without being downloaded).
 
     Parameters
     ----------
     subject:
-        Flywheel subject object
+        Flywheel subject object or snapshot
     modalities:
         list of modalities to download
     bids_dir:
@@ -183,6 +343,12 @@ def download_bids_modalities(
         don't download if True
     post_populate:
         list of modalities to populate the IntendedFor fields with
+    max_workers:
+        number of files to download concurrently
+
+    Yields
+    ------
+        path relative to the BIDS directory, local path and file on Flywheel
     """
 
     # Data will not be downloaded if it is a dry run
@@ -191,54 +357,110 @@ def download_bids_modalities(
     else:
         log.info(f"Attempting to download modalities: {modalities}...")
 
-    # Determine if multiple sessions
-    num_sessions: int = len(subject.sessions())
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
 
-    log.info(f"Found {num_sessions} sessions")
+    log.info(f"Found {len(tree.sessions)} sessions")
 
-    # Loop through all sessions and acquisitions to find required files
-    for session in subject.sessions.iter():
-        log.info(f"--- Searching through session:  {session.label} ---")
-        for acq in session.reload().acquisitions.iter():
-            # Check if ignore is set at acquisition level
-            if "BIDS" in acq.info:
-                if acq.info["BIDS"]["ignore"] is True:
-                    continue
+    # Only spin up a pool of download threads when files are to be downloaded concurrently
+    pool: ThreadPoolExecutor | None = None
+    if max_workers > 1 and not is_dry_run:
+        log.info(f"Downloading with {max_workers} concurrent workers")
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending: dict[Future[None], list[tuple[Path, Path, FileEntry]]] = {}
+    # Files sharing a destination with a pending download are yielded once it completes, rather
+    # than downloaded again (as when downloading serially, where the file is already present)
+    submitted: dict[Path, list[tuple[Path, Path, FileEntry]]] = {}
 
-            for scan in acq.reload().files:
-                if not is_bidsified(scan, acq):
-                    continue
+    # Sidecars to be post populated are held back until all files are downloaded
+    held_back: list[tuple[Path, Path, FileEntry]] = []
 
-                # Filter out unwanted modalities
-                if scan["info"]["BIDS"]["Folder"] not in modalities:
+    def ready(items: list[tuple[Path, Path, FileEntry]]) -> list[tuple[Path, Path, FileEntry]]:
+        if not post_populate:
+            return items
+        held_back.extend(item for item in items if needs_populating(item[0], None))
+        return [item for item in items if not needs_populating(item[0], None)]
+
+    try:
+        # Loop through all sessions and acquisitions to find required files
+        for scan, bids_path in select_modality_files(tree, modalities):
+            item: tuple[Path, Path, FileEntry] = (bids_path, bids_dir / bids_path, scan)
+            # Only download if not already there and is not dry run
+            if not (bids_dir / bids_path).is_file() and not is_dry_run:
+                if bids_dir / bids_path in submitted:
+                    submitted[bids_dir / bids_path].append(item)
                     continue
+                log.info("    downloaded", extra=transfer.log_fields(scan))
+                # Populate the IntendedFor field once the sidecar has been downloaded
+                populate: bool = needs_populating(bids_path, post_populate)
+                if pool is not None:
+                    submitted[bids_dir / bids_path] = [item]
+                    future = pool.submit(download_scan, scan, bids_dir / bids_path, populate)
+                    pending[future] = submitted[bids_dir / bids_path]
+                    yield from ready(
+                        [done for items in utils.pop_completed(pending) for done in items]
+                    )
+                    continue
+                download_scan(scan, bids_dir / bids_path, populate)
+            yield from ready([item])
+
+        # Wait for all queued downloads, raising the first error encountered
+        for future in as_completed(list(pending)):
+            future.result()
+            yield from ready(pending.pop(future))
+    finally:
+        # Downloads not yet started are abandoned if the caller stops iterating early
+        for future in pending:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=True)
 
-                filename: str = scan["info"]["BIDS"]["Filename"]
+    if post_populate:
+        post_populate_intended_for(bids_dir / ("sub-" + tree.label), post_populate)
+        yield from held_back
 
-                log.info(f"Located: {filename}")
+    log.info("Finished downloading modalities")
 
-                save_path: Path = bids_dir / scan["info"]["BIDS"]["Path"]
 
-                # Only download if not already there and is not dry run
-                if not (save_path / filename).is_file() and not is_dry_run:
-                    log.info("    downloaded")
-                    scan.download(save_path / filename)
-                    # Populate the IntendedFor field
-                    if (
-                        "fmap" in str(save_path)
-                        and filename.endswith(".json")
-                        and not post_populate
-                    ):
-                        populate_intended_for(scan, save_path / filename)
+# pylint: disable=too-many-arguments
+def download_bids_modalities(
+    subject: snapshot.SubjectLike,
+    modalities: list[str],
+    bids_dir: Path,
+    is_dry_run: bool,
+    post_populate: list[str] | None = None,
+    *,
+    max_workers: int = 1,
+) -> None:
+    """
+    Download required files by looping through all sessions, acquisitions and analyses to find
+    required files. If max_workers is greater than one, matching files are queued onto a pool of
+    download threads while the search continues. See iter_bids_modalities to process files as
+    they are downloaded.
 
-    if post_populate:
-        post_populate_intended_for(bids_dir / ("sub-" + subject.label), post_populate)
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    modalities:
+        list of modalities to download
+    bids_dir:
+        Path to bids directory
+    dry_run:
+        don't download if True
+    post_populate:
+        list of modalities to populate the IntendedFor fields with
+    max_workers:
+        number of files to download concurrently
+    """
 
-    log.info("Finished downloading modalities")
+    for _ in iter_bids_modalities(
+        subject, modalities, bids_dir, is_dry_run, post_populate, max_workers=max_workers
+    ):
+        pass
 
 
 def download_bids_files(
-    subject: ContainerSubjectOutput,
+    subject: snapshot.SubjectLike,
     filenames: list[str],
     bids_dir: Path,
     is_dry_run: bool,
@@ -250,7 +472,7 @@ def download_bids_files(
     Parameters
     ----------
     subject:
-        Flywheel subject object
+        Flywheel subject object or snapshot
     filenames:
         list of partial names to use as regex for downloading required files
     bids_dir:
@@ -263,43 +485,20 @@ def download_bids_files(
     if is_dry_run:
         log.info("Dry run: data will not be downloaded")
 
-    # Determine if multiple sessions
-    num_sessions = len(subject.sessions())
-
-    log.info(f"Found {num_sessions} sessions")
-
-    # Loop through all sessions and acquisitions to find required files
-    for session in subject.sessions.iter():
-        log.info(f"--- Searching through session:  {session.label} ---")
-        for acq in session.reload().acquisitions.iter():
-            # Check if ignore is set at acquisition level
-            if "BIDS" in acq.info:
-                if acq.info["BIDS"]["ignore"] is True:
-                    continue
-
-            for scan in acq.reload().files:
-                if not is_bidsified(scan, acq):
-                    continue
-
-                filename: str = scan["info"]["BIDS"]["Filename"]
-
-                # Search through requested files and check for matches
-                for name in filenames:
-                    if re.search(name, filename):
-                        break
-                else:
-                    continue
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
 
-                log.info(f"Located: {filename}")
+    log.info(f"Found {len(tree.sessions)} sessions")
 
-                save_path: Path = bids_dir / scan["info"]["BIDS"]["Path"]
+    for scan, bids_path in select_bids_files(tree, filenames):
+        save_path: Path = bids_dir / bids_path.parent
+        filename: str = bids_path.name
 
-                # Only download if not already there and is not dry run
-                if not (save_path / filename).is_file() and not is_dry_run:
-                    log.info("    downloaded")
-                    scan.download(save_path / filename)
-                    # Populate the IntendedFor field
-                    if "fmap" in str(save_path) and filename.endswith(".json"):
-                        populate_intended_for(scan, save_path / filename)
+        # Only download if not already there and is not dry run
+        if not (save_path / filename).is_file() and not is_dry_run:
+            log.info("    downloaded", extra=transfer.log_fields(scan))
+            transfer.download_file(scan, save_path / filename)
+            # Populate the IntendedFor field
+            if "fmap" in str(save_path) and filename.endswith(".json"):
+                populate_intended_for(scan, save_path / filename)
 
     log.info("Finished downloading individual files")
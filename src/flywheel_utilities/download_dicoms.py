@@ -5,18 +5,28 @@ Module for downloading data from flywheel
 from __future__ import annotations
 
 import logging
-import re
+import multiprocessing
 import shutil
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Iterator
 
 from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
 
-from flywheel_utilities import download_bids
+from flywheel_utilities import (
+    disk_space,
+    download_bids,
+    instrumentation,
+    resources,
+    snapshot,
+    transfer,
+    utils,
+    zip_stream,
+)
 
 if TYPE_CHECKING:
-    from flywheel.models.container_subject_output import ContainerSubjectOutput
-
+    from flywheel.models.file_entry import FileEntry
 
 log = logging.getLogger(__name__)
 
@@ -41,31 +51,165 @@ def dicom_unzip_name(name: str) -> str:
     return clean_name.replace("_-_", "-")
 
 
-# pylint: disable=too-many-branches
+def dicom_series_info(scan: FileEntry, field: str) -> Any:
+    """
+    Retrieve a DICOM header field from the file metadata, falling back to the top level of the
+    file info if the DICOM header is not present.
+
+    Parameters
+    ----------
+    scan:
+        file on Flywheel
+    field:
+        DICOM header field (e.g., SeriesNumber)
+
+    Returns
+    -------
+        value of the field, or None if not present
+    """
+
+    try:
+        return scan.info["header"]["dicom"][field]
+    except KeyError:
+        return scan.info.get(field)
+
+
+def index_dicom_series(
+    tree: snapshot.SubjectSnapshot,
+) -> dict[str, tuple[int, FileEntry | None]]:
+    """
+    Index the subject's BIDS file names by SeriesNumber, alongside the DICOM series from the same
+    acquisition with the matching SeriesNumber. Built in a single pass over the subject's files.
+
+    Parameters
+    ----------
+    tree:
+        snapshot of the subject
+
+    Returns
+    -------
+        dict of BIDS file names and their SeriesNumber and DICOM series (None if not found)
+    """
+
+    index: dict[str, tuple[int, FileEntry | None]] = {}
+
+    for session in tree.sessions:
+        for acq in session.acquisitions:
+            # Check if ignore is set at acquisition level
+            if acq.is_ignored():
+                continue
+
+            bids_files: dict[str, int] = {}
+            dicoms: dict[int, FileEntry] = {}
+            for scan in acq.files:
+                series_number: int | None = dicom_series_info(scan, "SeriesNumber")
+                if series_number is None:
+                    continue
+                if scan.type.lower() == "dicom":
+                    dicoms.setdefault(series_number, scan)
+                if download_bids.is_bidsified(scan, acq):
+                    bids_files.setdefault(scan["info"]["BIDS"]["Filename"], series_number)
+
+            for filename, series_number in bids_files.items():
+                index.setdefault(filename, (series_number, dicoms.get(series_number)))
+
+    return index
+
+
+def download_dicom_series(
+    scan: FileEntry, work_dir: Path, is_dry_run: bool, stream: bool = False
+) -> Path:
+    """
+    Download a DICOM series, unzipping classic DICOMs and placing enhanced DICOMs in their own
+    folder. If stream is True, classic DICOMs are extracted while downloading, without writing the
+    zip file to disk.
+
+    Parameters
+    ----------
+    scan:
+        DICOM series on Flywheel
+    work_dir:
+        Path to working directory
+    is_dry_run:
+        unzip results?
+    stream:
+        extract zipped series while downloading?
+
+    Returns
+    -------
+        Path to folder containing the DICOMs
+    """
+
+    series_number: int = dicom_series_info(scan, "SeriesNumber")
+    series_desc: str = dicom_series_info(scan, "SeriesDescription")
+
+    is_zipped: bool = scan.name.lower().endswith(".zip")
+    scan_name: str = (str(series_number) + "_" + series_desc).replace(" ", "_")
+    if is_zipped and stream:
+        unzip_name: Path = work_dir / dicom_unzip_name(scan_name)
+        if not unzip_name.exists() and is_dry_run is False:
+            zip_stream.stream_unzip_file(scan, unzip_name)
+        log.debug(f" -> {unzip_name}")
+        return unzip_name
+
+    if not is_zipped:
+        download_dir_enhanced: Path = work_dir / scan_name
+        log.debug(f"  creating: {download_dir_enhanced}")
+        download_dir_enhanced.mkdir(exist_ok=True)
+        download_name: Path = download_dir_enhanced / scan.name
+    else:
+        download_name = work_dir / scan.name
+    if not download_name.is_file():
+        transfer.download_file(scan, download_name)
+
+    log.debug(f"  {download_name=}")
+    # If dealing with enhanced DICOMS, nothing to unzip
+    if not is_zipped:
+        return download_dir_enhanced
+
+    # If dealing with classic DICOMS, unzip the file
+    unzip_name = work_dir / dicom_unzip_name(scan_name)
+    if not download_name.is_dir() and is_dry_run is False:
+        with instrumentation.span("extraction", filename=scan.name) as record:
+            unzip_archive(download_name, unzip_name, is_dry_run)
+            record.add(files=1)
+    log.debug(f" -> {unzip_name}")
+
+    return unzip_name
+
+
+# pylint: disable=too-many-arguments
 # pylint: disable=too-many-locals
-# pylint: disable=too-many-nested-blocks
-# pylint: disable=too-many-statements
 def download_specific_dicoms(
-    subject: ContainerSubjectOutput,
+    subject: snapshot.SubjectLike,
     filenames: list[str],
     work_dir: Path,
     is_dry_run: bool = False,
+    *,
+    stream: bool = False,
+    check_space: bool = True,
 ) -> dict[str, Path]:
     """
     Download a zipped DICOM series. Use the BIDsified file names from the NIfTI file(s) to find the
     container housing the DICOM series, then use SeriesNumber to find the correct DICOM in the
-    Flywheel container.
+    Flywheel container. Each requested name is matched to the first BIDS file it is found in.
+    Unless check_space is False, the free disk space is checked before downloading (see
+    admit_dicoms).
 
     Parameters
     ----------
     subject:
-        Flywheel subject object
+        Flywheel subject object or snapshot
     filenames:
         list of BIDsified file names
     work_dir:
         Path to working directory
     is_dry_run:
         download results?
+    stream:
+        extract zipped series while downloading, without writing the zip file to disk?
+    check_space:
+        check the free disk space before downloading?
 
     Returns
     -------
@@ -77,132 +221,98 @@ def download_specific_dicoms(
 
     # Track number of downloads
     num_files: int = len(filenames)
-    num_downloads: int = 0
 
     orig_dicoms: dict[str, Path] = {}
 
-    for session in subject.sessions.iter():
-        for acq in session.reload().acquisitions.iter():
-            # Check if ignore is set at acquisition level
-            if "BIDS" in acq.info:
-                if acq.info["BIDS"]["ignore"] is True:
-                    continue
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
 
-            # Loop over files, search for the NIfTIs that were used in the
-            # analysis, then download the DICOMs found in the same container
-            download: bool = False
-            for scan in acq.reload().files:
-                if not download_bids.is_bidsified(scan, acq):
-                    continue
+    # Compile the requested file names once for the whole search
+    matcher = utils.PatternMatcher(filenames)
 
-                filename: str = scan["info"]["BIDS"]["Filename"]
-
-                # Search through requested files and check for matches
-                for name in filenames:
-                    if re.search(name, filename):
-                        download = True
-                        # Extract series number to use as unique identifier
-                        try:
-                            series_number: int = scan.info["header"]["dicom"]["SeriesNumber"]
-                        except KeyError:
-                            series_number = scan.info["SeriesNumber"]
-                        break
-                else:
-                    continue
+    # Search the BIDS file names for the NIfTIs that were used in the analysis, then download
+    # the DICOMs with the same SeriesNumber found in the same container
+    series: dict[str, FileEntry] = {}
+    for filename, (series_number, dicom) in index_dicom_series(tree).items():
+        name: str | None = matcher.search(filename)
+        if name is None or name in series:
+            continue
 
-                log.info(f"Located: {filename}")
+        log.info(f"Located: {filename}")
 
-                if download is True:
-                    break
+        if dicom is None:
+            log.warning(f"No DICOM series found with SeriesNumber: {series_number}")
+            continue
 
-            # If the correct BIDs file was found, reloop over the scans and
-            # download the DICOM series
-            if download is not True:
-                continue
+        series[name] = dicom
 
-            for scan in acq.reload().files:
-                if scan.type.lower() == "dicom":
-                    # Extract scan information which will be used to match with correct DICOM
-                    try:
-                        series_number_dicom: int = scan.info["header"]["dicom"]["SeriesNumber"]
-                        series_desc_dicom: str = scan.info["header"]["dicom"]["SeriesDescription"]
-                    except KeyError:
-                        series_number_dicom = scan.info["SeriesNumber"]
-                        series_desc_dicom = scan.info["SeriesDescription"]
-
-                    if series_number_dicom == series_number:
-                        is_zipped: bool = scan.name.lower().endswith(".zip")
-                        scan_name: str = (
-                            str(series_number_dicom) + "_" + series_desc_dicom
-                        ).replace(" ", "_")
-                        if not is_zipped:
-                            download_dir_enhanced = work_dir / scan_name
-                            log.debug(f"  creating: {download_dir_enhanced}")
-                            download_dir_enhanced.mkdir(exist_ok=True)
-                            download_name = download_dir_enhanced / scan.name
-                        else:
-                            download_name = work_dir / scan.name
-                        if not download_name.is_file():
-                            scan.download(download_name)
-                        num_downloads += 1
-                        break
+        # Stop early if requested DICOMs have already been found
+        if len(series) == num_files:
+            break
 
-            log.debug(f"  {download_name=}")
-            # If dealing with classic DICOMS, unzip the file
-            if is_zipped:
-                unzip_name: Path = work_dir / dicom_unzip_name(scan_name)
-                if not download_name.is_dir() and is_dry_run is False:
-                    unzip_archive(download_name, unzip_name, is_dry_run)
-                log.debug(f" -> {unzip_name}")
+    # Series are extracted into work_dir, alongside the zip files. A series matching several
+    # names is only downloaded once
+    if check_space and not is_dry_run:
+        unique: list[FileEntry] = list({id(dicom): dicom for dicom in series.values()}.values())
+        stream = admit_dicoms(unique, work_dir, work_dir, stream)
 
-                orig_dicoms[name] = unzip_name
-            else:
-                orig_dicoms[name] = download_dir_enhanced
+    for name, dicom in series.items():
+        orig_dicoms[name] = download_dicom_series(dicom, work_dir, is_dry_run, stream)
 
-            # Return early if requested DICOMs have already been found
-            if num_downloads == num_files:
-                return orig_dicoms
+    if len(orig_dicoms) == num_files:
+        return orig_dicoms
 
     # If completed looping over all sessions, check the correct number of DICOM
     # series were downloaded
-    if num_downloads != num_files:
-        log.warning("Could not find all the requested DICOM series")
-        log.warning(f"Only {num_downloads}/{num_files} downloaded")
-        log.warning(f"Provided strings: {filenames}")
+    log.warning("Could not find all the requested DICOM series")
+    log.warning(f"Only {len(orig_dicoms)}/{num_files} downloaded")
+    log.warning(f"Provided strings: {filenames}")
+    log.warning(f"Strings without a match: {matcher.unmatched()}")
 
     return orig_dicoms
 
 
-def download_all_dicoms(
-    subject: ContainerSubjectOutput,
-    work_dir: Path,
-    to_ignore: list[str],
-    dicom_dir: Path,
-    is_dry_run: bool,
-) -> None:
+def dicom_bids_path(scan: FileEntry) -> Path | None:
     """
-    Download all DICOM series for a subject with the option to filter using to_ignore.
+    Construct the BIDS path of a DICOM series from the file metadata, if it has been BIDSified
 
     Parameters
     ----------
-    subject:
-        Flywheel subject object
-    work_dir:
-        Path to working directory for download
+    scan:
+        DICOM series on Flywheel
+
+    Returns
+    -------
+        path relative to the BIDS directory, or None if not BIDSified
+    """
+
+    try:
+        bids_info: dict[str, Any] = scan.info["BIDS"]
+        return Path(bids_info["Path"]) / bids_info["Filename"]
+    except (KeyError, TypeError):
+        return None
+
+
+def select_dicom_series(
+    tree: snapshot.SubjectSnapshot, to_ignore: list[str]
+) -> Iterator[FileEntry]:
+    """
+    Find the DICOM series of a subject, skipping ignored acquisitions and those with labels
+    containing any of the strings in to_ignore
+
+    Parameters
+    ----------
+    tree:
+        snapshot of the subject
     to_ignore:
         list of strings used to reject DICOMS for download
-    dicom_dir:
-        directory to extract DICOM series to
-    is_dry_run:
-        download results?
-    """
 
-    log.info("--------------------------------------------")
-    log.info("Downloading multiple DICOM series")
+    Yields
+    ------
+        DICOM series on Flywheel
+    """
 
-    # Track number of downloads
-    for session in subject.sessions.iter():
-        for acq in session.reload().acquisitions.iter():
+    for session in tree.sessions:
+        for acq in session.acquisitions:
             # Filter
             skip_container: bool = False
             for ignore in to_ignore:
@@ -213,36 +323,285 @@ def download_all_dicoms(
                 continue
 
             # Check if ignore is set at acquisition level
-            if "BIDS" in acq.info:
-                if acq.info["BIDS"]["ignore"] is True:
-                    continue
+            if acq.is_ignored():
+                continue
 
-            for scan in acq.reload().files:
+            for scan in acq.files:
                 # Only interested in DICOMS
                 if not scan.type.lower() == "dicom":
                     continue
 
-                log.info(f"Found: {scan.name}")
+                log.info(f"Found: {scan.name}", extra=transfer.log_fields(scan, acq.id))
+                yield scan
 
-                is_zipped: bool = scan.name.lower().endswith(".zip")
 
-                scan_name: str = scan.name.replace(" ", "_")
-                download_name: Path = work_dir / scan_name
+def dicom_space_required(
+    series: list[FileEntry], work_dir: Path, dicom_dir: Path, stream: bool
+) -> dict[Path, int]:
+    """
+    Estimate the disk space required to download and extract DICOM series. Zip files are kept in
+    work_dir after extraction, unless streamed. Series already on disk are not counted.
+
+    Parameters
+    ----------
+    series:
+        DICOM series on Flywheel
+    work_dir:
+        Path to working directory for download
+    dicom_dir:
+        directory to extract DICOM series to
+    stream:
+        are zipped series extracted while downloading?
+
+    Returns
+    -------
+        number of bytes to be written, by destination directory
+    """
+
+    required: dict[Path, int] = {work_dir: 0, dicom_dir: 0}
+    for scan in series:
+        scan_name: str = scan.name.replace(" ", "_")
+        is_zipped: bool = scan_name.lower().endswith(".zip")
+        if (dicom_dir / dicom_unzip_name(scan_name)).exists():
+            continue
+        if not (is_zipped and stream) and not (work_dir / scan_name).exists():
+            required[work_dir] += disk_space.file_bytes(scan)
+        if is_zipped:
+            required[dicom_dir] += disk_space.extracted_bytes(scan)
+
+    return required
+
+
+def admit_dicoms(series: list[FileEntry], work_dir: Path, dicom_dir: Path, stream: bool) -> bool:
+    """
+    Check there is enough disk space to download and extract DICOM series before starting. If the
+    zip files do not fit alongside the extracted series, switch to extracting while downloading.
+
+    Parameters
+    ----------
+    series:
+        DICOM series on Flywheel
+    work_dir:
+        Path to working directory for download
+    dicom_dir:
+        directory to extract DICOM series to
+    stream:
+        extract zipped series while downloading?
+
+    Returns
+    -------
+        extract zipped series while downloading?
+
+    Raises
+    ------
+    OSError
+        (errno.ENOSPC) if there is not enough disk space even when extracting while downloading
+    """
+
+    required: dict[Path, int] = dicom_space_required(series, work_dir, dicom_dir, stream)
+    if stream or disk_space.has_free_space(required):
+        disk_space.check_free_space(required)
+        return stream
+
+    disk_space.check_free_space(dicom_space_required(series, work_dir, dicom_dir, True))
+    log.warning(
+        "Not enough disk space to keep the zipped DICOM series, extracting while downloading"
+    )
+    return True
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-branches
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-statements
+def iter_all_dicoms(
+    subject: snapshot.SubjectLike,
+    work_dir: Path,
+    to_ignore: list[str],
+    dicom_dir: Path,
+    is_dry_run: bool,
+    *,
+    max_workers: int = 1,
+    stream: bool = False,
+    check_space: bool = True,
+) -> Iterator[tuple[Path | None, Path, FileEntry]]:
+    """
+    Download all DICOM series for a subject with the option to filter using to_ignore, yielding
+    each series as soon as it has been extracted so that processing (e.g., conversion) can start
+    while the remaining series are downloaded. If max_workers is greater than one, zipped series are
+    extracted by a pool of processes while the remaining series are downloaded, and are yielded in
+    the order their extraction completes. Alternatively, if stream is True, zipped series are
+    extracted while downloading without writing the zip files to disk. In a dry run, zipped series
+    are not extracted, so the yielded folders may not exist. Unless check_space is False, the free
+    disk space is checked before downloading, switching to extracting while downloading if the zip
+    files would not fit (see admit_dicoms).
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    work_dir:
+        Path to working directory for download
+    to_ignore:
+        list of strings used to reject DICOMS for download
+    dicom_dir:
+        directory to extract DICOM series to
+    is_dry_run:
+        download results?
+    max_workers:
+        number of processes used to extract zipped series (at most the number of available CPUs)
+    stream:
+        extract zipped series while downloading?
+    check_space:
+        check the free disk space before downloading?
+
+    Yields
+    ------
+        BIDS path of the series (None if not BIDSified), folder containing the DICOMs and file on
+        Flywheel
+
+    Raises
+    ------
+    ValueError
+        if max_workers is less than one
+    """
 
-                log.debug(f"  {download_name=}")
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, not {max_workers}")
 
-                if not download_name.exists():
-                    log.debug("   downloading...")
-                    scan.download(download_name)
+    log.info("--------------------------------------------")
+    log.info("Downloading multiple DICOM series")
 
-                # Unzip the file
-                unzip_name: Path = dicom_dir / dicom_unzip_name(scan_name)
-                log.debug(f"  {unzip_name=}")
-                if is_zipped:
-                    if not unzip_name.exists() and is_dry_run is False:
-                        unzip_archive(download_name, unzip_name, is_dry_run)
-                else:
-                    log.info(f"   moving to: {unzip_name}")
-                    unzip_name.mkdir(exist_ok=True)
-                    shutil.move(str(download_name), unzip_name / scan_name)
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
+    series: list[FileEntry] = list(select_dicom_series(tree, to_ignore))
+
+    if check_space and not is_dry_run:
+        stream = admit_dicoms(series, work_dir, dicom_dir, stream)
+
+    # Only spin up a pool of extraction processes when archives are to be extracted concurrently
+    pool: ProcessPoolExecutor | None = None
+    if max_workers > 1 and not is_dry_run and not stream:
+        n_procs: int = min(max_workers, resources.available_cpus()[0])
+        log.info(f"Extracting DICOM series with {n_procs} processes")
+        # Spawned rather than forked, as the logging and monitoring threads may hold locks
+        pool = ProcessPoolExecutor(
+            max_workers=n_procs, mp_context=multiprocessing.get_context("spawn")
+        )
+    pending: dict[Future[None], tuple[Path | None, Path, FileEntry]] = {}
+
+    try:
+        for scan in series:
+            is_zipped: bool = scan.name.lower().endswith(".zip")
+
+            scan_name: str = scan.name.replace(" ", "_")
+            unzip_name: Path = dicom_dir / dicom_unzip_name(scan_name)
+            item: tuple[Path | None, Path, FileEntry] = (dicom_bids_path(scan), unzip_name, scan)
+
+            # Extract directly from the download stream
+            if is_zipped and stream:
+                if not unzip_name.exists() and is_dry_run is False:
+                    zip_stream.stream_unzip_file(scan, unzip_name)
                 log.debug(f" -> {unzip_name}")
+                yield item
+                continue
+
+            download_name: Path = work_dir / scan_name
+
+            log.debug(f"  {download_name=}")
+
+            if not download_name.exists():
+                log.debug("   downloading...")
+                transfer.download_file(scan, download_name)
+
+            # Unzip the file
+            log.debug(f"  {unzip_name=}")
+            if is_zipped:
+                if not unzip_name.exists() and is_dry_run is False:
+                    if pool is None:
+                        with instrumentation.span("extraction", filename=scan.name) as record:
+                            unzip_archive(download_name, unzip_name, is_dry_run)
+                            record.add(files=1)
+                    else:
+                        future: Future[None] = pool.submit(
+                            unzip_archive, download_name, unzip_name, is_dry_run
+                        )
+                        pending[future] = item
+                        yield from utils.pop_completed(pending)
+                        continue
+            else:
+                log.info(f"   moving to: {unzip_name}")
+                unzip_name.mkdir(exist_ok=True)
+                shutil.move(str(download_name), unzip_name / scan_name)
+            log.debug(f" -> {unzip_name}")
+            yield item
+
+        # Wait for all queued extractions, raising the first error encountered. Extractions run
+        # in other processes, so only the time spent waiting for them is recorded
+        record = instrumentation.SpanRecord("extraction_wait")
+        waiting: float = time.perf_counter()
+        for future in as_completed(list(pending)):
+            record.seconds += time.perf_counter() - waiting
+            future.result()
+            record.add(files=1)
+            yield pending.pop(future)
+            waiting = time.perf_counter()
+        instrumentation.emit(record)
+    finally:
+        # Extractions not yet started are abandoned if the caller stops iterating early
+        for future in pending:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+# pylint: disable=too-many-arguments
+def download_all_dicoms(
+    subject: snapshot.SubjectLike,
+    work_dir: Path,
+    to_ignore: list[str],
+    dicom_dir: Path,
+    is_dry_run: bool,
+    *,
+    max_workers: int = 1,
+    stream: bool = False,
+    check_space: bool = True,
+) -> None:
+    """
+    Download all DICOM series for a subject with the option to filter using to_ignore.
+    If max_workers is greater than one, zipped series are extracted by a pool of processes while the
+    remaining series are downloaded. Alternatively, if stream is True, zipped series are extracted
+    while downloading without writing the zip files to disk. See iter_all_dicoms to process the
+    series as they are extracted. Unless check_space is False, the free disk space is checked
+    before downloading (see admit_dicoms).
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    work_dir:
+        Path to working directory for download
+    to_ignore:
+        list of strings used to reject DICOMS for download
+    dicom_dir:
+        directory to extract DICOM series to
+    is_dry_run:
+        download results?
+    max_workers:
+        number of processes used to extract zipped series (at most the number of available CPUs)
+    stream:
+        extract zipped series while downloading?
+    check_space:
+        check the free disk space before downloading?
+    """
+
+    for _ in iter_all_dicoms(
+        subject,
+        work_dir,
+        to_ignore,
+        dicom_dir,
+        is_dry_run,
+        max_workers=max_workers,
+        stream=stream,
+        check_space=check_space,
+    ):
+        pass
@@ -7,12 +7,15 @@ from __future__ import annotations
 import logging
 import re
 import sys
+from fnmatch import fnmatchcase
 from functools import reduce
 from pathlib import Path
-from typing import TYPE_CHECKING
-from zipfile import ZipFile
+from typing import TYPE_CHECKING, Any
+from zipfile import ZipFile, ZipInfo
 
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
+import flywheel
+
+from flywheel_utilities import disk_space, instrumentation, remote_zip, retry, transfer
 
 if TYPE_CHECKING:
     from flywheel.models.container_analysis_output import ContainerAnalysisOutput
@@ -21,40 +24,100 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+# Number of analyses requested per page when querying Flywheel
+PAGE_SIZE = 10
+
 # pylint: disable=too-many-locals
 
 
-def unzip_result(zip_name: Path, work_dir: Path, is_dry_run: bool) -> int:
+def select_members(
+    names: list[str], include: list[str] | None = None, exclude: list[str] | None = None
+) -> list[str]:
+    """
+    Select zip members using glob patterns matched against the full member name. A member is
+    selected if it matches any include pattern (or no include patterns were given) and does not
+    match any exclude pattern.
+
+    Parameters
+    ----------
+    names:
+        names of members in the zip file
+    include:
+        glob patterns of members to extract (e.g., "*/anat/*")
+    exclude:
+        glob patterns of members not to extract
+
+    Returns
+    -------
+        selected member names
+    """
+
+    return [
+        name
+        for name in names
+        if (include is None or any(fnmatchcase(name, pattern) for pattern in include))
+        and not any(fnmatchcase(name, pattern) for pattern in exclude or [])
+    ]
+
+
+# pylint: disable=too-many-arguments
+def extract_result(
+    in_zip: ZipFile,
+    zip_name: Path,
+    work_dir: Path,
+    is_dry_run: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> int:
     """
-    Unzip the downloaded results. Attempts to find the zipped folder name first, however if there
-    are not nested folders, the unzip name is determined by stripping the zipped names of
-    everything after and including "_sub-".  Only unzips the file if not already present.
+    Extract the results from an open zip file. Attempts to find the zipped folder name first,
+    however if there are not nested folders, the unzip name is determined by stripping the zipped
+    names of everything after and including "_sub-".  Only unzips the file if not already present.
+    If include or exclude patterns are given, only the selected members are extracted, skipping
+    any already present.
 
     Parameters
     ----------
+    in_zip:
+        open zip file
     zip_name:
-        Path to zip file
+        name of zip file
     work_dir:
         Path to work directory
     is_dry_run:
         is this a dry run?
+    include:
+        glob patterns of members to extract
+    exclude:
+        glob patterns of members not to extract
 
     Returns
     -------
         exit code
     """
 
-    # Get list of all files in the zip file
-    with ZipFile(zip_name, "r") as in_zip:
-        dirs: list[str] = [info.filename for info in in_zip.infolist() if info.is_dir()]
-        files: list[str] = [
-            info.filename for info in in_zip.infolist() if not str(info).endswith("/")
-        ]
+    # Read the central directory once, and extract from the same handle
+    infos: list[ZipInfo] = in_zip.infolist()
+    dirs: list[str] = [info.filename for info in infos if info.is_dir()]
+    files: list[str] = [info.filename for info in infos if not info.is_dir()]
 
     if len(dirs) == 0 and len(files) == 0:
         log.error("Zip file is empty!")
         return 1
 
+    if include is not None or exclude is not None:
+        members: list[str] = select_members(files, include, exclude)
+        log.info(f"Extracting {len(members)}/{len(files)} members of {zip_name.name}")
+        if len(members) == 0:
+            log.warning(f"No members matched include={include} exclude={exclude}")
+        with instrumentation.span("extraction", filename=zip_name.name) as record:
+            for member in members:
+                if not (work_dir / member).exists() and not is_dry_run:
+                    record.add(bytes=in_zip.getinfo(member).file_size, files=1)
+                    in_zip.extract(member, work_dir)
+        return 0
+
     # Extract the base directory
     if len(dirs) != 0:
         base_dir: str = Path(dirs[0]).parts[0]
@@ -65,67 +128,254 @@ def unzip_result(zip_name: Path, work_dir: Path, is_dry_run: bool) -> int:
 
     # Check if file already exists
     if not (work_dir / base_dir).exists():
-        unzip_archive(zip_name, work_dir, is_dry_run)
+        log.info(f"Unzipping file, {zip_name}")
+        if not is_dry_run:
+            with instrumentation.span("extraction", filename=zip_name.name) as record:
+                in_zip.extractall(work_dir)
+                record.add(bytes=sum(info.file_size for info in infos), files=len(files))
     else:
         log.debug("Unzipped file already exists")
 
     return 0
 
 
-def download_previous_result(
-    subject: ContainerSubjectOutput,
-    results: dict[str, str],
+def unzip_result(
+    zip_name: Path,
     work_dir: Path,
-    export_gear: bool = False,
-    is_dry_run: bool = False,
+    is_dry_run: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
 ) -> int:
     """
-    Download a result from a specific gear, with the option to filter via the job tags.
-    One can specify if searching for processing results or export results via export_gear.
-    Results will be downloaded to 'work_dir'.
+    Unzip the downloaded results. See extract_result for details.
 
     Parameters
     ----------
-    subject:
-        Flywheel subject object
-    results_info:
-        dict containing gear_name, filename and tag.
-            - gear_name: with or without version
-            - filename: used as regex to match output file
-            - tag: used for simple is <tag> in tag search of job tags.
+    zip_name:
+        Path to zip file
+    work_dir:
+        Path to work directory
+    is_dry_run:
+        is this a dry run?
+    include:
+        glob patterns of members to extract
+    exclude:
+        glob patterns of members not to extract
+
+    Returns
+    -------
+        exit code
+    """
+
+    with ZipFile(zip_name, "r") as in_zip:
+        return extract_result(
+            in_zip, zip_name, work_dir, is_dry_run, include=include, exclude=exclude
+        )
+
+
+def unzip_remote_result(
+    output: FileEntry,
+    work_dir: Path,
+    is_dry_run: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> int:
+    """
+    Unzip results directly from Flywheel using HTTP range requests, transferring only the
+    central directory and the extracted members. If the server does not support range requests,
+    the zip file is downloaded and unzipped as usual. See extract_result for details.
+
+    Parameters
+    ----------
+    output:
+        zipped output on Flywheel
     work_dir:
         Path to work directory
-    export_gear:
-        should export runs be included?
     is_dry_run:
         is this a dry run?
+    include:
+        glob patterns of members to extract
+    exclude:
+        glob patterns of members not to extract
 
     Returns
     -------
         exit code
     """
 
-    gear_name: str = results["gear_name"]
-    filename: str = results["filename"]
-    tag: str = results["tag"]
+    log.info(f"Reading remote zip: {output.name}")
+    try:
+        with remote_zip.RemoteZip(output) as archive:
+            ret: int = extract_result(
+                archive.zip_file,
+                Path(output.name),
+                work_dir,
+                is_dry_run,
+                include=include,
+                exclude=exclude,
+            )
+            log.info(f"Transferred {archive.bytes_read} bytes of {output.name}")
+            return ret
+    except remote_zip.RangeNotSupportedError as err:
+        log.warning(f"{err}, downloading the whole zip file instead")
+
+    download_name: Path = work_dir / output.name
+    transfer.download_file(output, download_name)
+
+    return unzip_result(download_name, work_dir, is_dry_run, include=include, exclude=exclude)
+
+
+def is_completed_run(
+    analysis: ContainerAnalysisOutput | dict[str, Any], gear_name: str, export_gear: bool
+) -> bool:
+    """
+    Check if an analysis is a successful run of the requested gear
+
+    Parameters
+    ----------
+    analysis:
+        analysis container, or its JSON as listed by Flywheel (with the job inflated)
+    gear_name:
+        name of gear
+    export_gear:
+        should export runs be included?
+
+    Returns
+    -------
+        successful run?
+    """
+
+    if "gear-export" in analysis["job"]["config"]["config"]:
+        if analysis["job"]["config"]["config"]["gear-export"] != export_gear:
+            return False
+    return gear_name in analysis["gear_info"]["name"] and analysis["job"]["state"] == "complete"
+
+
+def query_latest_analysis(
+    client: flywheel.Client, subject_id: str, gear_name: str, tag: str, export_gear: bool
+) -> ContainerAnalysisOutput | None:
+    """
+    Query Flywheel for the subject's analyses from the requested gear, newest first, and return
+    the first successful run with the requested tag. Analyses are requested a page at a time, so
+    usually only a single small request is required, plus one to retrieve the matching analysis.
+    The job state and tags are not stored on the analyses, so cannot be filtered by the query.
+
+    Parameters
+    ----------
+    client:
+        Flywheel client
+    subject_id:
+        ID of subject
+    gear_name:
+        name of gear
+    tag:
+        tag required in the job tags (ignored if empty)
+    export_gear:
+        should export runs be included?
+
+    Returns
+    -------
+        latest matching analysis, or None if not found
+    """
+
+    skip: int = 0
+    while True:
+        # The SDK deserializes listed analyses with the job as a string, even when inflated, so
+        # the listed JSON is read instead
+        with instrumentation.span("api", subject=subject_id) as record:
+            page: list[dict[str, Any]] = retry.call(
+                client.get_subject_analyses,
+                subject_id,
+                filter=f"gear_info.name=~{gear_name}",
+                sort="created:desc",
+                limit=PAGE_SIZE,
+                skip=skip,
+                inflate_job=True,
+                _preload_content=False,
+            ).json()
+            record.add(api_calls=1)
+        if not page:
+            return None
+
+        # Filters not supported by the query are checked here. Analyses without a job (e.g.,
+        # uploaded) are not gear runs
+        for analysis in page:
+            if not isinstance(analysis.get("job"), dict):
+                continue
+            if not is_completed_run(analysis, gear_name, export_gear):
+                continue
+            if tag == "" or tag in analysis["job"]["tags"]:
+                with instrumentation.span("api", analysis=analysis["_id"]) as record:
+                    latest: ContainerAnalysisOutput = retry.call(
+                        client.get_analysis, analysis["_id"], inflate_job=True
+                    )
+                    record.add(api_calls=1)
+                return latest
+
+        skip += PAGE_SIZE
+
+
+# pylint: disable=too-many-arguments
+def find_previous_result(
+    subject: ContainerSubjectOutput,
+    gear_name: str,
+    tag: str,
+    export_gear: bool = False,
+    *,
+    client: flywheel.Client | None = None,
+) -> ContainerAnalysisOutput | None:
+    """
+    Find the latest successful run of a gear on a subject, with the option to filter via the job
+    tags. If a Flywheel client is supplied, the latest result is found by querying Flywheel,
+    rather than retrieving and filtering all of the subject's analyses.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object
+    gear_name:
+        name of gear, with or without version
+    tag:
+        used for simple is <tag> in tag search of job tags (ignored if empty)
+    export_gear:
+        should export runs be included?
+    client:
+        Flywheel client used to query the subject's analyses
+
+    Returns
+    -------
+        latest matching analysis, or None if not found
+    """
 
     log.info(f"Attempting to find previous {gear_name} result")
 
-    analyses: list[ContainerAnalysisOutput] = subject.reload().analyses
+    if client is not None:
+        try:
+            latest_result: ContainerAnalysisOutput | None = query_latest_analysis(
+                client, subject.id, gear_name, tag, export_gear
+            )
+        except flywheel.ApiException as err:  # pylint: disable=maybe-no-member
+            log.warning(f"Could not query analyses, filtering all analyses instead: {err}")
+        else:
+            if latest_result is None:
+                log.error(f"No successful {gear_name} runs with the tag '{tag}' were found!")
+            return latest_result
 
-    # Scan through subject's previous analyses and find all successful runs
-    def filter_completed(analysis: ContainerAnalysisOutput) -> bool:
-        if "gear-export" in analysis.job.config["config"]:
-            if analysis.job.config["config"]["gear-export"] != export_gear:
-                return False
-        return gear_name in analysis.gear_info["name"] and analysis.job["state"] == "complete"
+    with instrumentation.span("api", subject=subject.id) as record:
+        analyses: list[ContainerAnalysisOutput] = retry.call(subject.reload).analyses
+        record.add(api_calls=1)
 
-    analyses = list(filter(filter_completed, analyses))
+    # Scan through subject's previous analyses and find all successful runs
+    analyses = [
+        analysis for analysis in analyses if is_completed_run(analysis, gear_name, export_gear)
+    ]
 
     # Check we still have analysis outputs
     if len(analyses) == 0:
         log.error(f"No successful {gear_name} runs were found!")
-        return 1
+        return None
 
     log.debug(f"Found {len(analyses)} successful gear runs")
 
@@ -140,7 +390,7 @@ def download_previous_result(
     # Check we still have analysis outputs
     if len(analyses) == 0:
         log.error(f"No successful {gear_name} runs survived tag filtering!")
-        return 1
+        return None
 
     # list potential outputs
     log.debug(f"The following {gear_name} outputs were found:")
@@ -154,7 +404,222 @@ def download_previous_result(
     ) -> ContainerAnalysisOutput:
         return output1 if output1.created > output2.created else output2
 
-    latest_result: ContainerAnalysisOutput = reduce(latest_date, analyses)
+    return reduce(latest_date, analyses)
+
+
+def member_bytes(
+    output: FileEntry,
+    work_dir: Path,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> int | None:
+    """
+    Size of the members of a zipped output once extracted, read from its central directory using
+    range requests. Only the members selected by include and exclude that are not already in
+    work_dir are counted (see extract_result).
+
+    Parameters
+    ----------
+    output:
+        zipped output on Flywheel
+    work_dir:
+        Path to work directory
+    include:
+        glob patterns of members to extract
+    exclude:
+        glob patterns of members not to extract
+
+    Returns
+    -------
+        number of bytes, or None if range requests are not supported
+    """
+
+    try:
+        with remote_zip.RemoteZip(output) as archive:
+            infos: list[ZipInfo] = [info for info in archive.infolist() if not info.is_dir()]
+    except remote_zip.RangeNotSupportedError:
+        return None
+
+    selected: set[str] = set(select_members([info.filename for info in infos], include, exclude))
+    return sum(
+        info.file_size
+        for info in infos
+        if info.filename in selected and not (work_dir / info.filename).exists()
+    )
+
+
+def admit_result(
+    output: FileEntry,
+    work_dir: Path,
+    remote: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> bool:
+    """
+    Check there is enough disk space to download (and extract) an analysis output before
+    starting. The space required by a zipped output is the size of its selected members, read from
+    its central directory (see member_bytes), plus the size of the zip file unless it is read from
+    Flywheel using range requests. If the zip file does not fit alongside its extracted members,
+    switch to reading the members from Flywheel using range requests.
+
+    Parameters
+    ----------
+    output:
+        analysis output on Flywheel
+    work_dir:
+        Path to work directory
+    remote:
+        read zipped outputs from Flywheel using range requests, rather than downloading them?
+    include:
+        glob patterns of zip members to extract
+    exclude:
+        glob patterns of zip members not to extract
+
+    Returns
+    -------
+        read the zipped output from Flywheel using range requests?
+
+    Raises
+    ------
+    OSError
+        (errno.ENOSPC) if there is not enough disk space for the (extracted) output
+    """
+
+    if not output.name.endswith(".zip"):
+        disk_space.check_free_space({work_dir: disk_space.file_bytes(output)})
+        return remote
+
+    zipped: int = disk_space.file_bytes(output)
+    extracted: int | None = member_bytes(output, work_dir, include, exclude)
+    if extracted is None:
+        # Without range requests the zip file is downloaded, even if remote, and the size of the
+        # members is unknown
+        disk_space.check_free_space({work_dir: zipped + disk_space.extracted_bytes(output)})
+        return remote
+
+    if not remote and disk_space.has_free_space({work_dir: zipped + extracted}):
+        return False
+
+    disk_space.check_free_space({work_dir: extracted})
+    if not remote:
+        log.warning(
+            f"Not enough disk space to download {output.name} ({zipped / 1024**3:.2f} GiB) and "
+            f"extract {extracted / 1024**3:.2f} GiB, switching to reading the members from "
+            "Flywheel using range requests"
+        )
+    return True
+
+
+# pylint: disable=too-many-arguments
+def download_previous_result(
+    subject: ContainerSubjectOutput,
+    results: dict[str, str],
+    work_dir: Path,
+    export_gear: bool = False,
+    is_dry_run: bool = False,
+    *,
+    client: flywheel.Client | None = None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+    remote: bool = False,
+    check_space: bool = True,
+) -> int:
+    """
+    Download a result from a specific gear, with the option to filter via the job tags.
+    One can specify if searching for processing results or export results via export_gear.
+    Results will be downloaded to 'work_dir'. If a Flywheel client is supplied, the latest result
+    is found by querying Flywheel, rather than retrieving and filtering all of the subject's
+    analyses. If remote is True, only the required members of a zipped result are transferred.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object
+    results_info:
+        dict containing gear_name, filename and tag.
+            - gear_name: with or without version
+            - filename: used as regex to match output file
+            - tag: used for simple is <tag> in tag search of job tags.
+    work_dir:
+        Path to work directory
+    export_gear:
+        should export runs be included?
+    is_dry_run:
+        is this a dry run?
+    client:
+        Flywheel client used to query the subject's analyses
+    include:
+        glob patterns of zip members to extract (all members if None)
+    exclude:
+        glob patterns of zip members not to extract
+    remote:
+        read zipped outputs from Flywheel using range requests, rather than downloading them?
+    check_space:
+        check the free disk space before downloading? See admit_result
+
+    Returns
+    -------
+        exit code
+    """
+
+    latest_result: ContainerAnalysisOutput | None = find_previous_result(
+        subject, results["gear_name"], results["tag"], export_gear, client=client
+    )
+    if latest_result is None:
+        return 1
+
+    return download_analysis_output(
+        latest_result,
+        results["filename"],
+        work_dir,
+        is_dry_run,
+        include=include,
+        exclude=exclude,
+        remote=remote,
+        check_space=check_space,
+    )
+
+
+# pylint: disable=too-many-arguments
+def download_analysis_output(
+    latest_result: ContainerAnalysisOutput,
+    filename: str,
+    work_dir: Path,
+    is_dry_run: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+    remote: bool = False,
+    check_space: bool = True,
+) -> int:
+    """
+    Download (and unzip) the output of a previous analysis to 'work_dir'. Unless check_space is
+    False, the free disk space is checked before downloading (see admit_result).
+
+    Parameters
+    ----------
+    latest_result:
+        analysis containing the output
+    filename:
+        regex used to find output file
+    work_dir:
+        Path to work directory
+    is_dry_run:
+        is this a dry run?
+    include:
+        glob patterns of zip members to extract (all members if None)
+    exclude:
+        glob patterns of zip members not to extract
+    remote:
+        read zipped outputs from Flywheel using range requests, rather than downloading them?
+    check_space:
+        check the free disk space before downloading?
+
+    Returns
+    -------
+        exit code
+    """
 
     log.info(f"Download results from {latest_result.gear_info['version']}")
     log.info(f"Job id for previous results: {latest_result.id}")
@@ -167,9 +632,18 @@ def download_previous_result(
 
         log.info(f"Found: {output.name}")
         download_name = work_dir / output.name
+        if check_space and not is_dry_run and not download_name.is_file():
+            remote = admit_result(output, work_dir, remote, include=include, exclude=exclude)
+        if remote and output.name.endswith(".zip") and not download_name.is_file():
+            return unzip_remote_result(
+                output, work_dir, is_dry_run, include=include, exclude=exclude
+            )
         if not download_name.is_file():
-            log.info(f"Downloading: {download_name.name}")
-            output.download(download_name)
+            log.info(
+                f"Downloading: {download_name.name}",
+                extra=transfer.log_fields(output, latest_result.id),
+            )
+            transfer.download_file(output, download_name)
             break
 
     # Check file was downloaded
@@ -182,17 +656,27 @@ def download_previous_result(
     log.info("Successfully downloaded")
 
     if str(download_name).endswith(".zip"):
-        return unzip_result(download_name, work_dir, is_dry_run)
+        return unzip_result(download_name, work_dir, is_dry_run, include=include, exclude=exclude)
 
     return 0
 
 
+# pylint: disable=too-many-arguments
 def download_specific_result(
-    analysis: ContainerAnalysisOutput, filename: str, work_dir: Path, is_dry_run: bool
+    analysis: ContainerAnalysisOutput,
+    filename: str,
+    work_dir: Path,
+    is_dry_run: bool,
+    *,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+    remote: bool = False,
+    check_space: bool = True,
 ) -> None:
     """
     Download results using destination ID from previous gear run.
-    Results will be downloaded into work_dir.
+    Results will be downloaded into work_dir. Unless check_space is False, the free disk space is
+    checked before downloading (see admit_result).
 
     Parameters
     ----------
@@ -204,6 +688,14 @@ def download_specific_result(
         Path to work directory
     is_dry_run:
         is this a dry run?
+    include:
+        glob patterns of zip members to extract (all members if None)
+    exclude:
+        glob patterns of zip members not to extract
+    remote:
+        read zipped outputs from Flywheel using range requests, rather than downloading them?
+    check_space:
+        check the free disk space before downloading?
     """
 
     log.info("Scanning analysis output files for an output containing '{filename}'")
@@ -220,9 +712,16 @@ def download_specific_result(
             continue
         log.info(f"Found: {output.name}")
         download_name = work_dir / output.name
+        if check_space and not is_dry_run and not download_name.is_file():
+            remote = admit_result(output, work_dir, remote, include=include, exclude=exclude)
+        if remote and output.name.endswith(".zip") and not download_name.is_file():
+            unzip_remote_result(output, work_dir, is_dry_run, include=include, exclude=exclude)
+            return
         if not download_name.is_file():
-            log.info(f"Downloading: {download_name.name}")
-            output.download(download_name)
+            log.info(
+                f"Downloading: {download_name.name}", extra=transfer.log_fields(output, analysis.id)
+            )
+            transfer.download_file(output, download_name)
         else:
             log.debug("Zip file already exists. Must be testing")
         break
@@ -237,4 +736,4 @@ def download_specific_result(
     log.info("Successfully downloaded")
 
     if str(download_name).endswith(".zip"):
-        unzip_result(download_name, work_dir, is_dry_run)
+        unzip_result(download_name, work_dir, is_dry_run, include=include, exclude=exclude)
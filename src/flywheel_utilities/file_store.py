@@ -0,0 +1,211 @@
+"""
+Content-addressed store of downloaded files, shared by gear runs on the same node.
+Files are keyed by their Flywheel hash (or file ID and version if no hash is available), so a
+file already downloaded by a previous gear run is placed into the working directory with a
+hardlink (or a copy if the store is on another file system) instead of being downloaded again.
+The least recently used files are evicted once the store grows beyond its maximum size.
+
+Hardlinked files share their contents with the store, so must not be modified in place. Stored
+files are made read-only, so that writing to them fails rather than corrupting the store for later
+gear runs. Replace them instead (e.g., write to a temporary file and os.replace it).
+"""
+
+from __future__ import annotations
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from flywheel_utilities import instrumentation
+
+if TYPE_CHECKING:
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+OBJECTS_DIR = "objects"
+TMP_DIR = "tmp"
+READ_ONLY = 0o444
+
+
+def store_key(fw_file: FileEntry) -> str | None:
+    """
+    Construct the key of a file from its hash, or its file ID and version
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+
+    Returns
+    -------
+        key of the file, or None if the file cannot be identified
+    """
+
+    # Flywheel hashes are formatted as v0-<algorithm>-<hexdigest>
+    fw_hash: str | None = getattr(fw_file, "hash", None)
+    if fw_hash and fw_hash.count("-") == 2:
+        return fw_hash.split("-", 1)[1]
+
+    file_id: str | None = getattr(fw_file, "file_id", None)
+    version: int | None = getattr(fw_file, "version", None)
+    if file_id and version is not None:
+        return f"{file_id}-v{version}"
+
+    return None
+
+
+def link_or_copy(source: Path, destination: Path) -> None:
+    """
+    Hardlink source to destination, copying if hardlinks are not possible (e.g., across file
+    systems). An existing destination is replaced.
+
+    Parameters
+    ----------
+    source:
+        Path to existing file
+    destination:
+        Path to create
+    """
+
+    tmp_name: Path = destination.with_name(f".{destination.name}.{os.getpid()}.tmp")
+    try:
+        os.link(source, tmp_name)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            raise
+        log.debug(f"Cannot hardlink {source.name} ({err.strerror}), copying")
+        shutil.copyfile(source, tmp_name)
+    os.replace(tmp_name, destination)
+
+
+class FileStore:
+    """
+    Content-addressed file store with least recently used eviction
+
+    Parameters
+    ----------
+    root:
+        directory of the store (e.g., on node local scratch space)
+    max_bytes:
+        maximum total size of the stored files
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 100 * 1024**3):
+        self.root: Path = Path(root)
+        self.max_bytes: int = max_bytes
+
+        (self.root / OBJECTS_DIR).mkdir(parents=True, exist_ok=True)
+        (self.root / TMP_DIR).mkdir(exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        """Path of the stored file with the given key"""
+
+        # Hash keys are <algorithm>-<hexdigest>, and ID keys <file_id>-v<version>
+        prefix, _, digest = key.partition("-")
+        shard: str = digest[:2] if prefix in hashlib.algorithms_available else prefix[:2]
+        return self.root / OBJECTS_DIR / shard / key
+
+    def fetch(self, fw_file: FileEntry, destination: Path) -> bool:
+        """
+        Place a stored file at destination
+
+        Parameters
+        ----------
+        fw_file:
+            file on Flywheel
+        destination:
+            Path to place the file at
+
+        Returns
+        -------
+            was the file in the store?
+        """
+
+        key: str | None = store_key(fw_file)
+        if key is None:
+            return False
+        stored: Path = self.path(key)
+
+        with instrumentation.span("store", filename=fw_file.name) as record:
+            try:
+                size: int = stored.stat().st_size
+                if getattr(fw_file, "size", None) not in (None, size):
+                    log.warning(f"Discarding stored file with wrong size: {fw_file.name}")
+                    stored.unlink()
+                    return False
+                link_or_copy(stored, destination)
+                # The modification time records the last use, for eviction
+                os.utime(stored)
+            # Another gear run may have evicted the file in the meantime
+            except FileNotFoundError:
+                return False
+            record.add(bytes=size, files=1)
+
+        log.debug(f"Retrieved {fw_file.name} from file store")
+        return True
+
+    def add(self, fw_file: FileEntry, path: Path) -> None:
+        """
+        Add a downloaded file to the store, evicting old files if the store is too large
+
+        Parameters
+        ----------
+        fw_file:
+            file on Flywheel
+        path:
+            Path to the downloaded (and verified) file
+        """
+
+        key: str | None = store_key(fw_file)
+        if key is None:
+            log.debug(f"Cannot identify {fw_file.name}, not adding to file store")
+            return
+
+        stored: Path = self.path(key)
+        stored.parent.mkdir(exist_ok=True)
+        # Stage in the store first, so that other gear runs never see a partial file
+        with tempfile.TemporaryDirectory(dir=self.root / TMP_DIR) as tmp_dir:
+            staged: Path = Path(tmp_dir) / key
+            link_or_copy(path, staged)
+            # Also applies to the hardlinked working file, so in place edits fail loudly
+            os.chmod(staged, READ_ONLY)
+            os.replace(staged, stored)
+        log.debug(f"Added {fw_file.name} to file store")
+
+        self.evict()
+
+    def size(self) -> int:
+        """Total size of the stored files in bytes"""
+
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self) -> list[Path]:
+        """Stored files"""
+
+        return [entry for entry in (self.root / OBJECTS_DIR).glob("*/*") if entry.is_file()]
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the store fits within max_bytes"""
+
+        entries: list[tuple[float, int, Path]] = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total: int = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            log.debug(f"Evicting {entry.name} from file store")
+            entry.unlink(missing_ok=True)
+            total -= size
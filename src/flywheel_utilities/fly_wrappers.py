@@ -2,16 +2,22 @@
 Simple wrappers to use Flywheel.
 - get_subject()
 - check_run_level()
+- get_destination(), get_parent() and get_project(), which only look up each container once per
+  gear context
 """
 
 from __future__ import annotations
 
 import logging
 import sys
-from typing import TYPE_CHECKING
+import threading
+from typing import TYPE_CHECKING, Any, Callable
+from weakref import WeakKeyDictionary
 
 import flywheel
 
+from flywheel_utilities import instrumentation, retry
+
 if TYPE_CHECKING:
     from flywheel.models.container_subject_output import ContainerSubjectOutput
     from flywheel_geartoolkit_context import GearToolkitContext
@@ -19,6 +25,131 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+# Containers already looked up, and a lock for each lookup, per gear context
+_lookups: WeakKeyDictionary[Any, dict[str, Any]] = WeakKeyDictionary()
+_lookup_locks: WeakKeyDictionary[Any, dict[str, threading.Lock]] = WeakKeyDictionary()
+# Only guards the dicts above, so is never held during a request
+_lookups_lock = threading.Lock()
+
+
+def cached_lookup(context: GearToolkitContext, key: str, fetch: Callable[[], Any]) -> Any:
+    """
+    Return the result of a lookup for this context, only calling fetch the first time. Failed
+    lookups are not cached. Concurrent calls for the same lookup wait for a single fetch, while
+    other lookups (and other contexts) proceed independently.
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object
+    key:
+        name of the lookup
+    fetch:
+        function performing the lookup
+
+    Returns
+    -------
+        result of the lookup
+    """
+
+    with _lookups_lock:
+        lookups: dict[str, Any] = _lookups.setdefault(context, {})
+        if key in lookups:
+            return lookups[key]
+        key_lock: threading.Lock = _lookup_locks.setdefault(context, {}).setdefault(
+            key, threading.Lock()
+        )
+
+    with key_lock:
+        # Another thread may have completed the lookup while waiting
+        with _lookups_lock:
+            if key in lookups:
+                return lookups[key]
+
+        with instrumentation.span("api", lookup=key) as record:
+            result: Any = retry.call(fetch)
+            record.add(api_calls=1)
+
+        with _lookups_lock:
+            lookups[key] = result
+        return result
+
+
+def clear_lookups(context: GearToolkitContext | None = None) -> None:
+    """
+    Forget the looked up containers (e.g., after they have been modified)
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object (all contexts if None)
+    """
+
+    with _lookups_lock:
+        if context is None:
+            _lookups.clear()
+        else:
+            _lookups.pop(context, None)
+
+
+def get_destination(context: GearToolkitContext) -> Any:
+    """
+    Retrieve the destination container of the gear (looked up once per context)
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object
+
+    Returns
+    -------
+        Flywheel destination container
+    """
+
+    return cached_lookup(
+        context, "destination", lambda: context.client.get(context.destination["id"])
+    )
+
+
+def get_parent(context: GearToolkitContext) -> Any:
+    """
+    Retrieve the parent container of the gear's destination (looked up once per context)
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object
+
+    Returns
+    -------
+        Flywheel container the destination belongs to (e.g., subject)
+    """
+
+    return cached_lookup(
+        context, "parent", lambda: context.client.get(get_destination(context).parent["id"])
+    )
+
+
+def get_project(context: GearToolkitContext) -> flywheel.Project:
+    """
+    Retrieve the project containing the gear's destination (looked up once per context)
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object
+
+    Returns
+    -------
+        Flywheel project
+    """
+
+    return cached_lookup(
+        context,
+        "project",
+        lambda: context.client.get_project(get_destination(context)["parents"]["project"]),
+    )
+
 
 def get_subject(context: GearToolkitContext) -> ContainerSubjectOutput:
     """
@@ -34,8 +165,7 @@ def get_subject(context: GearToolkitContext) -> ContainerSubjectOutput:
         Flywheel subject object
     """
 
-    destination = context.client.get(context.destination["id"])
-    subject = context.client.get(destination.parent["id"])
+    subject = get_parent(context)
 
     log.info(f"Subject {subject.label} retrieved")
 
@@ -61,7 +191,7 @@ def check_run_level(
     """
 
     try:
-        destination = context.client.get(context.destination["id"])
+        destination = get_destination(context)
     except flywheel.ApiException as err:  # pylint: disable=maybe-no-member
         log.error("The destination id does not point to a valid analysis container")
         log.error(f"{err}")
@@ -9,6 +9,8 @@ import os
 from pathlib import Path
 from typing import TYPE_CHECKING
 
+from flywheel_utilities import fly_wrappers
+
 if TYPE_CHECKING:
     import flywheel
     from flywheel_geartoolkit_context import GearToolkitContext
@@ -37,10 +39,7 @@ def install_freesurfer_license(context: GearToolkitContext) -> None:
     fs_path: Path = Path(free_home) / "license.txt"
 
     # Find the license file at the project level
-    client: flywheel.Client = context.client
-    proj_id: str = client.get_analysis(context.destination["id"])["parents"]["project"]
-
-    proj: flywheel.models.project.Project = client.get_project(proj_id)
+    proj: flywheel.Project = fly_wrappers.get_project(context)
 
     if "FREESURFER_LICENSE" in proj["info"]:
         space_separated_text: str = proj["info"]["FREESURFER_LICENSE"]
@@ -0,0 +1,186 @@
+"""
+Lightweight timing and throughput instrumentation.
+Work is measured in spans, each belonging to a phase (e.g., "traversal", "transfer",
+"extraction") and carrying counts of bytes, files and API calls. Completed spans are passed to
+each registered sink. By default, spans are aggregated per phase by the module level RECORDER,
+which basic_logging.log_instrumentation_summary reports at the end of a gear run.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class SpanRecord:
+    """A completed span of work"""
+
+    phase: str
+    seconds: float = 0.0
+    bytes: int = 0
+    files: int = 0
+    api_calls: int = 0
+    labels: dict[str, Any] = field(default_factory=dict)
+
+    # pylint: disable-next=redefined-builtin
+    def add(self, bytes: int = 0, files: int = 0, api_calls: int = 0) -> None:
+        """Add to the counts of the span"""
+
+        self.bytes += bytes
+        self.files += files
+        self.api_calls += api_calls
+
+
+@dataclass
+class PhaseStats:
+    """Totals of all spans of a phase"""
+
+    spans: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+    files: int = 0
+    api_calls: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second"""
+
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+Sink = Callable[[SpanRecord], None]
+
+
+class Recorder:
+    """Thread safe sink aggregating spans per phase"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._phases: dict[str, PhaseStats] = {}
+
+    def __call__(self, record: SpanRecord) -> None:
+        with self._lock:
+            stats: PhaseStats = self._phases.setdefault(record.phase, PhaseStats())
+            stats.spans += 1
+            stats.seconds += record.seconds
+            stats.bytes += record.bytes
+            stats.files += record.files
+            stats.api_calls += record.api_calls
+
+    def summary(self) -> dict[str, PhaseStats]:
+        """Copy of the totals of each phase"""
+
+        with self._lock:
+            return {phase: PhaseStats(**vars(stats)) for phase, stats in self._phases.items()}
+
+    def reset(self) -> None:
+        """Discard all recorded spans"""
+
+        with self._lock:
+            self._phases.clear()
+
+
+RECORDER = Recorder()
+
+_sinks: list[Sink] = [RECORDER]
+
+
+def add_sink(sink: Sink) -> None:
+    """
+    Register a sink to receive each completed span. Registering a sink again has no effect.
+
+    Parameters
+    ----------
+    sink:
+        callable receiving a SpanRecord
+    """
+
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink: Sink) -> None:
+    """
+    Unregister a sink
+
+    Parameters
+    ----------
+    sink:
+        previously registered sink
+    """
+
+    _sinks.remove(sink)
+
+
+def emit(record: SpanRecord) -> None:
+    """
+    Pass a completed span to all sinks. Errors raised by sinks are logged, not raised.
+
+    Parameters
+    ----------
+    record:
+        completed span
+    """
+
+    for sink in list(_sinks):
+        try:
+            sink(record)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            log.debug(f"Instrumentation sink failed: {err}")
+
+
+@contextmanager
+def span(phase: str, **labels: Any) -> Iterator[SpanRecord]:
+    """
+    Time a span of work, emitting it to the sinks once complete (even if an error is raised)
+
+    Parameters
+    ----------
+    phase:
+        name of the phase the work belongs to
+    labels:
+        additional information passed to the sinks (e.g., container id, filename)
+
+    Yields
+    ------
+        span record, to which counts can be added
+    """
+
+    record = SpanRecord(phase, labels=labels)
+    start: float = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        emit(record)
+
+
+def log_span(record: SpanRecord) -> None:
+    """
+    Sink logging each span at debug level, with its measurements as structured fields (see
+    basic_logging.JsonFormatter)
+
+    Parameters
+    ----------
+    record:
+        completed span
+    """
+
+    log.debug(
+        f"{record.phase} took {record.seconds:.3f} s",
+        extra={
+            "phase": record.phase,
+            "elapsed": record.seconds,
+            "bytes": record.bytes,
+            "files": record.files,
+            "api_calls": record.api_calls,
+            "labels": record.labels,
+        },
+    )
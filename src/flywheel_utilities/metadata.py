@@ -9,7 +9,7 @@ from typing import TYPE_CHECKING
 
 import flywheel
 
-from flywheel_utilities import utils
+from flywheel_utilities import retry, utils
 
 if TYPE_CHECKING:
     from flywheel.models.container_subject_output import ContainerSubjectOutput
@@ -35,7 +35,7 @@ def update_subject_tags(context: GearToolkitContext, subject: ContainerSubjectOu
 
     if gear_name not in subject.tags:
         try:
-            context.client.add_subject_tag(subject.id, gear_name)
+            retry.call(context.client.add_subject_tag, subject.id, gear_name)
         except flywheel.rest.ApiException:  # pylint: disable=maybe-no-member
             log.info(f"Subject's already has tag: '{gear_name}'")
 
@@ -0,0 +1,170 @@
+"""
+Persistent on-disk cache of Flywheel container metadata.
+Entries are keyed by container ID and only returned if the container's 'modified' timestamp has
+not changed since the entry was stored. Entries are evicted once older than the time-to-live or
+when the cache grows beyond the maximum number of entries (least recently used first).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator
+
+if TYPE_CHECKING:
+    from flywheel_geartoolkit_context import GearToolkitContext
+
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = ".flywheel_metadata_cache.sqlite"
+
+
+class MetadataCache:
+    """
+    SQLite backed cache of container metadata
+
+    Parameters
+    ----------
+    path:
+        Path to the SQLite database file
+    ttl:
+        time-to-live of an entry in seconds
+    max_entries:
+        maximum number of entries to keep
+    """
+
+    def __init__(self, path: Path, ttl: float = 7 * 24 * 60 * 60, max_entries: int = 10000):
+        self.path: Path = path
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "container_id TEXT PRIMARY KEY, modified TEXT, data TEXT, "
+                "stored REAL, accessed REAL)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection, committing on success and closing it afterwards"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            with conn:
+                yield conn
+
+    def get(self, container_id: str, modified: Any) -> dict[str, Any] | None:
+        """
+        Retrieve the cached metadata of a container
+
+        Parameters
+        ----------
+        container_id:
+            Flywheel container ID
+        modified:
+            current 'modified' timestamp of the container
+
+        Returns
+        -------
+            cached metadata, or None if missing, stale or expired
+        """
+
+        now: float = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT modified, data, stored FROM metadata WHERE container_id = ?",
+                (container_id,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            if row[0] != str(modified) or now - row[2] > self.ttl:
+                log.debug(f"Stale metadata cache entry: {container_id}")
+                conn.execute("DELETE FROM metadata WHERE container_id = ?", (container_id,))
+                return None
+
+            conn.execute(
+                "UPDATE metadata SET accessed = ? WHERE container_id = ?", (now, container_id)
+            )
+
+        data: dict[str, Any] = json.loads(row[1])
+        return data
+
+    def put(self, container_id: str, modified: Any, data: dict[str, Any]) -> None:
+        """
+        Store the metadata of a container, evicting old entries if required
+
+        Parameters
+        ----------
+        container_id:
+            Flywheel container ID
+        modified:
+            current 'modified' timestamp of the container
+        data:
+            JSON serialisable metadata
+        """
+
+        now: float = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                (container_id, str(modified), json.dumps(data, default=str), now, now),
+            )
+        self.evict()
+
+    def invalidate(self, container_id: str | None = None) -> None:
+        """
+        Remove a single container from the cache, or clear the cache if no ID is supplied
+
+        Parameters
+        ----------
+        container_id:
+            Flywheel container ID
+        """
+
+        with self._connect() as conn:
+            if container_id is None:
+                log.debug("Clearing metadata cache")
+                conn.execute("DELETE FROM metadata")
+            else:
+                conn.execute("DELETE FROM metadata WHERE container_id = ?", (container_id,))
+
+    def evict(self) -> None:
+        """Remove expired entries and the least recently used entries above max_entries"""
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM metadata WHERE stored < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM metadata WHERE container_id NOT IN "
+                "(SELECT container_id FROM metadata ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            count: int = conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        return count
+
+
+def open_cache(context: GearToolkitContext, **kwargs: Any) -> MetadataCache:
+    """
+    Open (or create) the metadata cache stored in the gear's working directory
+
+    Parameters
+    ----------
+    context:
+        Flywheel gear context object
+    kwargs:
+        passed to MetadataCache (ttl, max_entries)
+
+    Returns
+    -------
+        metadata cache
+    """
+
+    return MetadataCache(Path(context.work_dir) / CACHE_NAME, **kwargs)
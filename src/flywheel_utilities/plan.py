@@ -0,0 +1,548 @@
+"""
+Plan downloads before making them.
+A plan lists every file a download function would transfer, with its size, type and source
+container, without transferring anything. Plans can be inspected (e.g., to check the disk space
+required before the transfer starts), saved as JSON, and executed later, possibly by another
+process with its own Flywheel client.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import re
+import shutil
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
+
+from flywheel_utilities import (
+    disk_space,
+    download_bids,
+    download_dicoms,
+    download_results,
+    instrumentation,
+    retry,
+    snapshot,
+    transfer,
+)
+
+if TYPE_CHECKING:
+    import flywheel
+    from flywheel.models.container_subject_output import ContainerSubjectOutput
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+# What happens to each file once it has been downloaded
+ACTIONS = (
+    "download",  # nothing further
+    "populate",  # populate the IntendedFor field of the fmap sidecar from the metadata
+    "unzip",  # extract the archive to extract_to
+    "move",  # move the file into the folder extract_to
+    "unzip_result",  # extract the members of the analysis output to extract_to
+)
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class PlannedFile:
+    """A file to be downloaded"""
+
+    name: str
+    destination: str
+    size: int | None = None
+    file_type: str | None = None
+    file_id: str | None = None
+    container_id: str | None = None
+    container_type: str | None = None
+    bids_path: str | None = None
+    action: str = "download"
+    extract_to: str | None = None
+    present: bool = False
+    # Only available in the process that created the plan
+    fw_file: Any = field(default=None, repr=False, compare=False)
+
+    def needs_transfer(self) -> bool:
+        """Is the file (or the series extracted from it) missing from disk?"""
+
+        if Path(self.destination).is_file():
+            return False
+        # Extracted DICOM series are not downloaded again
+        return not (
+            self.action in ("unzip", "move")
+            and self.extract_to is not None
+            and Path(self.extract_to).exists()
+        )
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class DownloadPlan:
+    """Files to be downloaded by one of the download functions"""
+
+    entry_point: str
+    subject_label: str | None = None
+    files: list[PlannedFile] = field(default_factory=list)
+    bids_dir: str | None = None
+    post_populate: list[str] | None = None
+    include: list[str] | None = None
+    exclude: list[str] | None = None
+
+    @property
+    def transfers(self) -> list[PlannedFile]:
+        """Files not yet on disk"""
+
+        return [planned for planned in self.files if not planned.present]
+
+    @property
+    def total_bytes(self) -> int:
+        """Number of bytes to be transferred (files of unknown size are not counted)"""
+
+        return sum(planned.size or 0 for planned in self.transfers)
+
+    def required_bytes(self) -> dict[Path, int]:
+        """
+        Estimated disk space required to execute the plan, by destination directory. Archives to
+        be extracted are assumed to expand by disk_space.ZIP_EXPANSION.
+        """
+
+        required: dict[Path, int] = {}
+        for planned in self.files:
+            if not planned.needs_transfer():
+                continue
+            parent: Path = Path(planned.destination).parent
+            required[parent] = required.get(parent, 0) + (planned.size or 0)
+            if planned.action in ("unzip", "unzip_result") and planned.extract_to is not None:
+                extract_to = Path(planned.extract_to)
+                required[extract_to] = required.get(extract_to, 0) + int(
+                    (planned.size or 0) * disk_space.ZIP_EXPANSION
+                )
+        return required
+
+    def log_summary(self) -> None:
+        """Log the number of files and bytes to be transferred"""
+
+        log.info(
+            f"Plan for {self.entry_point}: {len(self.transfers)} of {len(self.files)} files to "
+            f"download ({self.total_bytes / 1024**2:.1f} MiB)"
+        )
+        unknown: int = sum(planned.size is None for planned in self.transfers)
+        if unknown:
+            log.warning(f"Size of {unknown} files is unknown")
+
+    def to_dict(self) -> dict[str, Any]:
+        """Plan as a JSON serialisable dict"""
+
+        data: dict[str, Any] = {
+            one_field.name: getattr(self, one_field.name)
+            for one_field in fields(self)
+            if one_field.name != "files"
+        }
+        data["files"] = [
+            {
+                one_field.name: getattr(planned, one_field.name)
+                for one_field in fields(planned)
+                if one_field.name != "fw_file"
+            }
+            for planned in self.files
+        ]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> DownloadPlan:
+        """Plan from a dict created by to_dict"""
+
+        return cls(
+            **{key: value for key, value in data.items() if key != "files"},
+            files=[PlannedFile(**planned) for planned in data["files"]],
+        )
+
+    def save(self, path: Path) -> None:
+        """
+        Write the plan to a JSON file
+
+        Parameters
+        ----------
+        path:
+            Path to JSON file
+        """
+
+        with open(path, "w", encoding="utf-8") as out_json:
+            json.dump(self.to_dict(), out_json, indent=2)
+
+    @classmethod
+    def load(cls, path: Path) -> DownloadPlan:
+        """
+        Read a plan from a JSON file
+
+        Parameters
+        ----------
+        path:
+            Path to JSON file
+
+        Returns
+        -------
+            download plan
+        """
+
+        with open(path, "r", encoding="utf-8") as in_json:
+            return cls.from_dict(json.load(in_json))
+
+
+def file_sources(tree: snapshot.SubjectSnapshot) -> dict[int, str]:
+    """Map each file in a snapshot (by object id) to the ID of its acquisition"""
+
+    return {
+        id(scan): acq.id
+        for session in tree.sessions
+        for acq in session.acquisitions
+        for scan in acq.files
+    }
+
+
+# pylint: disable=too-many-arguments
+def planned_file(
+    fw_file: FileEntry,
+    destination: Path,
+    container_id: str | None,
+    container_type: str,
+    *,
+    action: str = "download",
+    bids_path: Path | None = None,
+    extract_to: Path | None = None,
+) -> PlannedFile:
+    """Describe the download of a file"""
+
+    planned = PlannedFile(
+        name=fw_file.name,
+        destination=str(destination),
+        size=getattr(fw_file, "size", None),
+        file_type=getattr(fw_file, "type", None),
+        file_id=getattr(fw_file, "file_id", None),
+        container_id=container_id,
+        container_type=container_type,
+        bids_path=None if bids_path is None else bids_path.as_posix(),
+        action=action,
+        extract_to=None if extract_to is None else str(extract_to),
+        fw_file=fw_file,
+    )
+    planned.present = not planned.needs_transfer()
+    return planned
+
+
+def plan_bids_modalities(
+    subject: snapshot.SubjectLike,
+    modalities: list[str],
+    bids_dir: Path,
+    post_populate: list[str] | None = None,
+) -> DownloadPlan:
+    """
+    Plan the download of the required modalities. See download_bids.download_bids_modalities.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    modalities:
+        list of modalities to download
+    bids_dir:
+        Path to bids directory
+    post_populate:
+        list of modalities to populate the IntendedFor fields with
+
+    Returns
+    -------
+        download plan
+    """
+
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
+    sources: dict[int, str] = file_sources(tree)
+
+    plan = DownloadPlan(
+        "download_bids_modalities",
+        tree.label,
+        bids_dir=str(bids_dir),
+        post_populate=post_populate,
+    )
+    for scan, bids_path in download_bids.select_modality_files(tree, modalities):
+        populate: bool = download_bids.needs_populating(bids_path, post_populate)
+        plan.files.append(
+            planned_file(
+                scan,
+                bids_dir / bids_path,
+                sources.get(id(scan)),
+                "acquisition",
+                action="populate" if populate else "download",
+                bids_path=bids_path,
+            )
+        )
+
+    plan.log_summary()
+    return plan
+
+
+def plan_bids_files(
+    subject: snapshot.SubjectLike, filenames: list[str], bids_dir: Path
+) -> DownloadPlan:
+    """
+    Plan the download of the requested files. See download_bids.download_bids_files.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    filenames:
+        list of partial names to use as regex for downloading required files
+    bids_dir:
+        Path to bids directory
+
+    Returns
+    -------
+        download plan
+    """
+
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
+    sources: dict[int, str] = file_sources(tree)
+
+    plan = DownloadPlan("download_bids_files", tree.label, bids_dir=str(bids_dir))
+    for scan, bids_path in download_bids.select_bids_files(tree, filenames):
+        populate: bool = "fmap" in str(bids_path.parent) and bids_path.name.endswith(".json")
+        plan.files.append(
+            planned_file(
+                scan,
+                bids_dir / bids_path,
+                sources.get(id(scan)),
+                "acquisition",
+                action="populate" if populate else "download",
+                bids_path=bids_path,
+            )
+        )
+
+    plan.log_summary()
+    return plan
+
+
+def plan_all_dicoms(
+    subject: snapshot.SubjectLike, work_dir: Path, to_ignore: list[str], dicom_dir: Path
+) -> DownloadPlan:
+    """
+    Plan the download of all DICOM series. See download_dicoms.download_all_dicoms.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or snapshot
+    work_dir:
+        Path to working directory for download
+    to_ignore:
+        list of strings used to reject DICOMS for download
+    dicom_dir:
+        directory to extract DICOM series to
+
+    Returns
+    -------
+        download plan
+    """
+
+    tree: snapshot.SubjectSnapshot = snapshot.get_snapshot(subject)
+    sources: dict[int, str] = file_sources(tree)
+
+    plan = DownloadPlan("download_all_dicoms", tree.label)
+    for scan in download_dicoms.select_dicom_series(tree, to_ignore):
+        scan_name: str = scan.name.replace(" ", "_")
+        plan.files.append(
+            planned_file(
+                scan,
+                work_dir / scan_name,
+                sources.get(id(scan)),
+                "acquisition",
+                action="unzip" if scan_name.lower().endswith(".zip") else "move",
+                bids_path=download_dicoms.dicom_bids_path(scan),
+                extract_to=dicom_dir / download_dicoms.dicom_unzip_name(scan_name),
+            )
+        )
+
+    plan.log_summary()
+    return plan
+
+
+# pylint: disable=too-many-arguments
+def plan_previous_result(
+    subject: ContainerSubjectOutput,
+    results: dict[str, str],
+    work_dir: Path,
+    export_gear: bool = False,
+    *,
+    client: flywheel.Client | None = None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> DownloadPlan | None:
+    """
+    Plan the download of a previous result. See download_results.download_previous_result.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object
+    results:
+        dict containing gear_name, filename and tag
+    work_dir:
+        Path to work directory
+    export_gear:
+        should export runs be included?
+    client:
+        Flywheel client used to query the subject's analyses
+    include:
+        glob patterns of zip members to extract (all members if None)
+    exclude:
+        glob patterns of zip members not to extract
+
+    Returns
+    -------
+        download plan, or None if no result was found
+    """
+
+    analysis = download_results.find_previous_result(
+        subject, results["gear_name"], results["tag"], export_gear, client=client
+    )
+    if analysis is None:
+        return None
+
+    plan = DownloadPlan("download_previous_result", subject.label, include=include, exclude=exclude)
+    for output in analysis.files:
+        if re.search(results["filename"], output.name):
+            is_zipped: bool = output.name.endswith(".zip")
+            plan.files.append(
+                planned_file(
+                    output,
+                    work_dir / output.name,
+                    analysis.id,
+                    "analysis",
+                    action="unzip_result" if is_zipped else "download",
+                    extract_to=work_dir if is_zipped else None,
+                )
+            )
+            break
+    else:
+        log.error("Could not locate requested file.")
+
+    plan.log_summary()
+    return plan
+
+
+def resolve_file(
+    planned: PlannedFile, client: flywheel.Client | None, containers: dict[str, Any]
+) -> FileEntry:
+    """
+    Retrieve the Flywheel file of a planned download, e.g. for a plan loaded from JSON. Files
+    are matched on their file ID if planned with one, so a file replaced since planning is not
+    downloaded in place of the planned file.
+
+    Parameters
+    ----------
+    planned:
+        planned download
+    client:
+        Flywheel client
+    containers:
+        containers already retrieved, by ID
+
+    Returns
+    -------
+        file on Flywheel
+
+    Raises
+    ------
+    ValueError
+        if the file is not found, or has been replaced since planning
+    """
+
+    if planned.fw_file is not None:
+        return planned.fw_file
+    if client is None or planned.container_id is None:
+        raise ValueError(f"Cannot retrieve {planned.name} without a client and container ID")
+
+    if planned.container_id not in containers:
+        with instrumentation.span("api", container=planned.container_id) as record:
+            containers[planned.container_id] = retry.call(client.get, planned.container_id)
+            record.add(api_calls=1)
+    files: list[FileEntry] = containers[planned.container_id].files
+    if planned.file_id is not None:
+        for fw_file in files:
+            if getattr(fw_file, "file_id", None) == planned.file_id:
+                return fw_file
+
+    for fw_file in files:
+        if fw_file.name == planned.name:
+            if planned.file_id is not None:
+                raise ValueError(
+                    f"{planned.name} in container {planned.container_id} has been replaced since "
+                    f"planning (file ID {getattr(fw_file, 'file_id', None)}, planned "
+                    f"{planned.file_id})"
+                )
+            return fw_file
+
+    raise ValueError(f"{planned.name} not found in container {planned.container_id}")
+
+
+def execute_plan(
+    plan: DownloadPlan, *, client: flywheel.Client | None = None, check_space: bool = True
+) -> None:
+    """
+    Download the files of a plan and perform the follow-up actions (populating sidecars,
+    extracting archives). Files already on disk are skipped.
+
+    Parameters
+    ----------
+    plan:
+        download plan
+    client:
+        Flywheel client, required if the plan was loaded from JSON
+    check_space:
+        check the free disk space before downloading? Raises OSError (errno.ENOSPC) if the
+        estimated space required is not available
+    """
+
+    log.info(f"Executing plan for {plan.entry_point}")
+
+    if check_space:
+        disk_space.check_free_space(plan.required_bytes())
+
+    containers: dict[str, Any] = {}
+    for planned in plan.files:
+        destination = Path(planned.destination)
+        extract_to: Path | None = None if planned.extract_to is None else Path(planned.extract_to)
+
+        downloaded: bool = planned.needs_transfer()
+        if downloaded:
+            fw_file: FileEntry = resolve_file(planned, client, containers)
+            log.info(
+                f"Downloading: {planned.name}",
+                extra=transfer.log_fields(fw_file, planned.container_id),
+            )
+            transfer.download_file(fw_file, destination)
+
+        if planned.action == "populate" and downloaded:
+            download_bids.populate_intended_for(fw_file, destination)
+        elif planned.action == "unzip" and extract_to is not None and not extract_to.exists():
+            with instrumentation.span("extraction", filename=planned.name) as record:
+                unzip_archive(destination, extract_to, False)
+                record.add(files=1)
+        elif planned.action == "move" and extract_to is not None and destination.is_file():
+            extract_to.mkdir(exist_ok=True)
+            shutil.move(str(destination), extract_to / destination.name)
+        elif planned.action == "unzip_result" and extract_to is not None:
+            download_results.unzip_result(
+                destination, extract_to, False, include=plan.include, exclude=plan.exclude
+            )
+
+    if plan.post_populate and plan.bids_dir is not None:
+        download_bids.post_populate_intended_for(
+            Path(plan.bids_dir) / f"sub-{plan.subject_label}", plan.post_populate
+        )
+
+    log.info("Finished executing plan")
@@ -0,0 +1,211 @@
+"""
+Random access to zip files stored on Flywheel using HTTP range requests.
+Only the central directory and the requested members are transferred, so single files can be
+extracted from large archives without downloading the whole archive.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+from types import TracebackType
+from typing import IO, TYPE_CHECKING
+from zipfile import ZipFile, ZipInfo
+
+import requests
+
+from flywheel_utilities import retry, transfer
+
+if TYPE_CHECKING:
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+# Minimum number of bytes requested at a time
+BLOCK_SIZE = 256 * 1024
+
+
+class RangeNotSupportedError(ValueError):
+    """Server does not support HTTP range requests"""
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object reading from a URL using HTTP range requests
+
+    Parameters
+    ----------
+    url:
+        URL of the file
+    size:
+        size of the file in bytes, requested from the server if None
+    """
+
+    def __init__(self, url: str, size: int | None = None):
+        super().__init__()
+        self.url: str = url
+        self.position: int = 0
+        self.requests: int = 0
+        self.bytes_read: int = 0
+        self.size: int = size if size is not None else self.request_size()
+
+    def request_range(self, start: int, end: int) -> requests.Response:
+        """Make a single request for the (inclusive) byte range start-end"""
+
+        self.requests += 1
+        # Streamed, so that the body is not read unless the range is honoured
+        resp = requests.get(
+            self.url,
+            headers={"Range": f"bytes={start}-{end}"},
+            timeout=transfer.TIMEOUT,
+            stream=True,
+        )
+        try:
+            resp.raise_for_status()
+        except requests.HTTPError:
+            resp.close()
+            raise
+
+        return resp
+
+    def get_range(self, start: int, end: int) -> requests.Response:
+        """Request the (inclusive) byte range start-end, checking the range is honoured"""
+
+        resp: requests.Response = self.request_range(start, end)
+        if resp.status_code != 206:
+            # Without range support, the body is the whole file, so is not read
+            resp.close()
+            raise RangeNotSupportedError(f"Range requests not supported by {self.url}")
+
+        return resp
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """Read the (inclusive) byte range start-end"""
+
+        with self.get_range(start, end) as resp:
+            return resp.content
+
+    def request_size(self) -> int:
+        """Retrieve the file size from the Content-Range header of a single byte request"""
+
+        def content_range() -> str:
+            with self.get_range(0, 0) as resp:
+                return resp.headers["Content-Range"]
+
+        return int(retry.call(content_range).rsplit("/", 1)[1])
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if self.position < 0:
+            raise OSError(f"Negative seek position: {self.position}")
+
+        return self.position
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:  # type: ignore[override]
+        size: int = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+
+        # The body is read within the retried call, so that interrupted transfers are retried
+        data: bytes = retry.call(self.read_range, self.position, self.position + size - 1)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        self.bytes_read += len(data)
+
+        return len(data)
+
+
+class RemoteZip:
+    """
+    Zip file on Flywheel, opened on first use. Listing the members only transfers the central
+    directory, and each member is only transferred when it is read or extracted.
+
+    Parameters
+    ----------
+    fw_file:
+        zip file on Flywheel
+    block_size:
+        minimum number of bytes requested at a time
+    """
+
+    def __init__(self, fw_file: FileEntry, block_size: int = BLOCK_SIZE):
+        self.fw_file: FileEntry = fw_file
+        self.block_size: int = block_size
+        self.reader: RangeReader | None = None
+        self._zip: ZipFile | None = None
+
+    def __enter__(self) -> RemoteZip:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @property
+    def zip_file(self) -> ZipFile:
+        """Zip file read via range requests, reading the central directory on first access"""
+
+        if self._zip is None:
+            self.reader = RangeReader(self.fw_file.url(), getattr(self.fw_file, "size", None))
+            # The buffer only holds the reader, which is closed with the archive
+            # pylint: disable-next=consider-using-with
+            self._zip = ZipFile(io.BufferedReader(self.reader, self.block_size))
+            log.debug(f"Read central directory of {self.fw_file.name}")
+
+        return self._zip
+
+    @property
+    def bytes_read(self) -> int:
+        """Number of bytes transferred so far"""
+
+        return 0 if self.reader is None else self.reader.bytes_read
+
+    def infolist(self) -> list[ZipInfo]:
+        """List the members of the archive"""
+
+        return self.zip_file.infolist()
+
+    def namelist(self) -> list[str]:
+        """List the names of the members of the archive"""
+
+        return self.zip_file.namelist()
+
+    def open(self, member: str | ZipInfo) -> IO[bytes]:
+        """Open a member for reading, transferring its data as it is read"""
+
+        return self.zip_file.open(member)
+
+    def extract(self, member: str | ZipInfo, output_dir: str) -> str:
+        """Extract a single member to output_dir, returning the extracted path"""
+
+        return self.zip_file.extract(member, output_dir)
+
+    def close(self) -> None:
+        """Close the archive"""
+
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self.reader is not None:
+            self.reader.close()
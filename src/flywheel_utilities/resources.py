@@ -2,18 +2,261 @@
 Determine and set computing resources.
 """
 
+from __future__ import annotations
+
+import csv
+import json
 import logging
 import os
-from math import floor
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
+from math import ceil, floor
+from pathlib import Path
+from types import TracebackType
 
 import psutil
 
 log = logging.getLogger(__name__)
 
+# Mount point of the cgroup hierarchy (the container's own cgroup inside a cgroup namespace)
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# cgroup v1 reports an unlimited memory limit as a very large number
+UNLIMITED_BYTES = 2**60
+
+
+def read_cgroup_file(path: Path) -> str | None:
+    """
+    Read a cgroup interface file
+
+    Parameters
+    ----------
+    path:
+        Path to cgroup file
+
+    Returns
+    -------
+        stripped contents, or None if the file cannot be read
+    """
+
+    try:
+        return path.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+
+def parse_cpu_list(cpu_list: str) -> int:
+    """
+    Count the CPUs in a cpuset list (e.g., "0-3,8")
+
+    Parameters
+    ----------
+    cpu_list:
+        cpuset list
+
+    Returns
+    -------
+        number of CPUs
+    """
+
+    count: int = 0
+    for part in cpu_list.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            count += int(end) - int(start) + 1
+        elif part:
+            count += 1
+
+    return count
+
+
+def cgroup_cpu_quota(root: Path = CGROUP_ROOT) -> float | None:
+    """
+    Determine the CPU quota from cgroup v2 cpu.max, or cgroup v1 cpu.cfs_quota_us
+
+    Parameters
+    ----------
+    root:
+        Path to the cgroup hierarchy
+
+    Returns
+    -------
+        number of CPUs allowed by the quota, or None if unlimited
+    """
+
+    cpu_max: str | None = read_cgroup_file(root / "cpu.max")
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        return None if quota == "max" else int(quota) / int(period)
+
+    for controller in ("cpu", "cpu,cpuacct"):
+        quota_us: str | None = read_cgroup_file(root / controller / "cpu.cfs_quota_us")
+        period_us: str | None = read_cgroup_file(root / controller / "cpu.cfs_period_us")
+        if quota_us is not None and period_us is not None:
+            return None if int(quota_us) <= 0 else int(quota_us) / int(period_us)
+
+    return None
+
+
+def cgroup_cpuset(root: Path = CGROUP_ROOT) -> int | None:
+    """
+    Determine the number of CPUs in the cgroup's cpuset
+
+    Parameters
+    ----------
+    root:
+        Path to the cgroup hierarchy
+
+    Returns
+    -------
+        number of CPUs, or None if not set
+    """
+
+    for path in (
+        root / "cpuset.cpus.effective",
+        root / "cpuset" / "cpuset.effective_cpus",
+        root / "cpuset" / "cpuset.cpus",
+    ):
+        cpu_list: str | None = read_cgroup_file(path)
+        if cpu_list:
+            return parse_cpu_list(cpu_list)
+
+    return None
+
+
+def available_cpus(root: Path = CGROUP_ROOT) -> tuple[int, str]:
+    """
+    Determine the number of CPUs the process can actually use, taking the smallest of the host
+    CPU count, the scheduler affinity, the cgroup cpuset and the cgroup CPU quota (rounded up).
+
+    Parameters
+    ----------
+    root:
+        Path to the cgroup hierarchy
+
+    Returns
+    -------
+    n_cpus:
+        number of usable CPUs
+    source:
+        which limit determined the number of CPUs
+    """
+
+    host_cpus: int | None = os.cpu_count()
+    assert host_cpus is not None, "Could not determine available CPUs"
+
+    limits: list[tuple[int, str]] = [(host_cpus, "host")]
+    if hasattr(os, "sched_getaffinity"):
+        limits.append((len(os.sched_getaffinity(0)), "sched_getaffinity"))
+    cpuset: int | None = cgroup_cpuset(root)
+    if cpuset is not None:
+        limits.append((cpuset, "cgroup cpuset"))
+    quota: float | None = cgroup_cpu_quota(root)
+    if quota is not None:
+        limits.append((max(1, ceil(quota)), "cgroup CPU quota"))
+
+    return min(limits, key=lambda limit: limit[0])
+
+
+def read_memory_stat(path: Path, key: str) -> int:
+    """
+    Read a value from a cgroup memory.stat file
+
+    Parameters
+    ----------
+    path:
+        Path to memory.stat
+    key:
+        name of the value (e.g., inactive_file)
+
+    Returns
+    -------
+        value, or 0 if not present
+    """
+
+    for line in (read_cgroup_file(path) or "").splitlines():
+        name, _, value = line.partition(" ")
+        if name == key:
+            return int(value)
+
+    return 0
+
+
+def cgroup_memory(root: Path = CGROUP_ROOT) -> tuple[int, int] | None:
+    """
+    Determine the memory limit and current usage from cgroup v2 memory.max, or cgroup v1
+    memory.limit_in_bytes. As for the kubelet and docker stats, inactive page cache is not counted
+    as used, since it is reclaimed before the limit is reached (e.g., after downloading data).
+
+    Parameters
+    ----------
+    root:
+        Path to the cgroup hierarchy
+
+    Returns
+    -------
+        memory limit and usage (working set) in bytes, or None if unlimited
+    """
+
+    for limit_file, usage_file, stat_file, inactive_key in (
+        (root / "memory.max", root / "memory.current", root / "memory.stat", "inactive_file"),
+        (
+            root / "memory" / "memory.limit_in_bytes",
+            root / "memory" / "memory.usage_in_bytes",
+            root / "memory" / "memory.stat",
+            "total_inactive_file",
+        ),
+    ):
+        limit: str | None = read_cgroup_file(limit_file)
+        if limit is None:
+            continue
+        if limit == "max" or int(limit) >= UNLIMITED_BYTES:
+            return None
+        usage: int = int(read_cgroup_file(usage_file) or 0)
+        return int(limit), max(0, usage - read_memory_stat(stat_file, inactive_key))
+
+    return None
+
+
+def available_memory(root: Path = CGROUP_ROOT) -> tuple[float, float, str]:
+    """
+    Determine the total and available memory, restricted by the cgroup memory limit if lower
+    than the host's memory
+
+    Parameters
+    ----------
+    root:
+        Path to the cgroup hierarchy
+
+    Returns
+    -------
+    mem_total:
+        total memory in GiB
+    mem_avail:
+        available memory in GiB
+    source:
+        which limit determined the memory
+    """
+
+    memory = psutil.virtual_memory()
+    mem_total: int = memory.total
+    mem_avail: int = memory.available
+    source: str = "host"
+
+    cgroup: tuple[int, int] | None = cgroup_memory(root)
+    if cgroup is not None and cgroup[0] < mem_total:
+        mem_total = cgroup[0]
+        mem_avail = min(mem_avail, max(0, cgroup[0] - cgroup[1]))
+        source = "cgroup memory limit"
+
+    return mem_total / (1024**3), mem_avail / (1024**3), source
+
 
 def determine_n_cpus(n_cpus: int, omp_threads: int) -> tuple[int, int]:
     """
     Provide the desired number of cpus and threads, and have maximum number allowed returned.
+    The maximum respects the CPU affinity and any cgroup CPU quota or cpuset of the container.
 
     Parameters
     ----------
@@ -30,10 +273,9 @@ def determine_n_cpus(n_cpus: int, omp_threads: int) -> tuple[int, int]:
         allocated number of threads per process
     """
 
-    avail_cpus: int | None = os.cpu_count()
-    assert avail_cpus is not None, "Could not determine available CPUs"
+    avail_cpus, source = available_cpus()
 
-    log.info(f"Available CPUs: {avail_cpus}")
+    log.info(f"Available CPUs: {avail_cpus} (limited by {source})")
 
     if n_cpus:
         if n_cpus > avail_cpus:
@@ -64,6 +306,7 @@ def determine_n_cpus(n_cpus: int, omp_threads: int) -> tuple[int, int]:
 def determine_max_mem(mem_mb: int | float) -> float:
     """
     Provide the desired amount of memory and have the maximum allowed memory usage returned.
+    The maximum respects any cgroup memory limit of the container.
 
     Parameters
     ----------
@@ -76,10 +319,9 @@ def determine_max_mem(mem_mb: int | float) -> float:
         allocated memory (in GiB)
     """
 
-    mem_total: float = psutil.virtual_memory().total / (1024**3)
-    mem_avail: float = psutil.virtual_memory().available / (1024**3)
+    mem_total, mem_avail, source = available_memory()
 
-    log.info(f"Systems memory: {int(mem_total)} GiB")
+    log.info(f"Systems memory: {int(mem_total)} GiB (limited by {source})")
     log.info(f"Available memory: {int(mem_avail)} GiB")
 
     if mem_mb:
@@ -94,3 +336,250 @@ def determine_max_mem(mem_mb: int | float) -> float:
         mem_mb = floor(mem_avail) - 1
 
     return mem_mb
+
+
+def directory_size(path: Path) -> int:
+    """
+    Total size of the files within a directory, ignoring files removed while scanning
+
+    Parameters
+    ----------
+    path:
+        Path to directory
+
+    Returns
+    -------
+        size in bytes
+    """
+
+    total: int = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += directory_size(Path(entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except OSError:
+        pass
+
+    return total
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of a list of values
+
+    Parameters
+    ----------
+    values:
+        values (must not be empty)
+    pct:
+        percentile between 0 and 100
+
+    Returns
+    -------
+        percentile of the values
+    """
+
+    ordered: list[float] = sorted(values)
+    rank: int = max(1, ceil(pct / 100 * len(ordered)))
+
+    return ordered[rank - 1]
+
+
+@dataclass
+class ResourceSample:
+    """Resource usage at a single point in time"""
+
+    time: float
+    cpu_percent: float
+    rss_mb: float
+    disk_mb: float
+    net_sent_mb: float
+    net_recv_mb: float
+
+
+# pylint: disable=too-many-instance-attributes
+class ResourceMonitor:
+    """
+    Background thread sampling the resource usage of this process and its children: CPU usage,
+    resident memory, disk usage of the work directory, and network traffic since the monitor was
+    started. On exit, a summary is logged and the time series optionally written to a CSV or JSON
+    file (depending on the suffix of output).
+
+    Parameters
+    ----------
+    work_dir:
+        Path to directory whose disk usage is monitored (not monitored if None)
+    interval:
+        seconds between samples
+    output:
+        Path to write the time series and summary to
+    """
+
+    def __init__(
+        self, work_dir: Path | None = None, interval: float = 5.0, output: Path | None = None
+    ):
+        self.work_dir: Path | None = work_dir
+        self.interval: float = interval
+        self.output: Path | None = output
+        self.samples: list[ResourceSample] = []
+
+        self._process = psutil.Process()
+        self._processes: dict[int, psutil.Process] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._start_time: float = 0.0
+        self._start_net: tuple[int, int] = (0, 0)
+
+    def __enter__(self) -> ResourceMonitor:
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.stop()
+        self.log_summary()
+        if self.output is not None:
+            self.write(self.output)
+
+    def start(self) -> None:
+        """Start sampling in a background thread"""
+
+        net = psutil.net_io_counters()
+        self._start_net = (net.bytes_sent, net.bytes_recv)
+        self._start_time = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="resource-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling, taking a final sample"""
+
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.samples.append(self.sample())
+
+    def _run(self) -> None:
+        """Take samples until stopped"""
+
+        while True:
+            self.samples.append(self.sample())
+            if self._stop.wait(self.interval):
+                return
+
+    def _process_usage(self) -> tuple[float, float]:
+        """CPU usage (percent of a single CPU) and resident memory (bytes) of the process tree"""
+
+        try:
+            current: list[psutil.Process] = [self._process] + self._process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            current = [self._process]
+
+        cpu: float = 0.0
+        rss: float = 0.0
+        processes: dict[int, psutil.Process] = {}
+        for proc in current:
+            # Reuse process objects so CPU usage is measured since the previous sample
+            proc = self._processes.get(proc.pid, proc)
+            try:
+                cpu += proc.cpu_percent()
+                rss += proc.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            processes[proc.pid] = proc
+        self._processes = processes
+
+        return cpu, rss
+
+    def sample(self) -> ResourceSample:
+        """Measure the current resource usage"""
+
+        cpu, rss = self._process_usage()
+        disk: int = directory_size(self.work_dir) if self.work_dir is not None else 0
+        net = psutil.net_io_counters()
+
+        return ResourceSample(
+            time=time.monotonic() - self._start_time,
+            cpu_percent=cpu,
+            rss_mb=rss / 1024**2,
+            disk_mb=disk / 1024**2,
+            net_sent_mb=(net.bytes_sent - self._start_net[0]) / 1024**2,
+            net_recv_mb=(net.bytes_recv - self._start_net[1]) / 1024**2,
+        )
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        Summarise the samples
+
+        Returns
+        -------
+            peak, mean, median and 95th percentile of each measurement
+        """
+
+        summary: dict[str, dict[str, float]] = {}
+        if not self.samples:
+            return summary
+
+        for field in fields(ResourceSample):
+            if field.name == "time":
+                continue
+            values: list[float] = [getattr(sample, field.name) for sample in self.samples]
+            summary[field.name] = {
+                "peak": max(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+            }
+
+        return summary
+
+    def log_summary(self) -> None:
+        """Log the summary of the samples"""
+
+        summary: dict[str, dict[str, float]] = self.summary()
+        if not summary:
+            return
+
+        log.info(f"Resource usage over {self.samples[-1].time:.1f} s ({len(self.samples)} samples)")
+        for name, stats in summary.items():
+            log.info(
+                f"  {name}: peak={stats['peak']:.1f} mean={stats['mean']:.1f} "
+                f"p50={stats['p50']:.1f} p95={stats['p95']:.1f}"
+            )
+
+    def write(self, output: Path) -> None:
+        """
+        Write the time series to a CSV file, or the time series and summary to a JSON file
+
+        Parameters
+        ----------
+        output:
+            Path to output file (.csv or .json)
+        """
+
+        rows: list[dict[str, float]] = [asdict(sample) for sample in self.samples]
+
+        if output.suffix == ".csv":
+            with open(output, "w", encoding="utf-8", newline="") as out_csv:
+                writer = csv.DictWriter(
+                    out_csv, fieldnames=[field.name for field in fields(ResourceSample)]
+                )
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(output, "w", encoding="utf-8") as out_json:
+                json.dump({"summary": self.summary(), "samples": rows}, out_json, indent=2)
+
+        log.info(f"Resource usage written to: {output}")
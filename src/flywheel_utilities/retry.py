@@ -0,0 +1,245 @@
+"""
+Shared retry and rate limiting policy for requests to Flywheel.
+Calls made through retry.call are rate limited by a token bucket shared by all threads, and
+retried on transient errors (connection errors, HTTP 429 and 5xx) with exponential backoff and
+full jitter, waiting for the duration given by the server's Retry-After header if present.
+The Flywheel SDK itself retries some statuses a few times; this policy additionally covers
+server errors, interrupted transfers and the requests made directly to file URLs.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+import flywheel
+import requests
+
+from flywheel_utilities import instrumentation
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+# pylint: disable=too-few-public-methods
+class TokenBucket:
+    """
+    Thread safe token bucket allowing rate requests per second on average, in bursts of up to
+    burst requests
+
+    Parameters
+    ----------
+    rate:
+        requests per second
+    burst:
+        maximum number of requests made at once
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate: float = rate
+        self.burst: int = burst
+        self._tokens: float = float(burst)
+        self._updated: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Take a token, waiting until one is available
+
+        Returns
+        -------
+            seconds waited
+        """
+
+        with self._lock:
+            now: float = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens are taken in order, so a negative balance is the queue of waiting requests
+            self._tokens -= 1
+            wait: float = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def transient_status(err: BaseException) -> tuple[bool, float | None]:
+    """
+    Check if an error is transient, i.e., the request may succeed if retried
+
+    Parameters
+    ----------
+    err:
+        error raised by the request
+
+    Returns
+    -------
+        is the error transient, and the delay requested by the server (Retry-After) if any
+    """
+
+    status: int | None = None
+    headers: Any = None
+    if isinstance(err, flywheel.ApiException):  # pylint: disable=maybe-no-member
+        status, headers = err.status, err.headers
+    elif isinstance(err, requests.HTTPError) and err.response is not None:
+        status, headers = err.response.status_code, err.response.headers
+    elif isinstance(
+        err,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ConnectionError,
+        ),
+    ):
+        return True, None
+
+    if status not in TRANSIENT_STATUSES:
+        return False, None
+
+    retry_after: float | None = None
+    try:
+        retry_after = float(headers["Retry-After"]) if headers else None
+    except (KeyError, TypeError, ValueError):
+        # Retry-After may also be an HTTP date, in which case the backoff is used instead
+        pass
+
+    return True, retry_after
+
+
+class RetryPolicy:
+    """
+    Retry and rate limiting policy
+
+    Parameters
+    ----------
+    max_attempts:
+        maximum number of attempts of each call
+    base_delay:
+        delay in seconds before the first retry, doubled for each further retry
+    max_delay:
+        maximum delay in seconds between attempts (including those requested via Retry-After)
+    rate:
+        maximum number of requests per second across all threads (unlimited if None)
+    burst:
+        maximum number of requests made at once when rate limited
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        rate: float | None = None,
+        burst: int = 10,
+    ):
+        self.max_attempts: int = max_attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.bucket: TokenBucket | None = TokenBucket(rate, burst) if rate else None
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """
+        Delay before the next attempt
+
+        Parameters
+        ----------
+        attempt:
+            number of attempts made so far
+        retry_after:
+            delay requested by the server
+
+        Returns
+        -------
+            delay in seconds
+        """
+
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Full jitter spreads out the retries of concurrent requests
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Call func(*args, **kwargs), retrying on transient errors
+
+        Parameters
+        ----------
+        func:
+            function making a request to Flywheel
+        args, kwargs:
+            arguments passed to func
+
+        Returns
+        -------
+            return value of func
+        """
+
+        attempt: int = 0
+        while True:
+            attempt += 1
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                transient, retry_after = transient_status(err)
+                if not transient or attempt >= self.max_attempts:
+                    raise
+                delay: float = self.backoff(attempt, retry_after)
+                log.warning(
+                    f"Request failed ({type(err).__name__}: {err}), retrying in {delay:.1f} s "
+                    f"(attempt {attempt}/{self.max_attempts})"
+                )
+                with instrumentation.span("retry_wait", error=type(err).__name__):
+                    time.sleep(delay)
+
+
+_policy: RetryPolicy = RetryPolicy()  # pylint: disable=invalid-name
+
+
+def set_policy(policy: RetryPolicy) -> None:
+    """
+    Set the policy used by retry.call, e.g. to rate limit requests
+
+    Parameters
+    ----------
+    policy:
+        retry and rate limiting policy
+    """
+
+    global _policy  # pylint: disable=global-statement
+    _policy = policy
+
+
+def get_policy() -> RetryPolicy:
+    """Policy used by retry.call"""
+
+    return _policy
+
+
+def call(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Call func(*args, **kwargs) under the shared retry and rate limiting policy
+
+    Parameters
+    ----------
+    func:
+        function making a request to Flywheel
+    args, kwargs:
+        arguments passed to func
+
+    Returns
+    -------
+        return value of func
+    """
+
+    return _policy.call(func, *args, **kwargs)
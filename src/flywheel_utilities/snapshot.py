@@ -0,0 +1,223 @@
+"""
+Take a single-pass snapshot of a subject's session, acquisition and file metadata on Flywheel.
+The snapshot can be passed to any of the download functions in place of the Flywheel subject
+object, so that the metadata is only retrieved from Flywheel once.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Union
+
+from flywheel_utilities import instrumentation, retry
+
+if TYPE_CHECKING:
+    from flywheel.models.container_acquisition_output import ContainerAcquisitionOutput
+    from flywheel.models.container_subject_output import ContainerSubjectOutput
+    from flywheel.models.file_entry import FileEntry
+
+    from flywheel_utilities.metadata_cache import MetadataCache
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class AcquisitionSnapshot:
+    """Metadata of a single acquisition, including the metadata of all its files"""
+
+    id: str
+    label: str
+    info: dict[str, Any]
+    files: list[FileEntry] = field(default_factory=list)
+
+    def is_ignored(self) -> bool:
+        """Has the BIDS ignore field been set at the acquisition level?"""
+        return "BIDS" in self.info and self.info["BIDS"]["ignore"] is True
+
+
+@dataclass
+class SessionSnapshot:
+    """Metadata of a single session and its acquisitions"""
+
+    id: str
+    label: str
+    acquisitions: list[AcquisitionSnapshot] = field(default_factory=list)
+
+
+@dataclass
+class SubjectSnapshot:
+    """Metadata of a subject and its sessions"""
+
+    id: str
+    label: str
+    sessions: list[SessionSnapshot] = field(default_factory=list)
+
+
+# Either a live Flywheel subject or a snapshot of one
+SubjectLike = Union["ContainerSubjectOutput", SubjectSnapshot]
+
+
+def _load_cached(acq: ContainerAcquisitionOutput, cache: MetadataCache) -> list[FileEntry] | None:
+    """
+    Restore the file metadata of a listed acquisition from the cache.
+
+    Parameters
+    ----------
+    acq:
+        acquisition as returned by the Flywheel listing endpoint
+    cache:
+        metadata cache
+
+    Returns
+    -------
+        files with their info restored, or None if the cache is missing or stale
+    """
+
+    cached = cache.get(acq.id, acq.modified)
+    if cached is None:
+        return None
+
+    files: list[FileEntry] = list(acq.files or [])
+    for scan in files:
+        entry = cached["files"].get(scan.name)
+        if entry is None or entry["modified"] != str(scan.modified):
+            return None
+
+    for scan in files:
+        scan.info = cached["files"][scan.name]["info"]
+
+    return files
+
+
+def _store_cached(acq: ContainerAcquisitionOutput, cache: MetadataCache) -> None:
+    """
+    Store the file metadata of a reloaded acquisition in the cache.
+
+    Parameters
+    ----------
+    acq:
+        reloaded acquisition
+    cache:
+        metadata cache
+    """
+
+    files = {
+        scan.name: {"modified": str(scan.modified), "info": scan.info or {}}
+        for scan in acq.files or []
+    }
+    cache.put(acq.id, acq.modified, {"files": files})
+
+
+def snapshot_acquisition(
+    acq: ContainerAcquisitionOutput, cache: MetadataCache | None = None
+) -> tuple[AcquisitionSnapshot, str]:
+    """
+    Retrieve the file metadata of a single acquisition. Acquisitions with the BIDS ignore field
+    set are not reloaded, and acquisitions unchanged since they were cached are restored from the
+    cache.
+
+    Parameters
+    ----------
+    acq:
+        acquisition as returned by the listing endpoint
+    cache:
+        metadata cache used to avoid reloading unchanged acquisitions
+
+    Returns
+    -------
+    acq_snapshot:
+        snapshot of the acquisition
+    source:
+        how the file metadata was obtained ("ignored", "cached" or "reloaded")
+    """
+
+    acq_snapshot = AcquisitionSnapshot(id=acq.id, label=acq.label, info=acq.info or {})
+    if acq_snapshot.is_ignored():
+        return acq_snapshot, "ignored"
+
+    if cache is not None:
+        files: list[FileEntry] | None = _load_cached(acq, cache)
+        if files is not None:
+            acq_snapshot.files = files
+            return acq_snapshot, "cached"
+
+    full_acq = retry.call(acq.reload)
+    acq_snapshot.info = full_acq.info or {}
+    acq_snapshot.files = list(full_acq.files or [])
+    if cache is not None:
+        _store_cached(full_acq, cache)
+
+    return acq_snapshot, "reloaded"
+
+
+def take_snapshot(
+    subject: ContainerSubjectOutput, cache: MetadataCache | None = None
+) -> SubjectSnapshot:
+    """
+    Retrieve the session, acquisition and file metadata for a subject. Each session is listed
+    once, and each acquisition is reloaded exactly once to retrieve the full file metadata (the
+    Flywheel listing endpoints do not include the file info). Acquisitions with the BIDS ignore
+    field set are not reloaded, as none of their files will be downloaded. If a metadata cache is
+    supplied, acquisitions which have not been modified since they were cached are not reloaded.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object
+    cache:
+        metadata cache used to avoid reloading unchanged acquisitions
+
+    Returns
+    -------
+        snapshot of the subject's hierarchy
+    """
+
+    log.info(f"Retrieving metadata for subject: {subject.label}")
+
+    snapshot = SubjectSnapshot(id=subject.id, label=subject.label)
+
+    num_acqs: int = 0
+    num_cached: int = 0
+    with instrumentation.span("traversal", subject=subject.id) as record:
+        record.add(api_calls=1)
+        for session in retry.call(subject.sessions):
+            session_snapshot = SessionSnapshot(id=session.id, label=session.label)
+            record.add(api_calls=1)
+            for acq in retry.call(session.acquisitions):
+                num_acqs += 1
+                acq_snapshot, source = snapshot_acquisition(acq, cache)
+                session_snapshot.acquisitions.append(acq_snapshot)
+                if source == "cached":
+                    num_cached += 1
+                record.add(files=len(acq_snapshot.files), api_calls=int(source == "reloaded"))
+            snapshot.sessions.append(session_snapshot)
+
+    log.debug(f"Snapshot contains {len(snapshot.sessions)} sessions and {num_acqs} acquisitions")
+    if cache is not None:
+        log.debug(f"Metadata of {num_cached} acquisitions restored from cache")
+
+    return snapshot
+
+
+def get_snapshot(subject: SubjectLike, cache: MetadataCache | None = None) -> SubjectSnapshot:
+    """
+    Return the snapshot of a subject, retrieving it from Flywheel if a live subject is supplied.
+
+    Parameters
+    ----------
+    subject:
+        Flywheel subject object or existing snapshot
+    cache:
+        metadata cache used when retrieving the snapshot
+
+    Returns
+    -------
+        snapshot of the subject's hierarchy
+    """
+
+    if isinstance(subject, SubjectSnapshot):
+        return subject
+
+    return take_snapshot(subject, cache)
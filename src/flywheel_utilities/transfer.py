@@ -0,0 +1,323 @@
+"""
+Resumable, atomic file downloads from Flywheel.
+Files are downloaded into a temporary '.part' file next to the destination, verified against the
+size and hash stored in the Flywheel metadata, and only then renamed to the destination. An
+interrupted download leaves only the '.part' file behind, which is resumed on the next attempt.
+If a file store has been set with use_file_store, files are taken from the store when available
+and verified downloads are added to it. Requests are retried on transient errors (see retry.py),
+resuming from the last byte received.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator
+
+import requests
+
+from flywheel_utilities import file_store, instrumentation, retry
+
+if TYPE_CHECKING:
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+# Set with use_file_store
+_file_store: file_store.FileStore | None = None  # pylint: disable=invalid-name
+
+
+def use_file_store(store: file_store.FileStore | None) -> None:
+    """
+    Set the file store used by download_file. Downloaded files are hardlinked to the stored files
+    where possible, which are read-only: files must be replaced (e.g., write to a temporary file
+    and os.replace it) rather than modified in place, which raises PermissionError.
+
+    Parameters
+    ----------
+    store:
+        file store shared across gear runs, or None to stop using a store
+    """
+
+    global _file_store  # pylint: disable=global-statement
+    _file_store = store
+
+
+def log_fields(fw_file: FileEntry, container_id: str | None = None) -> dict[str, Any]:
+    """
+    Structured fields describing a file, to pass to log records via 'extra' (see
+    basic_logging.JsonFormatter)
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+    container_id:
+        ID of the file's container (taken from the file's parent reference if None)
+
+    Returns
+    -------
+        container ID, file name and size of the file
+    """
+
+    if container_id is None:
+        parent_ref: dict[str, Any] = getattr(fw_file, "parent_ref", None) or {}
+        container_id = parent_ref.get("id")
+
+    # 'filename' is reserved for the source file of the log record
+    return {
+        "container_id": container_id,
+        "file_name": fw_file.name,
+        "bytes": getattr(fw_file, "size", None),
+    }
+
+
+def part_name(download_name: Path) -> Path:
+    """
+    Construct name of the temporary file used while downloading
+
+    Parameters
+    ----------
+    download_name:
+        final Path of the download
+
+    Returns
+    -------
+        Path of the partial download
+    """
+
+    return download_name.with_name(download_name.name + PART_SUFFIX)
+
+
+def file_hash(path: Path, algorithm: str) -> str:
+    """
+    Compute the hex digest of a file
+
+    Parameters
+    ----------
+    path:
+        Path to file
+    algorithm:
+        name of hashlib algorithm
+
+    Returns
+    -------
+        hex digest
+    """
+
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def verify_file(fw_file: FileEntry, path: Path) -> bool:
+    """
+    Check the size and hash of a downloaded file against the Flywheel metadata. Checks are skipped
+    if the metadata is not available, or the hash is in an unrecognised format.
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+    path:
+        Path to downloaded file
+
+    Returns
+    -------
+        does the file match the metadata?
+    """
+
+    size: int | None = getattr(fw_file, "size", None)
+    if size is not None and path.stat().st_size != size:
+        log.warning(f"Size mismatch for {path.name}: {path.stat().st_size} != {size}")
+        return False
+
+    # Flywheel hashes are formatted as v0-<algorithm>-<hexdigest>
+    fw_hash: str | None = getattr(fw_file, "hash", None)
+    if not fw_hash:
+        return True
+    parts: list[str] = fw_hash.split("-")
+    if len(parts) != 3 or parts[0] != "v0" or parts[1] not in hashlib.algorithms_available:
+        log.debug(f"Unrecognised hash format, skipping hash check: {fw_hash}")
+        return True
+
+    if file_hash(path, parts[1]) != parts[2]:
+        log.warning(f"Hash mismatch for {path.name}")
+        return False
+
+    return True
+
+
+def iter_chunks(fw_file: FileEntry) -> Iterator[bytes]:
+    """
+    Stream the contents of a file from Flywheel without writing it to disk. If the transfer is
+    interrupted by a transient error, it is resumed from the last byte received (with a range
+    request), retrying under the shared retry policy.
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+
+    Yields
+    ------
+        chunks of the file contents
+    """
+
+    url: str = retry.call(fw_file.url)
+    policy: retry.RetryPolicy = retry.get_policy()
+    offset: int = 0
+    attempt: int = 0
+    while True:
+        with retry.call(open_stream, url, offset) as resp:
+            # Without range support, the bytes already received are sent again
+            skip: int = offset if resp.status_code != 206 else 0
+            try:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    if skip:
+                        chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                        if not chunk:
+                            continue
+                    offset += len(chunk)
+                    yield chunk
+                return
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                attempt += 1
+                if not retry.transient_status(err)[0] or attempt >= policy.max_attempts:
+                    raise
+                delay: float = policy.backoff(attempt)
+                error: str = type(err).__name__
+                log.warning(
+                    f"Transfer of {fw_file.name} interrupted ({error}: {err}), resuming from byte "
+                    f"{offset} in {delay:.1f} s (attempt {attempt}/{policy.max_attempts})"
+                )
+        with instrumentation.span("retry_wait", error=error):
+            time.sleep(delay)
+
+
+def open_stream(url: str, offset: int = 0) -> requests.Response:
+    """
+    Request a URL, streaming the response
+
+    Parameters
+    ----------
+    url:
+        URL of the file
+    offset:
+        byte to start from (using a range request, which the server may not support)
+
+    Returns
+    -------
+        response, with the content not yet read
+    """
+
+    headers: dict[str, str] = {"Range": f"bytes={offset}-"} if offset else {}
+    resp = requests.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+    try:
+        resp.raise_for_status()
+    except requests.HTTPError:
+        resp.close()
+        raise
+
+    return resp
+
+
+def resume_download(fw_file: FileEntry, part: Path) -> None:
+    """
+    Resume a partial download using an HTTP range request. If the server does not support range
+    requests, the file is downloaded from the start. If the range starts at the end of the file
+    (HTTP 416), the partial download is already complete, and is left to be verified.
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+    part:
+        Path to partial download
+    """
+
+    offset: int = part.stat().st_size
+    log.info(f"Resuming download of {fw_file.name} from byte {offset}")
+
+    with requests.get(
+        fw_file.url(), headers={"Range": f"bytes={offset}-"}, stream=True, timeout=TIMEOUT
+    ) as resp:
+        if resp.status_code == 416:
+            log.debug(f"Partial download of {fw_file.name} is already complete")
+            return
+        resp.raise_for_status()
+        mode: str = "ab"
+        if resp.status_code != 206:
+            log.debug("Range requests not supported, restarting download")
+            mode = "wb"
+        with open(part, mode) as out_file:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                out_file.write(chunk)
+
+
+def fetch_part(fw_file: FileEntry, part: Path) -> None:
+    """
+    Download a file into part, resuming a previous partial download if present
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+    part:
+        Path to partial download
+    """
+
+    size: int | None = getattr(fw_file, "size", None)
+    if part.is_file() and part.stat().st_size > 0:
+        if size is None or part.stat().st_size < size:
+            resume_download(fw_file, part)
+    else:
+        fw_file.download(part)
+
+
+def download_file(fw_file: FileEntry, download_name: Path) -> None:
+    """
+    Download a file into a temporary '.part' file, resuming any previous partial download,
+    verify it against the Flywheel metadata, and atomically move it to download_name. If a file
+    store is in use, the file is taken from the store if present, and otherwise added to it.
+
+    Parameters
+    ----------
+    fw_file:
+        file on Flywheel
+    download_name:
+        Path to save the file to
+    """
+
+    store: file_store.FileStore | None = _file_store
+    if store is not None and store.fetch(fw_file, download_name):
+        return
+
+    part: Path = part_name(download_name)
+
+    with instrumentation.span("transfer", filename=fw_file.name) as record:
+        # An interrupted attempt leaves a partial download, which the next attempt resumes
+        retry.call(fetch_part, fw_file, part)
+        record.add(bytes=part.stat().st_size, files=1)
+
+    with instrumentation.span("verification", filename=fw_file.name) as record:
+        if not verify_file(fw_file, part):
+            part.unlink()
+            raise OSError(f"Downloaded file does not match Flywheel metadata: {fw_file.name}")
+        record.add(bytes=part.stat().st_size, files=1)
+
+    os.replace(part, download_name)
+
+    if store is not None:
+        store.add(fw_file, download_name)
@@ -5,7 +5,9 @@ General functions.
 from __future__ import annotations
 
 import logging
-from typing import TYPE_CHECKING
+import re
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, TypeVar
 
 if TYPE_CHECKING:
     from flywheel_geartoolkit_context import GearToolkitContext
@@ -13,6 +15,11 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Back references and conditionals, which would refer to the renumbered groups of combined patterns
+GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
 
 def get_gear_name(context: GearToolkitContext) -> str:
     """
@@ -58,3 +65,108 @@ def zip_save_name(identifier: str, sub_label: str, dest_id: str) -> str:
     save_name += sub_label + "_" + dest_id
 
     return save_name + ".zip"
+
+
+class PatternMatcher:
+    """
+    Match names against a list of regex patterns using a single precompiled regex. Each pattern is
+    wrapped in a lookahead with its own named group, so the reported pattern is the first pattern
+    in the list that would be found by re.search(). Patterns which cannot be combined (e.g., with
+    global flags such as (?i), named groups repeated across patterns, or back references to groups,
+    which are renumbered when combined) are compiled individually instead, and searched in order.
+
+    Parameters
+    ----------
+    patterns:
+        list of regex patterns
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns: list[str] = list(patterns)
+        self.matched: set[int] = set()
+
+        self.regex: re.Pattern[str] | None = None
+        self.compiled: list[re.Pattern[str]] = []
+
+        if self.patterns:
+            combined: str = "|".join(
+                f"(?=.*?(?P<_pattern{i}>{pattern}))" for i, pattern in enumerate(self.patterns)
+            )
+        else:
+            combined = "(?!)"
+
+        if any(GROUP_REFERENCE.search(pattern) for pattern in self.patterns):
+            log.debug("Patterns refer to their groups, searching them individually")
+            self.compiled = [re.compile(pattern) for pattern in self.patterns]
+            return
+
+        try:
+            self.regex = re.compile(combined, re.DOTALL)
+        except re.error as err:
+            log.debug(f"Cannot combine patterns ({err}), searching them individually")
+            self.compiled = [re.compile(pattern) for pattern in self.patterns]
+
+    def search(self, name: str) -> str | None:
+        """
+        Find the first pattern found within name
+
+        Parameters
+        ----------
+        name:
+            name to search
+
+        Returns
+        -------
+            matching pattern, or None if no patterns match
+        """
+
+        index: int
+        if self.regex is None:
+            for index, regex in enumerate(self.compiled):
+                if regex.search(name):
+                    break
+            else:
+                return None
+        else:
+            result: re.Match[str] | None = self.regex.match(name)
+            if result is None or result.lastgroup is None:
+                return None
+
+            # Groups within a pattern close before the enclosing named group
+            index = int(result.lastgroup[len("_pattern") :])
+        self.matched.add(index)
+
+        return self.patterns[index]
+
+    def unmatched(self) -> list[str]:
+        """
+        List the patterns which have not matched any names so far
+
+        Returns
+        -------
+            unmatched patterns
+        """
+
+        return [pattern for i, pattern in enumerate(self.patterns) if i not in self.matched]
+
+
+def pop_completed(pending: dict[Future[Any], T]) -> list[T]:
+    """
+    Remove the completed futures from pending, raising the first error encountered
+
+    Parameters
+    ----------
+    pending:
+        dict of futures and the items they were submitted for
+
+    Returns
+    -------
+        items of the completed futures
+    """
+
+    completed: list[T] = []
+    for future in [future for future in pending if future.done()]:
+        future.result()
+        completed.append(pending.pop(future))
+
+    return completed
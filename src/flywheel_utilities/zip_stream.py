@@ -0,0 +1,342 @@
+"""
+Extract zip archives while they are being downloaded, without writing the archive to disk.
+The archive is parsed sequentially using the local file headers, so only stored and deflated
+members are supported. Stored members of unknown size (written with a data descriptor) and
+encrypted members cannot be streamed, in which case an UnsupportedZipError is raised.
+"""
+
+from __future__ import annotations
+
+import logging
+import shutil
+import struct
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Iterable, Iterator
+
+from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
+
+from flywheel_utilities import instrumentation, transfer
+
+if TYPE_CHECKING:
+    from flywheel.models.file_entry import FileEntry
+
+
+log = logging.getLogger(__name__)
+
+LOCAL_HEADER_SIG = b"PK\x03\x04"
+CENTRAL_DIR_SIG = b"PK\x01\x02"
+END_CENTRAL_DIR_SIG = b"PK\x05\x06"
+DATA_DESCRIPTOR_SIG = b"PK\x07\x08"
+ZIP64_EXTRA_ID = 0x0001
+
+STORED = 0
+DEFLATED = 8
+
+
+class UnsupportedZipError(ValueError):
+    """Archive cannot be extracted while streaming"""
+
+
+class ChunkReader:
+    """
+    Buffered reader over an iterable of byte chunks
+
+    Parameters
+    ----------
+    chunks:
+        iterable of byte chunks
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._buffer: bytearray = bytearray()
+
+    def read_some(self, max_size: int = -1) -> bytes:
+        """Read up to max_size bytes (any size if negative), returning b"" once exhausted"""
+
+        if not self._buffer:
+            for chunk in self._chunks:
+                if chunk:
+                    self._buffer.extend(chunk)
+                    break
+
+        size: int = len(self._buffer) if max_size < 0 else min(max_size, len(self._buffer))
+        data: bytes = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+    def read(self, size: int) -> bytes:
+        """Read exactly size bytes"""
+
+        data = bytearray()
+        while len(data) < size:
+            chunk: bytes = self.read_some(size - len(data))
+            if not chunk:
+                raise EOFError("Unexpected end of zip stream")
+            data.extend(chunk)
+
+        return bytes(data)
+
+    def unread(self, data: bytes) -> None:
+        """Return data to the front of the buffer"""
+
+        self._buffer[:0] = data
+
+
+def member_path(output_dir: Path, name: str) -> Path:
+    """
+    Construct the extraction path of a member, guarding against paths outside output_dir
+
+    Parameters
+    ----------
+    output_dir:
+        Path to extract to
+    name:
+        name of member in zip
+
+    Returns
+    -------
+        Path to extract member to
+    """
+
+    target: Path = (output_dir / name).resolve()
+    if output_dir.resolve() not in target.parents and target != output_dir.resolve():
+        raise UnsupportedZipError(f"Zip member outside of extraction directory: {name}")
+
+    return target
+
+
+def zip64_sizes(extra: bytes, comp_size: int, uncomp_size: int) -> tuple[int, int, bool]:
+    """
+    Retrieve the member sizes from the zip64 extra field, if present
+
+    Parameters
+    ----------
+    extra:
+        extra field of the local file header
+    comp_size:
+        compressed size from the local file header
+    uncomp_size:
+        uncompressed size from the local file header
+
+    Returns
+    -------
+        compressed size, uncompressed size and whether the member uses zip64
+    """
+
+    pos: int = 0
+    while pos + 4 <= len(extra):
+        header_id, length = struct.unpack("<HH", extra[pos : pos + 4])
+        if header_id == ZIP64_EXTRA_ID:
+            data: bytes = extra[pos + 4 : pos + 4 + length]
+            if len(data) >= 16:
+                uncomp_size, comp_size = struct.unpack("<QQ", data[:16])
+            return comp_size, uncomp_size, True
+        pos += 4 + length
+
+    return comp_size, uncomp_size, False
+
+
+def copy_member(reader: ChunkReader, out_file: BinaryIO, method: int, comp_size: int | None) -> int:
+    """
+    Write a single member's data to out_file
+
+    Parameters
+    ----------
+    reader:
+        reader positioned at the start of the member's data
+    out_file:
+        file to write uncompressed data to
+    method:
+        compression method
+    comp_size:
+        compressed size, or None if not known in advance
+
+    Returns
+    -------
+        CRC-32 of the uncompressed data
+    """
+
+    crc: int = 0
+
+    if method == STORED:
+        if comp_size is None:
+            raise UnsupportedZipError("Stored zip member of unknown size")
+        remaining: int = comp_size
+        while remaining:
+            data: bytes = reader.read_some(remaining)
+            if not data:
+                raise EOFError("Unexpected end of zip stream")
+            remaining -= len(data)
+            crc = zlib.crc32(data, crc)
+            out_file.write(data)
+        return crc
+
+    decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+    remaining = -1 if comp_size is None else comp_size
+    while not decomp.eof and remaining != 0:
+        data = reader.read_some(remaining)
+        if not data:
+            raise EOFError("Unexpected end of zip stream")
+        if remaining > 0:
+            remaining -= len(data)
+        uncompressed: bytes = decomp.decompress(data)
+        crc = zlib.crc32(uncompressed, crc)
+        out_file.write(uncompressed)
+    uncompressed = decomp.flush()
+    crc = zlib.crc32(uncompressed, crc)
+    out_file.write(uncompressed)
+
+    # Return any data read beyond the end of the deflate stream
+    reader.unread(decomp.unused_data)
+
+    return crc
+
+
+def read_data_descriptor(reader: ChunkReader, is_zip64: bool) -> int:
+    """
+    Read the data descriptor following a member's data
+
+    Parameters
+    ----------
+    reader:
+        reader positioned at the end of the member's data
+    is_zip64:
+        are the sizes stored as 8 bytes?
+
+    Returns
+    -------
+        CRC-32 stored in the descriptor
+    """
+
+    first: bytes = reader.read(4)
+    if first == DATA_DESCRIPTOR_SIG:
+        first = reader.read(4)
+    crc: int = struct.unpack("<I", first)[0]
+    reader.read(16 if is_zip64 else 8)
+
+    return crc
+
+
+# pylint: disable=too-many-locals
+def stream_unzip(chunks: Iterable[bytes], output_dir: Path) -> list[str]:
+    """
+    Extract a zip archive from a stream of byte chunks
+
+    Parameters
+    ----------
+    chunks:
+        iterable of byte chunks making up the archive
+    output_dir:
+        Path to extract to
+
+    Returns
+    -------
+        names of the extracted members
+    """
+
+    reader = ChunkReader(chunks)
+    members: list[str] = []
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        signature: bytes = reader.read(4)
+        if signature in (CENTRAL_DIR_SIG, END_CENTRAL_DIR_SIG):
+            break
+        if signature != LOCAL_HEADER_SIG:
+            raise UnsupportedZipError("Invalid zip local file header")
+
+        _, flags, method, _, _, crc, comp_size, uncomp_size, name_len, extra_len = struct.unpack(
+            "<HHHHHIIIHH", reader.read(26)
+        )
+        name: str = reader.read(name_len).decode("utf-8" if flags & 0x800 else "cp437")
+        comp_size, uncomp_size, is_zip64 = zip64_sizes(
+            reader.read(extra_len), comp_size, uncomp_size
+        )
+
+        if flags & 0x1:
+            raise UnsupportedZipError(f"Encrypted zip member: {name}")
+        if method not in (STORED, DEFLATED):
+            raise UnsupportedZipError(f"Unsupported compression method {method}: {name}")
+
+        has_descriptor: bool = bool(flags & 0x8)
+        target: Path = member_path(output_dir, name)
+
+        if name.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, "wb") as out_file:
+                data_crc: int = copy_member(
+                    reader, out_file, method, None if has_descriptor else comp_size
+                )
+            if has_descriptor:
+                crc = read_data_descriptor(reader, is_zip64)
+            if data_crc != crc:
+                raise OSError(f"CRC mismatch extracting zip member: {name}")
+
+        members.append(name)
+
+    log.debug(f"Extracted {len(members)} members to {output_dir}")
+
+    return members
+
+
+def count_chunks(chunks: Iterable[bytes], record: instrumentation.SpanRecord) -> Iterator[bytes]:
+    """
+    Pass through chunks, adding their size to the bytes of a span
+
+    Parameters
+    ----------
+    chunks:
+        iterable of byte chunks
+    record:
+        span to add the bytes to
+
+    Yields
+    ------
+        chunks
+    """
+
+    for chunk in chunks:
+        record.add(bytes=len(chunk))
+        yield chunk
+
+
+def stream_unzip_file(fw_file: FileEntry, output_dir: Path) -> None:
+    """
+    Extract a zipped file from Flywheel while it is being downloaded. The archive is extracted
+    into a temporary '.part' directory which is renamed to output_dir once complete. If the
+    archive cannot be streamed, it is downloaded next to output_dir and extracted as usual.
+
+    Parameters
+    ----------
+    fw_file:
+        zipped file on Flywheel
+    output_dir:
+        Path to extract to
+    """
+
+    part: Path = transfer.part_name(output_dir)
+    if part.exists():
+        shutil.rmtree(part)
+
+    log.info(f"Streaming and extracting: {fw_file.name}")
+    try:
+        with instrumentation.span("stream_extraction", filename=fw_file.name) as record:
+            members: list[str] = stream_unzip(
+                count_chunks(transfer.iter_chunks(fw_file), record), part
+            )
+            record.add(files=len(members))
+    except UnsupportedZipError as err:
+        log.warning(f"Could not stream {fw_file.name} ({err}), downloading instead")
+        shutil.rmtree(part, ignore_errors=True)
+        download_name: Path = output_dir.parent / fw_file.name
+        transfer.download_file(fw_file, download_name)
+        with instrumentation.span("extraction", filename=fw_file.name):
+            unzip_archive(download_name, part)
+        download_name.unlink()
+
+    part.rename(output_dir)
@@ -0,0 +1,255 @@
+"""
+Benchmarks of the download entry points against a synthetic subject, with latency and bandwidth
+injected into every mock API call and transfer. Each benchmark reports the number of API calls,
+the wall time and the peak memory allocated by Python (tracemalloc).
+
+Run with, e.g.:
+    python -m tests.benchmarks.bench_downloads --sessions 4 --acquisitions 8 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+
+from flywheel_utilities import (
+    async_download,
+    batch,
+    download_bids,
+    download_dicoms,
+    download_results,
+    snapshot,
+)
+
+from tests.mock_classes import (
+    Analysis,
+    Client,
+    File,
+    Job,
+    Latency,
+    synthetic_subject,
+)
+
+
+@dataclass
+class BenchResult:
+    """Measurements of a single benchmark"""
+
+    name: str
+    seconds: float
+    api_calls: int
+    transferred_mb: float
+    peak_mb: float
+
+
+def make_bids_dirs(subject, bids_dir):
+    """Create the anat folder of each session"""
+
+    for session in subject.sessions.items:
+        (bids_dir / f"sub-{subject.label}" / f"ses-{session.label}" / "anat").mkdir(parents=True)
+
+
+def bench_snapshot(subject, _work_dir):
+    """Retrieve the subject's metadata"""
+
+    snapshot.take_snapshot(subject)
+
+
+def bench_bids(subject, work_dir, max_workers=1):
+    """Download all anat files"""
+
+    make_bids_dirs(subject, work_dir)
+    download_bids.download_bids_modalities(
+        subject, ["anat"], work_dir, False, max_workers=max_workers
+    )
+
+
+def bench_bids_concurrent(subject, work_dir):
+    """Download all anat files with 8 download threads"""
+
+    bench_bids(subject, work_dir, max_workers=8)
+
+
+def bench_iter_bids(subject, work_dir):
+    """Download all anat files with 8 download threads, consuming files as they arrive"""
+
+    make_bids_dirs(subject, work_dir)
+    for _ in download_bids.iter_bids_modalities(subject, ["anat"], work_dir, False, max_workers=8):
+        pass
+
+
+def bench_async_bids(subject, work_dir):
+    """Download all anat files using asyncio"""
+
+    make_bids_dirs(subject, work_dir)
+    asyncio.run(async_download.async_download_bids_modalities(subject, ["anat"], work_dir, False))
+
+
+def bench_all_dicoms(subject, work_dir, max_workers=1):
+    """Download and extract all DICOM series"""
+
+    dicom_dir = work_dir / "dicoms"
+    dicom_dir.mkdir()
+    download_dicoms.download_all_dicoms(
+        subject, work_dir, [], dicom_dir, False, max_workers=max_workers
+    )
+
+
+def bench_all_dicoms_pool(subject, work_dir):
+    """Download all DICOM series, extracting with a pool of 4 processes"""
+
+    bench_all_dicoms(subject, work_dir, max_workers=4)
+
+
+def bench_specific_dicoms(subject, work_dir):
+    """Download the DICOM series of the first file of each session"""
+
+    names = [
+        session.acquisitions.items[0].files[0].name.split("_", 1)[1]
+        for session in subject.sessions.items
+    ]
+    download_dicoms.download_specific_dicoms(subject, names, work_dir)
+
+
+def bench_batch_bids(subject, work_dir):
+    """Download all anat files of 4 subjects with 4 workers"""
+
+    subjects = [subject] + [
+        synthetic_subject(
+            f"{idx:02d}",
+            len(subject.sessions.items),
+            len(subject.sessions.items[0].acquisitions.items),
+            len(subject.sessions.items[0].acquisitions.items[0].files) - 1,
+            subject.sessions.items[0].acquisitions.items[0].files[0].size,
+            subject.latency,
+        )
+        for idx in range(1, 4)
+    ]
+    for one_subject in subjects:
+        make_bids_dirs(one_subject, work_dir)
+    batch.batch_download_bids_modalities(subjects, ["anat"], work_dir, False)
+
+
+def mock_analyses(latency):
+    """History of 50 analyses, the newest of which has the requested output"""
+
+    analyses = [Analysis("fmriprep", day, job=Job(tags=["old"])) for day in range(1, 50)]
+    analyses.append(
+        Analysis(
+            "fmriprep",
+            50,
+            files=[File("fmriprep_sub-00.html", latency=latency)],
+            job=Job(tags=["rerun"]),
+        )
+    )
+    return analyses
+
+
+def bench_results_query(subject, work_dir):
+    """Find and download the latest result by querying the analyses"""
+
+    results = {"gear_name": "fmriprep", "filename": "fmriprep", "tag": "rerun"}
+    client = Client(mock_analyses(subject.latency), subject.latency)
+    download_results.download_previous_result(subject, results, work_dir, client=client)
+
+
+def bench_results_reload(subject, work_dir):
+    """Find and download the latest result by filtering all of the subject's analyses"""
+
+    results = {"gear_name": "fmriprep", "filename": "fmriprep", "tag": "rerun"}
+    subject.analyses = mock_analyses(subject.latency)
+    download_results.download_previous_result(subject, results, work_dir)
+
+
+BENCHMARKS = {
+    "snapshot": bench_snapshot,
+    "bids": bench_bids,
+    "bids_concurrent": bench_bids_concurrent,
+    "iter_bids": bench_iter_bids,
+    "async_bids": bench_async_bids,
+    "all_dicoms": bench_all_dicoms,
+    "all_dicoms_pool": bench_all_dicoms_pool,
+    "specific_dicoms": bench_specific_dicoms,
+    "batch_bids": bench_batch_bids,
+    "results_query": bench_results_query,
+    "results_reload": bench_results_reload,
+}
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-positional-arguments
+def run_benchmarks(
+    work_dir,
+    names=None,
+    n_sessions=2,
+    n_acquisitions=4,
+    n_files=2,
+    file_size=1024,
+    latency=0.0,
+    bandwidth=None,
+):
+    """Run the named benchmarks (all if None), each on a new synthetic subject"""
+
+    measured = []
+    for name in names if names is not None else BENCHMARKS:
+        injected = Latency(latency, bandwidth)
+        subject = synthetic_subject("00", n_sessions, n_acquisitions, n_files, file_size, injected)
+        bench_dir = Path(work_dir) / name
+        bench_dir.mkdir()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        BENCHMARKS[name](subject, bench_dir)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        measured.append(
+            BenchResult(name, seconds, injected.calls, injected.bytes / 1024**2, peak / 1024**2)
+        )
+
+    return measured
+
+
+def main(argv=None):
+    """Run the benchmarks and print a table of the results"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--acquisitions", type=int, default=4)
+    parser.add_argument("--files", type=int, default=2, help="files per acquisition")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="bytes")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API call")
+    parser.add_argument("--bandwidth", type=float, default=100e6, help="bytes per second")
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {sorted(unknown)}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        measured = run_benchmarks(
+            work_dir,
+            args.names or None,
+            args.sessions,
+            args.acquisitions,
+            args.files,
+            args.file_size,
+            args.latency,
+            args.bandwidth,
+        )
+
+    print(f"{'benchmark':<18}{'seconds':>10}{'API calls':>11}{'MiB moved':>11}{'peak MiB':>10}")
+    for result in measured:
+        print(
+            f"{result.name:<18}{result.seconds:>10.3f}{result.api_calls:>11}"
+            f"{result.transferred_mb:>11.1f}{result.peak_mb:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
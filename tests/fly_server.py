@@ -0,0 +1,275 @@
+"""
+Local stand-in for the Flywheel API endpoints used by this library, so that the real Flywheel SDK
+can be exercised end-to-end without a Flywheel instance. Containers and files are loaded from
+fixtures, and latency, bandwidth throttling and errors can be injected into every request.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+import flywheel
+
+FIXTURES = Path(__file__).parent / "fixtures" / "flywheel.json"
+
+CONTAINER_TYPES = ["projects", "subjects", "sessions", "acquisitions", "analyses", "containers"]
+
+
+class FlywheelHandler(BaseHTTPRequestHandler):
+    """Serve container JSON and file contents from the server's fixtures"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve containers, analyses and files"""
+
+        if not self.server.inject(self):
+            return
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query, True).items()}
+        parts = [unquote(part) for part in url.path.split("/")[2:]]
+
+        if len(parts) == 2 and parts[0] in CONTAINER_TYPES and parts[1] in self.server.containers:
+            self.send_json(self.server.container(parts[1]))
+        elif len(parts) == 3 and parts[0] == "subjects" and parts[2] == "analyses":
+            self.send_json(self.server.analyses(parts[1], query))
+        elif len(parts) == 3 and parts[0] in CONTAINER_TYPES and parts[2] in CONTAINER_TYPES:
+            self.send_json(self.server.children(parts[0], parts[1], parts[2]))
+        elif len(parts) == 4 and parts[2] == "files" and (parts[1], parts[3]) in self.server.files:
+            if query.get("ticket") == "":
+                self.send_json({"ticket": "ticket"})
+            else:
+                self.send_file(self.server.files[parts[1], parts[3]])
+        else:
+            self.send_json({"message": f"Not found: {url.path}"}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Add tags to containers"""
+
+        if not self.server.inject(self):
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        parts = [unquote(part) for part in urlparse(self.path).path.split("/")[2:]]
+
+        if len(parts) == 3 and parts[2] == "tags" and parts[1] in self.server.containers:
+            tags = self.server.containers[parts[1]].setdefault("tags", [])
+            if body["value"] in tags:
+                self.send_json({"message": "Tag already exists"}, 409)
+            else:
+                tags.append(body["value"])
+                self.send_json({"modified": 1})
+        else:
+            self.send_json({"message": f"Not found: {self.path}"}, 404)
+
+    def send_json(self, data, status=200, headers=None):
+        """Send a JSON response"""
+
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, content):
+        """Send file contents, honouring Range headers and the server's bandwidth"""
+
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]), len(content) - 1) if match[2] else len(content) - 1
+            body = content[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        else:
+            body = content
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start : start + chunk_size])
+            if self.server.bandwidth:
+                time.sleep(len(body[start : start + chunk_size]) / self.server.bandwidth)
+        self.server.count(bytes_sent=len(body))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Silence request logging"""
+
+
+# pylint: disable=too-many-instance-attributes
+class FlywheelServer(ThreadingHTTPServer):
+    """
+    Stand-in Flywheel server
+
+    latency:
+        seconds added to every request
+    bandwidth:
+        bytes per second at which files are sent (unlimited if None)
+    error_rate:
+        fraction of requests failed with error_status
+    errors:
+        statuses returned by the next requests, before any are served, e.g. [429, 503]
+    retry_after:
+        value of the Retry-After header sent with 429 and 503 errors (omitted if None)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fixtures=None, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        super().__init__(("127.0.0.1", 0), FlywheelHandler)
+        self.containers = {}
+        self.files = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = 500
+        self.errors = []
+        self.retry_after = None
+        self.requests = []
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        if fixtures is not None:
+            self.load(fixtures)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def api_key(self):
+        """API key pointing the Flywheel SDK at this server over plain HTTP"""
+
+        return f"127.0.0.1:{self.server_address[1]}:__force_insecure:stand-in-key"
+
+    def client(self):
+        """Flywheel client using this server"""
+
+        return flywheel.Client(self.api_key, disable_auth_check=True)
+
+    def load(self, fixtures):
+        """
+        Load containers from a JSON fixtures file. Each container lists its files with either
+        'content' (text) or 'size' (random bytes).
+        """
+
+        with open(fixtures, "r", encoding="utf-8") as in_json:
+            data = json.load(in_json)
+        for container in data["containers"]:
+            files = container.pop("files", [])
+            self.add_container(container)
+            for one_file in files:
+                content = one_file.pop("content", None)
+                if content is None:
+                    content = os.urandom(one_file.pop("size", 0))
+                elif isinstance(content, str):
+                    content = content.encode()
+                self.add_file(container["_id"], one_file, content)
+
+    def add_container(self, container):
+        """Add a container (JSON as returned by the Flywheel API)"""
+
+        container.setdefault("files", [])
+        self.containers[container["_id"]] = container
+
+    def add_file(self, container_id, file_info, content):
+        """Add a file to a container, filling in its size and hash"""
+
+        file_info = {
+            "type": None,
+            "info": {},
+            **file_info,
+            "size": len(content),
+            "hash": "v0-sha384-" + hashlib.sha384(content).hexdigest(),
+        }
+        self.containers[container_id]["files"].append(file_info)
+        self.files[container_id, file_info["name"]] = content
+
+    def container(self, container_id):
+        """JSON of a container"""
+
+        return self.containers[container_id]
+
+    def children(self, parent_type, parent_id, child_type):
+        """Child containers of a container, e.g. the sessions of a subject"""
+
+        return [
+            container
+            for container in self.containers.values()
+            if container.get("container_type") == child_type[:-1]
+            and container.get("parents", {}).get(parent_type[:-1]) == parent_id
+        ]
+
+    def analyses(self, subject_id, query):
+        """Analyses of a subject, filtered, sorted and paged as requested"""
+
+        found = [
+            container
+            for container in self.containers.values()
+            if container.get("container_type") == "analysis"
+            and container.get("parent", {}).get("id") == subject_id
+        ]
+        if "filter" in query:
+            key, pattern = query["filter"].split("=~")
+            found = [ana for ana in found if re.search(pattern, str(lookup(ana, key)))]
+        if "sort" in query:
+            key, order = query["sort"].split(":")
+            found.sort(key=lambda ana: str(lookup(ana, key)), reverse=order == "desc")
+        skip = int(query.get("skip", 0))
+        # As with Flywheel, the SDK deserializes the listed (inflated) jobs as strings
+        return found[skip : skip + int(query.get("limit", len(found)))]
+
+    def count(self, request=None, bytes_sent=0):
+        """Record a request or the bytes sent"""
+
+        with self._lock:
+            if request is not None:
+                self.requests.append(request)
+            self.bytes_sent += bytes_sent
+
+    def inject(self, handler):
+        """Apply the latency and errors to a request, returning False if it was failed"""
+
+        self.count(request=(handler.command, urlparse(handler.path).path))
+        time.sleep(self.latency)
+
+        with self._lock:
+            status = self.errors.pop(0) if self.errors else None
+            if status is None and self.error_rate and self._random.random() < self.error_rate:
+                status = self.error_status
+        if status is None:
+            return True
+
+        headers = {}
+        if status in (429, 503) and self.retry_after is not None:
+            headers["Retry-After"] = self.retry_after
+        # The request body must be consumed to keep the connection usable
+        handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        handler.send_json({"message": "Injected error"}, status, headers)
+        return False
+
+
+def lookup(data, key):
+    """Look up a dotted key (e.g. 'gear_info.name') in nested dicts"""
+
+    for part in key.split("."):
+        data = data.get(part, {}) if isinstance(data, dict) else {}
+    return data
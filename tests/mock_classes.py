@@ -1,7 +1,13 @@
 """
-Very basic mock context class
+Very basic mock classes mimicking the Flywheel context and container hierarchy
 """
 
+import copy
+import hashlib
+import io
+import threading
+import time
+import zipfile
 from pathlib import Path
 
 
@@ -10,15 +16,313 @@ from pathlib import Path
 class Context:
     """Dummy class docstring"""
 
+    # pylint: disable=too-many-arguments
     def __init__(
         self,
         debug_level="INFO",
         working_dir="",
         gear_name="dummy-name",
         gear_version="3.14.2_0.11.0",
+        client=None,
+        destination_id="analysis",
     ):
         self.config = {"gear-log-level": debug_level}
 
         self.work_dir = Path(working_dir)
 
         self.manifest = {"label": gear_name, "version": gear_version}
+
+        self.client = client
+
+        self.destination = {"id": destination_id}
+
+
+class Latency:
+    """Per-call latency and transfer bandwidth injected into mock API calls, counting calls"""
+
+    def __init__(self, seconds=0.0, bandwidth=None):
+        self.seconds = seconds
+        self.bandwidth = bandwidth
+        self.calls = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def call(self, n_bytes=0):
+        """Count a call transferring n_bytes and sleep for its simulated duration"""
+        with self._lock:
+            self.calls += 1
+            self.bytes += n_bytes
+        time.sleep(self.seconds + (n_bytes / self.bandwidth if self.bandwidth else 0.0))
+
+
+class Finder:
+    """Mock of flywheel.finder.Finder wrapping a list of children"""
+
+    def __init__(self, items, latency=None):
+        self.items = items
+        self.latency = latency
+
+    def __call__(self):
+        if self.latency is not None:
+            self.latency.call()
+        return list(self.items)
+
+    def iter(self):
+        """Iterate over children"""
+        if self.latency is not None:
+            self.latency.call()
+        return iter(self.items)
+
+
+class File:
+    """Mock of a Flywheel FileEntry, supporting both item and attribute access"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, info=None, file_type="nifti", content=b"data", latency=None):
+        self.name = name
+        self.info = info if info is not None else {}
+        self.type = file_type
+        self.content = content
+        self.modified = "2024-01-01 00:00:00"
+        self.downloads = 0
+        self.latency = latency
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def size(self):
+        """Size of the mock contents"""
+        return len(self.content)
+
+    @property
+    def hash(self):
+        """Flywheel formatted hash of the mock contents"""
+        return "v0-sha384-" + hashlib.sha384(self.content).hexdigest()
+
+    def url(self):
+        """Mock download URL"""
+        return f"https://flywheel.test/files/{self.name}"
+
+    def download(self, dest_file):
+        """Write the mock contents to dest_file"""
+        self.downloads += 1
+        if self.latency is not None:
+            self.latency.call(len(self.content))
+        with open(dest_file, "wb") as out_file:
+            out_file.write(self.content)
+
+
+class Acquisition:
+    """Mock of a Flywheel acquisition container"""
+
+    def __init__(self, label, files, info=None, latency=None):
+        self.id = f"acq-{label}"
+        self.label = label
+        self.files = files
+        self.info = info if info is not None else {}
+        self.modified = "2024-01-01 00:00:00"
+        self.reloads = 0
+        self.latency = latency
+
+    def reload(self):
+        """Count reloads and return self"""
+        self.reloads += 1
+        if self.latency is not None:
+            self.latency.call()
+        return self
+
+
+class Session:
+    """Mock of a Flywheel session container"""
+
+    def __init__(self, label, acquisitions, latency=None):
+        self.id = f"ses-{label}"
+        self.label = label
+        self.acquisitions = Finder(acquisitions, latency)
+        self.reloads = 0
+
+    def reload(self):
+        """Count reloads and return self"""
+        self.reloads += 1
+        return self
+
+
+class Subject:
+    """Mock of a Flywheel subject container"""
+
+    def __init__(self, label, sessions, latency=None, analyses=None):
+        self.id = f"sub-{label}"
+        self.label = label
+        self.sessions = Finder(sessions, latency)
+        self.analyses = analyses if analyses is not None else []
+        self.latency = latency
+
+    def reload(self):
+        """Return self, including the analyses"""
+        if self.latency is not None:
+            self.latency.call()
+        return self
+
+
+def bids_file(name, folder, path, latency=None, **info):
+    """Create a mock BIDSified file"""
+
+    bids_info = {"Filename": name, "Folder": folder, "Path": path, "ignore": False}
+    return File(name, info={"BIDS": bids_info, **info}, latency=latency)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+# pylint: disable=too-many-positional-arguments
+def synthetic_subject(
+    label="00", n_sessions=2, n_acquisitions=4, n_files=2, file_size=1024, latency=None
+):
+    """
+    Generate a subject with n_sessions sessions, each with n_acquisitions acquisitions holding
+    n_files BIDSified anat files and a zipped DICOM series of n_files members, all with contents
+    of file_size bytes
+    """
+
+    sessions = []
+    for ses in range(n_sessions):
+        path = f"sub-{label}/ses-{ses:02d}/anat"
+        acquisitions = []
+        for acq in range(n_acquisitions):
+            files = []
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as out_zip:
+                for run in range(n_files):
+                    name = f"sub-{label}_ses-{ses:02d}_acq-{acq:02d}_run-{run:02d}_T1w.nii.gz"
+                    files.append(bids_file(name, "anat", path, latency, SeriesNumber=acq))
+                    files[-1].content = bytes([run % 256]) * file_size
+                    out_zip.writestr(f"{acq}/{run}.dcm", bytes([run % 256]) * file_size)
+            files.append(
+                File(
+                    f"{acq} - T1w_{ses:02d}.dicom.zip",
+                    info={"header": {"dicom": {"SeriesNumber": acq, "SeriesDescription": "T1w"}}},
+                    file_type="dicom",
+                    content=buffer.getvalue(),
+                    latency=latency,
+                )
+            )
+            acquisitions.append(Acquisition(f"T1w_{ses:02d}_{acq:02d}", files, latency=latency))
+        sessions.append(Session(f"{ses:02d}", acquisitions, latency))
+
+    return Subject(label, sessions, latency)
+
+
+class Job:
+    """Mock of a Flywheel job"""
+
+    def __init__(self, state="complete", tags=None, config=None):
+        self.state = state
+        self.tags = tags if tags is not None else []
+        self.config = {"config": config if config is not None else {}}
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class Analysis:
+    """Mock of a Flywheel analysis container"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, gear_name, created, files=None, job=None, version="1.0.0"):
+        self.id = f"{gear_name}-{created}"
+        self.gear_info = {"name": gear_name, "version": version}
+        self.created = created
+        self.files = files if files is not None else []
+        self.job = job if job is not None else Job()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_json(self):
+        """JSON of the analysis as listed by Flywheel, with the job inflated"""
+        return {
+            "_id": self.id,
+            "gear_info": self.gear_info,
+            "created": self.created,
+            "job": None if self.job is None else vars(self.job),
+        }
+
+
+class Response:
+    """Mock of a raw HTTP response"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        """Decoded body"""
+        return self.data
+
+
+class Client:
+    """
+    Mock of a Flywheel client holding a subject's analyses. As deserialized by the SDK, analyses
+    are listed with their jobs as strings, unless the raw JSON is requested.
+    """
+
+    def __init__(self, analyses, latency=None):
+        self.analyses = analyses
+        self.requests = []
+        self.latency = latency
+
+    def get_subject_analyses(self, subject_id, **kwargs):
+        """Page through analyses, newest first, filtered on gear name"""
+        self.requests.append((subject_id, kwargs))
+        if self.latency is not None:
+            self.latency.call()
+        gear_name = kwargs["filter"].split("=~")[1]
+        found = sorted(
+            (ana for ana in self.analyses if gear_name in ana.gear_info["name"]),
+            key=lambda ana: ana.created,
+            reverse=True,
+        )
+        page = found[kwargs["skip"] : kwargs["skip"] + kwargs["limit"]]
+        if kwargs.get("_preload_content") is False:
+            return Response([ana.to_json() for ana in page])
+        page = [copy.copy(ana) for ana in page]
+        for ana in page:
+            ana.job = str(vars(ana.job))
+        return page
+
+    def get_analysis(self, analysis_id, **kwargs):
+        """Look up an analysis"""
+        self.requests.append((analysis_id, kwargs))
+        return next(ana for ana in self.analyses if ana.id == analysis_id)
+
+
+class Container:
+    """Mock of a generic Flywheel container"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, container_id, container_type, parent=None, parents=None, **attrs):
+        self.id = container_id
+        self.container_type = container_type
+        self.parent = parent
+        self.parents = parents if parents is not None else {}
+        for key, value in attrs.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class ContainerClient:
+    """Mock of a Flywheel client looking up containers by ID, counting requests"""
+
+    def __init__(self, containers):
+        self.containers = {container.id: container for container in containers}
+        self.requests = []
+
+    def get(self, container_id):
+        """Look up any container"""
+        self.requests.append(container_id)
+        return self.containers[container_id]
+
+    def get_project(self, project_id):
+        """Look up a project"""
+        return self.get(project_id)
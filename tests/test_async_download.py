@@ -0,0 +1,162 @@
+"""
+Test for async_download.py
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from flywheel_utilities import async_download, download_bids, snapshot
+
+from tests.mock_classes import Acquisition, Session, Subject, bids_file, synthetic_subject
+from tests.test_download_bids import mock_subject
+
+
+def test_async_take_snapshot():
+    """Test the asynchronous snapshot matches the subject"""
+
+    subject = mock_subject()
+    limiter = async_download.RequestLimiter(4)
+    try:
+        tree = asyncio.run(async_download.async_take_snapshot(subject, limiter))
+    finally:
+        limiter.close()
+
+    assert [session.label for session in tree.sessions] == ["01", "02"]
+    assert [acq.label for acq in tree.sessions[0].acquisitions] == ["T1w", "rest", "fmap"]
+    for session in subject.sessions():
+        for acq in session.acquisitions():
+            assert acq.reloads == 1
+
+
+def test_limiter_event_loops():
+    """Test a limiter can be reused from consecutive event loops while its requests wait"""
+
+    limiter = async_download.RequestLimiter(1)
+
+    async def requests():
+        return await asyncio.gather(*[limiter.run(time.sleep, 0.01) for _ in range(3)])
+
+    try:
+        for _ in range(2):
+            assert asyncio.run(requests()) == [None, None, None]
+    finally:
+        limiter.close()
+
+
+def test_async_take_snapshot_sessions(monkeypatch):
+    """Test the acquisitions of all sessions are reloaded concurrently"""
+
+    subject = synthetic_subject(n_sessions=3, n_acquisitions=2)
+    # Only passes once all acquisitions are being reloaded at the same time
+    barrier = threading.Barrier(6, timeout=5)
+    original = snapshot.snapshot_acquisition
+
+    def snapshot_acquisition(acq, cache=None):
+        barrier.wait()
+        return original(acq, cache)
+
+    monkeypatch.setattr(snapshot, "snapshot_acquisition", snapshot_acquisition)
+    limiter = async_download.RequestLimiter(6)
+    try:
+        tree = asyncio.run(async_download.async_take_snapshot(subject, limiter))
+    finally:
+        limiter.close()
+
+    assert [len(session.acquisitions) for session in tree.sessions] == [2, 2, 2]
+    assert [acq.id for acq in tree.sessions[1].acquisitions] == [
+        acq.id for acq in subject.sessions()[1].acquisitions()
+    ]
+
+
+def test_async_download_failure(tmp_path, monkeypatch):
+    """Test the event loop is not blocked by the downloads in flight when one fails"""
+
+    for folder in ["anat", "func", "fmap"]:
+        for ses in ["01", "02"]:
+            (tmp_path / f"sub-00/ses-{ses}/{folder}").mkdir(parents=True)
+
+    def download_scan(scan, *_):
+        if scan.name.endswith(".json"):
+            raise OSError("Download failed")
+        time.sleep(0.5)
+
+    monkeypatch.setattr(download_bids, "download_scan", download_scan)
+
+    async def download_and_tick():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        try:
+            with pytest.raises(OSError):
+                await async_download.async_download_bids_modalities(
+                    mock_subject(), ["anat", "func", "fmap"], tmp_path, False
+                )
+        finally:
+            ticker.cancel()
+        return ticks
+
+    ticks = asyncio.run(download_and_tick())
+
+    # The loop kept running while the slow downloads finished
+    assert max(later - earlier for earlier, later in zip(ticks, ticks[1:])) < 0.25
+
+
+def test_async_download_bids_modalities(tmp_path):
+    """Test the same files are downloaded as by the synchronous version"""
+
+    for ses in ["01", "02"]:
+        for folder in ["anat", "func", "fmap"]:
+            (tmp_path / "async" / f"sub-00/ses-{ses}/{folder}").mkdir(parents=True)
+            (tmp_path / "sync" / f"sub-00/ses-{ses}/{folder}").mkdir(parents=True)
+
+    async def download_subjects():
+        # Several subjects can share a single limiter
+        limiter = async_download.RequestLimiter(2)
+        try:
+            await asyncio.gather(
+                async_download.async_download_bids_modalities(
+                    mock_subject(), ["func", "fmap"], tmp_path / "async", False, limiter=limiter
+                ),
+                async_download.async_download_bids_modalities(
+                    mock_subject(), ["anat"], tmp_path / "async", False, limiter=limiter
+                ),
+            )
+        finally:
+            limiter.close()
+
+    asyncio.run(download_subjects())
+    download_bids.download_bids_modalities(
+        mock_subject(), ["anat", "func", "fmap"], tmp_path / "sync", False
+    )
+
+    downloaded = sorted(
+        path.relative_to(tmp_path / "async") for path in (tmp_path / "async").rglob("*.*")
+    )
+    expected = sorted(
+        path.relative_to(tmp_path / "sync") for path in (tmp_path / "sync").rglob("*.*")
+    )
+    assert downloaded == expected
+    assert len(downloaded) == 8
+
+
+def test_async_download_shared_destination(tmp_path):
+    """Test files mapped to the same BIDS path are only downloaded once, as in serial mode"""
+
+    path = "sub-00/ses-01/func"
+    (tmp_path / path).mkdir(parents=True)
+    scans = [bids_file("sub-00_ses-01_task-rest_bold.nii.gz", "func", path) for _ in range(2)]
+    scans[0].content, scans[1].content = b"first", b"second"
+    subject = Subject("00", [Session("01", [Acquisition("rest", scans)])])
+
+    asyncio.run(async_download.async_download_bids_modalities(subject, ["func"], tmp_path, False))
+
+    assert (tmp_path / path / scans[0].name).read_bytes() == b"first"
+    assert [scan.downloads for scan in scans] == [1, 0]
@@ -2,11 +2,15 @@
 Test for basic_logging.py
 """
 
+import io
+import json
 import logging
+import threading
 
-from flywheel_utilities.basic_logging import setup_basic_logging
+from flywheel_utilities import instrumentation, transfer
+from flywheel_utilities.basic_logging import JsonFormatter, queue_handler, setup_basic_logging
 
-from tests.mock_classes import Context
+from tests.mock_classes import Context, File
 
 logger = logging.getLogger()
 
@@ -19,3 +23,91 @@ def test_setup_basic_logging():
 
     # 30 = DEBUG
     assert logger.level == 30
+
+
+def test_json_queue_logging():
+    """Test JSON records with extra fields are written by the queue listener"""
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    handler_in, listener = queue_handler(handler)
+
+    test_logger = logging.getLogger("test_json_queue_logging")
+    test_logger.propagate = False
+    test_logger.addHandler(handler_in)
+    test_logger.warning("Downloaded %s", "sub-00_T1w.nii.gz", extra={"bytes": 1024})
+    listener.stop()
+    test_logger.removeHandler(handler_in)
+
+    entry = json.loads(stream.getvalue())
+    assert entry["message"] == "Downloaded sub-00_T1w.nii.gz"
+    assert entry["level"] == "WARNING"
+    assert entry["bytes"] == 1024
+
+
+def test_stop_queue_listener():
+    """Test the listener can be stopped twice, and records logged afterwards are still written"""
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler_in, listener = queue_handler(handler)
+
+    logger.addHandler(handler_in)
+    try:
+        listener.stop()
+        # As at exit
+        listener.stop()
+        logger.warning("Logged after stopping")
+    finally:
+        logger.removeHandler(handler_in)
+        logger.removeHandler(handler)
+
+    assert "Logged after stopping" in stream.getvalue()
+
+
+def test_json_file_fields():
+    """Test JSON logging records spans and the container, name and size of files"""
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    package_logger = logging.getLogger("flywheel_utilities")
+    package_logger.addHandler(handler)
+    level = package_logger.level
+    package_logger.setLevel(logging.DEBUG)
+
+    setup_basic_logging(Context("INFO"), json_format=True)
+    try:
+        with instrumentation.span("transfer", filename="sub-00_T1w.nii.gz") as record:
+            record.add(bytes=4, files=1)
+        logging.getLogger("flywheel_utilities.download_bids").info(
+            "Located", extra=transfer.log_fields(File("sub-00_T1w.nii.gz"), "acq-1")
+        )
+    finally:
+        instrumentation.remove_sink(instrumentation.log_span)
+        package_logger.removeHandler(handler)
+        package_logger.setLevel(level)
+
+    span_entry, file_entry = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert span_entry["phase"] == "transfer"
+    assert span_entry["bytes"] == 4
+    assert "elapsed" in span_entry
+    assert file_entry["container_id"] == "acq-1"
+    assert file_entry["file_name"] == "sub-00_T1w.nii.gz"
+    assert file_entry["bytes"] == len(b"data")
+
+
+def test_queue_configured_root():
+    """Test no listener thread is started if the root logger already has handlers"""
+
+    handler = logging.NullHandler()
+    logger.addHandler(handler)
+    threads = threading.active_count()
+    try:
+        listener = setup_basic_logging(Context("INFO"), use_queue=True)
+    finally:
+        logger.removeHandler(handler)
+
+    assert listener is None
+    assert threading.active_count() == threads
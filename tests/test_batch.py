@@ -0,0 +1,56 @@
+"""
+Test for batch.py
+"""
+
+from flywheel_utilities import batch
+
+from tests.mock_classes import Acquisition, Finder, Session, Subject, bids_file
+
+
+def mock_subject(label):
+    """Mock subject with a single T1w image"""
+
+    path = f"sub-{label}/anat"
+    anat = Acquisition("T1w", [bids_file(f"sub-{label}_T1w.nii.gz", "anat", path)])
+    return Subject(label, [Session("01", [anat])])
+
+
+class Project:
+    """Mock of a Flywheel project"""
+
+    def __init__(self, subjects):
+        self.subjects = Finder(subjects)
+
+
+def test_project_subjects():
+    """Test subjects are selected by ID or label"""
+
+    project = Project([mock_subject(label) for label in ["00", "01", "02"]])
+
+    assert len(batch.project_subjects(project)) == 3
+    subjects = batch.project_subjects(project, ["sub-00", "02", "03"])
+    assert [subject.label for subject in subjects] == ["00", "02"]
+
+
+def test_batch_download_bids_modalities(tmp_path):
+    """Test all subjects are downloaded, with failures reported per subject"""
+
+    subjects = [mock_subject(f"{idx:02d}") for idx in range(6)]
+    for subject in subjects:
+        (tmp_path / f"sub-{subject.label}" / "anat").mkdir(parents=True)
+
+    # Listing the sessions of this subject fails
+    def fail():
+        raise OSError("Connection reset")
+
+    subjects[3].sessions = fail
+
+    statuses = batch.batch_download_bids_modalities(
+        subjects, ["anat"], tmp_path, False, max_workers=3
+    )
+
+    assert [status.label for status in statuses] == [subject.label for subject in subjects]
+    assert [status.state for status in statuses] == ["done"] * 3 + ["failed"] + ["done"] * 2
+    assert "Connection reset" in statuses[3].error
+    for subject in subjects[:3] + subjects[4:]:
+        assert (tmp_path / f"sub-{subject.label}/anat/sub-{subject.label}_T1w.nii.gz").is_file()
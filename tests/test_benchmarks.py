@@ -0,0 +1,21 @@
+"""
+Test for benchmarks/bench_downloads.py
+"""
+
+from tests.benchmarks import bench_downloads
+
+
+def test_run_benchmarks(tmp_path):
+    """Test every benchmark runs on a small synthetic subject"""
+
+    measured = bench_downloads.run_benchmarks(tmp_path, n_sessions=1, n_acquisitions=2)
+    calls = {result.name: result.api_calls for result in measured}
+
+    assert list(calls) == list(bench_downloads.BENCHMARKS)
+    # One listing of sessions and acquisitions and one reload per acquisition
+    assert calls["snapshot"] == 4
+    # Plus one call per downloaded file
+    assert calls["bids"] == calls["bids_concurrent"] == calls["async_bids"] == 4 + 4
+    assert calls["all_dicoms"] == 4 + 2
+    assert calls["batch_bids"] == 4 * calls["bids"]
+    assert all(result.seconds > 0 and result.peak_mb > 0 for result in measured)
@@ -0,0 +1,37 @@
+"""
+Test for disk_space.py
+"""
+
+import errno
+
+import pytest
+
+from flywheel_utilities import disk_space
+
+from tests.mock_classes import File
+
+
+def test_check_free_space(tmp_path):
+    """Test destinations on the same file system share its free space"""
+
+    free = disk_space.free_bytes(tmp_path / "missing" / "dir")
+    assert disk_space.existing_parent(tmp_path / "missing" / "dir") == tmp_path
+
+    disk_space.check_free_space({tmp_path / "a": free // 4, tmp_path / "b": free // 4})
+    assert not disk_space.has_free_space({tmp_path / "a": free // 4}, reserve=free)
+
+    with pytest.raises(OSError) as err:
+        disk_space.check_free_space({tmp_path / "a": free // 2 + 1, tmp_path / "b": free // 2 + 1})
+    assert err.value.errno == errno.ENOSPC
+    assert err.value.filename == str(tmp_path)
+
+
+def test_extracted_bytes():
+    """Test zip archives are assumed to expand, and files of unknown size are not counted"""
+
+    fw_file = File("series.dicom.zip", content=b"x" * 100)
+
+    assert disk_space.file_bytes(fw_file) == 100
+    assert disk_space.extracted_bytes(fw_file) == int(100 * disk_space.ZIP_EXPANSION)
+    assert disk_space.extracted_bytes(fw_file, expansion=1.5) == 150
+    assert disk_space.file_bytes(object()) == 0
@@ -9,6 +9,8 @@ from pathlib import Path
 
 from flywheel_utilities import download_bids
 
+from tests.mock_classes import Acquisition, Session, Subject, bids_file
+
 
 def test_intendedfor_pass(tmp_path, caplog):
     """Test successful population of IntendedFor"""
@@ -264,3 +266,115 @@ def test_is_bidsified_ignore_missing(caplog):
 
     assert ret is False
     assert caplog.messages[0] == "No ignore field: mock_label"
+
+
+def mock_subject():
+    """Mock subject with anat, func and fmap data across two sessions"""
+
+    sessions = []
+    for ses in ["01", "02"]:
+        path = f"sub-00/ses-{ses}"
+        anat = Acquisition(
+            "T1w", [bids_file(f"sub-00_ses-{ses}_T1w.nii.gz", "anat", f"{path}/anat")]
+        )
+        func = Acquisition(
+            "rest",
+            [
+                bids_file(f"sub-00_ses-{ses}_task-rest_bold.nii.gz", "func", f"{path}/func"),
+                bids_file(f"sub-00_ses-{ses}_task-rest_bold.json", "func", f"{path}/func"),
+            ],
+        )
+        fmap = Acquisition(
+            "fmap",
+            [
+                bids_file(
+                    f"sub-00_ses-{ses}_dir-ap_epi.json",
+                    "fmap",
+                    f"{path}/fmap",
+                    IntendedFor=[f"ses-{ses}/func/sub-00_ses-{ses}_task-rest_bold.nii.gz"],
+                )
+            ],
+        )
+        for acq in [anat, func, fmap]:
+            for scan in acq.files:
+                if scan.name.endswith(".json"):
+                    scan.content = b"{}"
+        sessions.append(Session(ses, [anat, func, fmap]))
+
+    return Subject("00", sessions)
+
+
+def download_modalities(bids_dir, max_workers):
+    """Create BIDS structure and download func and fmap data"""
+
+    subject = mock_subject()
+    for session in subject.sessions():
+        for modality in ["anat", "func", "fmap"]:
+            (bids_dir / "sub-00" / f"ses-{session.label}" / modality).mkdir(parents=True)
+
+    download_bids.download_bids_modalities(
+        subject, ["func", "fmap"], bids_dir, False, max_workers=max_workers
+    )
+
+    return {
+        one_file.relative_to(bids_dir).as_posix(): one_file.read_bytes()
+        for one_file in bids_dir.rglob("*")
+        if one_file.is_file()
+    }
+
+
+def test_download_modalities_concurrent(tmp_path):
+    """Test concurrent downloads produce the same dataset as serial downloads"""
+
+    serial = download_modalities(tmp_path / "serial", 1)
+    concurrent = download_modalities(tmp_path / "concurrent", 4)
+
+    assert "sub-00/ses-01/anat/sub-00_ses-01_T1w.nii.gz" not in serial
+    assert len(serial) == 6
+    assert serial == concurrent
+
+    fmap = json.loads(concurrent["sub-00/ses-02/fmap/sub-00_ses-02_dir-ap_epi.json"])
+    assert fmap["IntendedFor"] == ["ses-02/func/sub-00_ses-02_task-rest_bold.nii.gz"]
+
+
+def test_download_modalities_shared_destination(tmp_path):
+    """Test files mapped to the same BIDS path are only downloaded once, as in serial mode"""
+
+    for max_workers in [1, 4]:
+        bids_dir = tmp_path / str(max_workers)
+        path = "sub-00/ses-01/func"
+        (bids_dir / path).mkdir(parents=True)
+        scans = [bids_file("sub-00_ses-01_task-rest_bold.nii.gz", "func", path) for _ in range(2)]
+        scans[0].content, scans[1].content = b"first", b"second"
+        subject = Subject("00", [Session("01", [Acquisition("rest", scans)])])
+
+        yielded = list(
+            download_bids.iter_bids_modalities(
+                subject, ["func"], bids_dir, False, max_workers=max_workers
+            )
+        )
+
+        assert [scan for _, _, scan in yielded] == scans
+        assert (bids_dir / path / scans[0].name).read_bytes() == b"first"
+        assert [scan.downloads for scan in scans] == [1, 0]
+
+
+def test_iter_bids_modalities(tmp_path):
+    """Test each file is yielded once on disk, with fmap sidecars yielded after populating"""
+
+    subject = mock_subject()
+    for session in subject.sessions():
+        for modality in ["func", "fmap"]:
+            (tmp_path / "sub-00" / f"ses-{session.label}" / modality).mkdir(parents=True)
+
+    yielded = []
+    for bids_path, local_path, scan in download_bids.iter_bids_modalities(
+        subject, ["func", "fmap"], tmp_path, False, post_populate=["func"], max_workers=4
+    ):
+        assert local_path == tmp_path / bids_path
+        assert local_path.is_file()
+        assert scan.name == bids_path.name
+        yielded.append(bids_path.name)
+
+    assert len(yielded) == 6
+    assert [name for name in yielded if "epi" in name] == yielded[-2:]
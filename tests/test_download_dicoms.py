@@ -0,0 +1,187 @@
+"""
+Test for download_dicoms.py
+"""
+
+import errno
+import io
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from flywheel_utilities import disk_space, download_dicoms, snapshot, transfer
+
+from tests.mock_classes import Acquisition, File, Session, Subject, bids_file
+
+
+def dicom_zip(members):
+    """Create zipped DICOM series contents"""
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as out_zip:
+        for member in members:
+            out_zip.writestr(member, b"DICM")
+    return buffer.getvalue()
+
+
+def dicom_file(name, series_number, series_desc, content=b"DICM"):
+    """Create a mock DICOM file"""
+
+    header = {"SeriesNumber": series_number, "SeriesDescription": series_desc}
+    return File(name, info={"header": {"dicom": header}}, file_type="dicom", content=content)
+
+
+def mock_subject():
+    """Mock subject with a magnitude and phase series in the same acquisition"""
+
+    magnitude = bids_file("sub-00_part-mag_dwi.nii.gz", "dwi", "sub-00/dwi", SeriesNumber=5)
+    phase = bids_file("sub-00_part-phase_dwi.nii.gz", "dwi", "sub-00/dwi", SeriesNumber=6)
+    dwi = Acquisition(
+        "dwi",
+        [
+            magnitude,
+            phase,
+            dicom_file("5 - dwi.dicom.zip", 5, "dwi", dicom_zip(["dwi/1.dcm", "dwi/2.dcm"])),
+            dicom_file("6 - dwi_phase.dcm", 6, "dwi phase"),
+        ],
+    )
+    anat = Acquisition(
+        "T1w",
+        [
+            bids_file("sub-00_T1w.nii.gz", "anat", "sub-00/anat", SeriesNumber=2),
+            dicom_file("2 - T1w.dicom.zip", 2, "T1w", dicom_zip(["t1/1.dcm"])),
+        ],
+    )
+
+    return Subject("00", [Session("01", [anat, dwi])]), dwi
+
+
+def test_index_dicom_series():
+    """Test BIDS file names are indexed to the DICOM with the matching SeriesNumber"""
+
+    subject, dwi = mock_subject()
+
+    index = download_dicoms.index_dicom_series(snapshot.take_snapshot(subject))
+
+    assert list(index) == [
+        "sub-00_T1w.nii.gz",
+        "sub-00_part-mag_dwi.nii.gz",
+        "sub-00_part-phase_dwi.nii.gz",
+    ]
+    assert index["sub-00_part-mag_dwi.nii.gz"] == (5, dwi.files[2])
+    assert index["sub-00_part-phase_dwi.nii.gz"] == (6, dwi.files[3])
+
+
+def test_download_specific_dicoms(tmp_path):
+    """Test multiple requested files from the same acquisition"""
+
+    subject, dwi = mock_subject()
+
+    dicoms = download_dicoms.download_specific_dicoms(
+        subject, ["part-mag_dwi", "part-phase_dwi"], tmp_path
+    )
+
+    assert dwi.reloads == 1
+    assert dicoms == {
+        "part-mag_dwi": tmp_path / "5_dwi",
+        "part-phase_dwi": tmp_path / "6_dwi_phase",
+    }
+    assert (tmp_path / "5_dwi" / "dwi" / "2.dcm").is_file()
+    assert (tmp_path / "6_dwi_phase" / "6 - dwi_phase.dcm").is_file()
+    assert not (tmp_path / "2_T1w").exists()
+
+
+def test_download_specific_dicoms_disk_space(tmp_path, monkeypatch):
+    """Test the free disk space is checked before downloading the requested series"""
+
+    subject, dwi = mock_subject()
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: 0)
+
+    with pytest.raises(OSError) as err:
+        download_dicoms.download_specific_dicoms(subject, ["part-mag_dwi"], tmp_path)
+    assert err.value.errno == errno.ENOSPC
+    assert all(scan.downloads == 0 for scan in dwi.files)
+
+    download_dicoms.download_specific_dicoms(subject, ["part-mag_dwi"], tmp_path, check_space=False)
+    assert (tmp_path / "5_dwi" / "dwi" / "2.dcm").is_file()
+
+
+def test_download_all_dicoms_parallel(tmp_path):
+    """Test zipped series are extracted by a pool of processes"""
+
+    subject, _ = mock_subject()
+    dicom_dir = tmp_path / "dicoms"
+    dicom_dir.mkdir()
+
+    download_dicoms.download_all_dicoms(subject, tmp_path, [], dicom_dir, False, max_workers=2)
+
+    assert (dicom_dir / "2-T1w" / "t1" / "1.dcm").is_file()
+    assert (dicom_dir / "5-dwi" / "dwi" / "2.dcm").is_file()
+
+    with pytest.raises(ValueError):
+        download_dicoms.download_all_dicoms(subject, tmp_path, [], dicom_dir, False, max_workers=0)
+    assert (dicom_dir / "6-dwi_phase.dcm" / "6_-_dwi_phase.dcm").is_file()
+
+
+def test_download_all_dicoms_stream(tmp_path, monkeypatch):
+    """Test zipped series are extracted without writing the zip file to disk"""
+
+    subject, _ = mock_subject()
+    dicom_dir = tmp_path / "dicoms"
+    dicom_dir.mkdir()
+    monkeypatch.setattr(transfer, "iter_chunks", lambda fw_file: [fw_file.content])
+
+    download_dicoms.download_all_dicoms(subject, tmp_path, [], dicom_dir, False, stream=True)
+
+    assert (dicom_dir / "2-T1w" / "t1" / "1.dcm").is_file()
+    assert (dicom_dir / "5-dwi" / "dwi" / "2.dcm").is_file()
+    assert list(tmp_path.glob("*.zip")) == []
+
+
+def test_iter_all_dicoms(tmp_path):
+    """Test each series is yielded once extracted, with the BIDS path of BIDSified series"""
+
+    subject, dwi = mock_subject()
+    dwi.files[2].info["BIDS"] = {"Path": "sourcedata/sub-00/dwi", "Filename": "5-dwi.dicom.zip"}
+    dicom_dir = tmp_path / "dicoms"
+    dicom_dir.mkdir()
+
+    yielded = {
+        scan.name: (bids_path, local_path)
+        for bids_path, local_path, scan in download_dicoms.iter_all_dicoms(
+            subject, tmp_path, [], dicom_dir, False, max_workers=2
+        )
+    }
+
+    assert yielded == {
+        "2 - T1w.dicom.zip": (None, dicom_dir / "2-T1w"),
+        "5 - dwi.dicom.zip": (Path("sourcedata/sub-00/dwi/5-dwi.dicom.zip"), dicom_dir / "5-dwi"),
+        "6 - dwi_phase.dcm": (None, dicom_dir / "6-dwi_phase.dcm"),
+    }
+    assert all(local_path.is_dir() for _, local_path in yielded.values())
+
+
+def test_download_all_dicoms_disk_space(tmp_path, monkeypatch):
+    """Test zipped series are streamed if the zip files do not fit, and nothing is downloaded if
+    the extracted series do not fit"""
+
+    subject, _ = mock_subject()
+    dicom_dir = tmp_path / "dicoms"
+    dicom_dir.mkdir()
+    series = list(download_dicoms.select_dicom_series(snapshot.take_snapshot(subject), []))
+    kept = download_dicoms.dicom_space_required(series, tmp_path, dicom_dir, False)
+    streamed = download_dicoms.dicom_space_required(series, tmp_path, dicom_dir, True)
+    assert streamed[tmp_path] == len(b"DICM") and streamed[dicom_dir] == kept[dicom_dir]
+    monkeypatch.setattr(transfer, "iter_chunks", lambda fw_file: [fw_file.content])
+
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: sum(streamed.values()) - 1)
+    with pytest.raises(OSError) as err:
+        download_dicoms.download_all_dicoms(subject, tmp_path, [], dicom_dir, False)
+    assert err.value.errno == errno.ENOSPC
+    assert all(scan.downloads == 0 for scan in series)
+
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: sum(streamed.values()))
+    download_dicoms.download_all_dicoms(subject, tmp_path, [], dicom_dir, False)
+
+    assert (dicom_dir / "5-dwi" / "dwi" / "2.dcm").is_file()
+    assert not list(tmp_path.glob("*.zip"))
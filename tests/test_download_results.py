@@ -0,0 +1,132 @@
+"""
+Test for download_results.py
+"""
+
+from zipfile import ZipFile
+
+from flywheel_utilities import download_results
+
+from tests.mock_classes import Analysis, Client, File, Job, Subject
+
+
+def mock_analyses():
+    """Mock history of analyses on a subject"""
+
+    analyses = [Analysis("fmriprep", day, job=Job(tags=["old"])) for day in range(1, 25)]
+    analyses += [
+        Analysis("fmriprep", 30, files=[File("fmriprep_sub-00.html")], job=Job(tags=["rerun"])),
+        Analysis("fmriprep", 31, job=Job(state="failed", tags=["rerun"])),
+        Analysis("fmriprep", 32, job=Job(tags=["rerun"], config={"gear-export": True})),
+        Analysis("freesurfer", 33, job=Job(tags=["rerun"])),
+    ]
+    return analyses
+
+
+def test_query_latest_analysis():
+    """Test the latest successful run is found from the first page of results"""
+
+    client = Client(mock_analyses())
+
+    latest = download_results.query_latest_analysis(client, "sub", "fmriprep", "rerun", False)
+
+    assert latest.created == 30
+    # A single page is listed, and the match retrieved
+    assert len(client.requests) == 2
+    assert client.requests[0][1]["sort"] == "created:desc"
+
+    # Without a tag, newest successful run is returned
+    latest = download_results.query_latest_analysis(client, "sub", "fmriprep", "", True)
+    assert latest.created == 32
+
+
+def test_query_latest_analysis_jobs():
+    """Test the jobs are checked from the listed JSON, and only the match is retrieved"""
+
+    client = Client(mock_analyses())
+
+    latest = download_results.query_latest_analysis(client, "sub", "fmriprep", "rerun", False)
+
+    assert latest.job.tags == ["rerun"]
+    assert client.requests[0][1]["_preload_content"] is False
+    assert client.requests[1:] == [("fmriprep-30", {"inflate_job": True})]
+
+    # Analyses without a job are skipped
+    analyses = mock_analyses()
+    analyses[-2].job = None
+    client = Client(analyses)
+    latest = download_results.query_latest_analysis(client, "sub", "fmriprep", "", True)
+    assert latest.created == 30
+
+
+def test_query_latest_analysis_paging():
+    """Test further pages are requested if required, and None returned if no match"""
+
+    client = Client(mock_analyses())
+
+    latest = download_results.query_latest_analysis(client, "sub", "fmriprep", "old", False)
+    assert latest.created == 24
+    assert len(client.requests) == 2
+
+    client = Client(mock_analyses())
+    assert download_results.query_latest_analysis(client, "sub", "fmriprep", "new", False) is None
+    assert len(client.requests) == 4
+
+
+def test_download_previous_result(tmp_path):
+    """Test downloading the output of the latest run via a query"""
+
+    client = Client(mock_analyses())
+    results = {"gear_name": "fmriprep", "filename": "fmriprep", "tag": "rerun"}
+
+    ret = download_results.download_previous_result(
+        Subject("00", []), results, tmp_path, client=client
+    )
+
+    assert ret == 0
+    assert client.requests[0][0] == "sub-00"
+    assert (tmp_path / "fmriprep_sub-00.html").is_file()
+
+
+def make_result_zip(zip_name):
+    """Create a zipped result with nested folders"""
+
+    with ZipFile(zip_name, "w") as out_zip:
+        out_zip.writestr("fmriprep/", "")
+        out_zip.writestr("fmriprep/sub-00/anat/T1w.nii.gz", b"anat")
+        out_zip.writestr("fmriprep/sub-00/anat/T1w.json", b"{}")
+        out_zip.writestr("fmriprep/sub-00/func/bold.nii.gz", b"func")
+
+
+def test_unzip_result(tmp_path):
+    """Test the whole result is extracted by default"""
+
+    make_result_zip(tmp_path / "fmriprep_sub-00.zip")
+
+    assert download_results.unzip_result(tmp_path / "fmriprep_sub-00.zip", tmp_path, False) == 0
+    assert (tmp_path / "fmriprep/sub-00/anat/T1w.nii.gz").is_file()
+    assert (tmp_path / "fmriprep/sub-00/func/bold.nii.gz").is_file()
+
+
+def test_unzip_result_selective(tmp_path):
+    """Test only the selected members are extracted"""
+
+    make_result_zip(tmp_path / "fmriprep_sub-00.zip")
+
+    ret = download_results.unzip_result(
+        tmp_path / "fmriprep_sub-00.zip",
+        tmp_path,
+        False,
+        include=["*/anat/*"],
+        exclude=["*.json"],
+    )
+
+    assert ret == 0
+    assert (tmp_path / "fmriprep/sub-00/anat/T1w.nii.gz").is_file()
+    assert not (tmp_path / "fmriprep/sub-00/anat/T1w.json").exists()
+    assert not (tmp_path / "fmriprep/sub-00/func").exists()
+
+    # Later requests extract further members, even though the base directory now exists
+    download_results.unzip_result(
+        tmp_path / "fmriprep_sub-00.zip", tmp_path, False, include=["*/func/*"]
+    )
+    assert (tmp_path / "fmriprep/sub-00/func/bold.nii.gz").is_file()
@@ -0,0 +1,63 @@
+"""
+Test for file_store.py
+"""
+
+import os
+
+from flywheel_utilities import file_store, transfer
+
+from tests.mock_classes import File
+
+
+def test_download_from_store(tmp_path):
+    """Test a file downloaded by one gear run is linked into the next run's working directory"""
+
+    store = file_store.FileStore(tmp_path / "store")
+    transfer.use_file_store(store)
+    try:
+        for run in ["run1", "run2"]:
+            (tmp_path / run).mkdir()
+            fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+            transfer.download_file(fw_file, tmp_path / run / fw_file.name)
+            assert (tmp_path / run / fw_file.name).read_bytes() == b"0123456789"
+    finally:
+        transfer.use_file_store(None)
+
+    # Only the first run downloaded the file
+    assert fw_file.downloads == 0
+    assert len(store.entries()) == 1
+    assert (tmp_path / "run2" / fw_file.name).stat().st_ino == store.entries()[0].stat().st_ino
+
+    # Editing a linked file in place would corrupt the store
+    assert store.entries()[0].stat().st_mode & 0o777 == file_store.READ_ONLY
+
+
+def test_store_eviction(tmp_path):
+    """Test the least recently used files are evicted once the store is too large"""
+
+    store = file_store.FileStore(tmp_path / "store", max_bytes=25)
+    files = [File(f"{idx}.nii.gz", content=bytes([idx]) * 10) for idx in range(3)]
+    for idx, fw_file in enumerate(files):
+        (tmp_path / fw_file.name).write_bytes(fw_file.content)
+        store.add(fw_file, tmp_path / fw_file.name)
+        os.utime(store.path(file_store.store_key(fw_file)), (idx, idx))
+
+    store.evict()
+
+    assert store.size() == 20
+    assert not store.fetch(files[0], tmp_path / "evicted.nii.gz")
+    assert store.fetch(files[1], tmp_path / "kept.nii.gz")
+    assert (tmp_path / "kept.nii.gz").read_bytes() == files[1].content
+
+
+def test_store_path(tmp_path):
+    """Test stored files are sharded on the digest of the hash or on the file ID"""
+
+    store = file_store.FileStore(tmp_path)
+    fw_file = File("sub-00_T1w.nii.gz")
+    key = file_store.store_key(fw_file)
+
+    assert key.startswith("sha384-")
+    assert store.path(key) == tmp_path / "objects" / key[7:9] / key
+    key = "65a1b2c3d4e5f60718293a4b-v2"
+    assert store.path(key) == tmp_path / "objects" / "65" / key
@@ -0,0 +1,93 @@
+"""
+End-to-end tests of the Flywheel SDK calls made by this library, against the stand-in server
+"""
+
+import time
+
+import flywheel
+import pytest
+
+from flywheel_utilities import download_bids, download_results, fly_wrappers, metadata
+
+from tests.fly_server import FIXTURES, FlywheelServer
+from tests.mock_classes import Context
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """Stand-in server loaded with the default fixtures"""
+
+    with FlywheelServer(FIXTURES) as server:
+        yield server
+
+
+def test_download_bids_modalities(server, tmp_path):
+    """Test BIDS data is downloaded through the SDK and verified against the metadata"""
+
+    subject = server.client().get("subject-1")
+    (tmp_path / "sub-00/ses-01/anat").mkdir(parents=True)
+
+    download_bids.download_bids_modalities(subject, ["anat"], tmp_path, False, max_workers=4)
+
+    downloaded = tmp_path / "sub-00/ses-01/anat/sub-00_ses-01_T1w.nii.gz"
+    assert downloaded.read_bytes() == server.files["acquisition-1", downloaded.name]
+    assert server.requests[-1] == (
+        "GET",
+        f"/api/acquisitions/acquisition-1/files/{downloaded.name}",
+    )
+
+
+def test_download_previous_result(server, tmp_path):
+    """Test the latest tagged result is found by querying the subject's analyses"""
+
+    client = server.client()
+    subject = client.get("subject-1")
+    results = {"gear_name": "fmriprep", "filename": "fmriprep", "tag": "rerun"}
+
+    ret = download_results.download_previous_result(subject, results, tmp_path, client=client)
+
+    assert ret == 0
+    assert (tmp_path / "fmriprep_sub-00.html").read_text() == "new report"
+    assert ("GET", "/api/analyses/analysis-1") not in server.requests
+
+
+def test_context_lookups_and_tags(server):
+    """Test the gear's project is looked up once, and the subject tagged once"""
+
+    client = server.client()
+    context = Context(client=client, destination_id="analysis-3", gear_name="bids-app")
+
+    assert fly_wrappers.get_project(context).label == "Epilepsy"
+    assert fly_wrappers.get_project(context).label == "Epilepsy"
+    assert server.requests == [
+        ("GET", "/api/containers/analysis-3"),
+        ("GET", "/api/projects/project-1"),
+    ]
+
+    subject = client.get("subject-1")
+    metadata.update_subject_tags(context, subject)
+    # The stale subject is missing the tag, which the server rejects as already present
+    metadata.update_subject_tags(context, subject)
+    assert server.containers["subject-1"]["tags"] == ["bids-app:3.14.2_0.11.0"]
+
+
+def test_injected_latency_and_errors(server):
+    """Test latency and errors are injected, with transient errors retried by the SDK"""
+
+    client = server.client()
+
+    server.errors = [500]
+    with pytest.raises(flywheel.ApiException) as err:  # pylint: disable=maybe-no-member
+        client.get("subject-1")
+    assert err.value.status == 500
+
+    server.errors = [503, 429]
+    server.retry_after = 0
+    server.requests.clear()
+    assert client.get("subject-1").label == "00"
+    assert len(server.requests) == 3
+
+    server.latency = 0.2
+    start = time.perf_counter()
+    client.get("subject-1")
+    assert time.perf_counter() - start >= 0.2
@@ -0,0 +1,76 @@
+"""
+Test for fly_wrappers.py
+"""
+
+import threading
+
+from flywheel_utilities import fly_wrappers
+
+from tests.mock_classes import Container, ContainerClient, Context
+
+
+def mock_context():
+    """Mock context whose destination is an analysis of a subject"""
+
+    client = ContainerClient(
+        [
+            Container(
+                "analysis",
+                "analysis",
+                parent=Container("subject", "reference", type="subject"),
+                parents={"project": "project", "subject": "subject"},
+            ),
+            Container("subject", "subject", label="00"),
+            Container("project", "project", info={}),
+        ]
+    )
+    return Context(client=client)
+
+
+def test_lookups_cached_per_context():
+    """Test each container is only looked up once per context"""
+
+    context = mock_context()
+
+    fly_wrappers.check_run_level(context, "subject")
+    assert fly_wrappers.get_subject(context).label == "00"
+    assert fly_wrappers.get_project(context).id == "project"
+    assert fly_wrappers.get_subject(context).label == "00"
+
+    assert sorted(context.client.requests) == ["analysis", "project", "subject"]
+
+    # Lookups are not shared between contexts, and can be forgotten
+    other = mock_context()
+    fly_wrappers.get_destination(other)
+    assert other.client.requests == ["analysis"]
+
+    fly_wrappers.clear_lookups(context)
+    fly_wrappers.get_destination(context)
+    assert context.client.requests.count("analysis") == 2
+
+
+def test_lookups_not_serialised():
+    """Test a slow lookup does not hold up lookups of other contexts, or of the same context"""
+
+    slow = mock_context()
+    release = threading.Event()
+    get = slow.client.get
+
+    def slow_get(container_id):
+        if container_id == "analysis":
+            release.wait(5)
+        return get(container_id)
+
+    slow.client.get = slow_get
+    thread = threading.Thread(target=fly_wrappers.get_destination, args=(slow,))
+    thread.start()
+    try:
+        assert fly_wrappers.get_destination(mock_context()).id == "analysis"
+        assert fly_wrappers.cached_lookup(slow, "project", lambda: "project") == "project"
+        # Both completed while the slow lookup is still in flight
+        assert thread.is_alive()
+    finally:
+        release.set()
+        thread.join()
+
+    assert slow.client.requests == ["analysis"]
@@ -0,0 +1,53 @@
+"""
+Test for instrumentation.py
+"""
+
+import logging
+
+from flywheel_utilities import instrumentation, transfer
+from flywheel_utilities.basic_logging import log_instrumentation_summary
+
+from tests.mock_classes import File
+
+
+def test_span_sinks():
+    """Test spans are aggregated per phase and passed to registered sinks"""
+
+    recorder = instrumentation.Recorder()
+    records = []
+    instrumentation.add_sink(recorder)
+    instrumentation.add_sink(records.append)
+
+    try:
+        with instrumentation.span("transfer", filename="a") as record:
+            record.add(bytes=10, files=1)
+        with instrumentation.span("transfer", filename="b") as record:
+            record.add(bytes=5, files=1)
+        with instrumentation.span("api") as record:
+            record.add(api_calls=3)
+    finally:
+        instrumentation.remove_sink(recorder)
+        instrumentation.remove_sink(records.append)
+
+    summary = recorder.summary()
+    assert summary["transfer"].spans == 2
+    assert summary["transfer"].bytes == 15
+    assert summary["api"].api_calls == 3
+    assert [record.labels.get("filename") for record in records] == ["a", "b", None]
+
+
+def test_download_instrumented(tmp_path, caplog):
+    """Test downloads are recorded and summarised"""
+
+    recorder = instrumentation.Recorder()
+    instrumentation.add_sink(recorder)
+    try:
+        transfer.download_file(File("sub-00_T1w.nii.gz", content=b"0123456789"), tmp_path / "a")
+    finally:
+        instrumentation.remove_sink(recorder)
+
+    assert recorder.summary()["transfer"].bytes == 10
+
+    with caplog.at_level(logging.INFO):
+        log_instrumentation_summary(recorder)
+    assert "transfer" in caplog.text
@@ -0,0 +1,70 @@
+"""
+Test for metadata_cache.py
+"""
+
+import time
+
+from flywheel_utilities import metadata_cache
+from flywheel_utilities.metadata_cache import MetadataCache
+
+from tests.mock_classes import Context
+
+
+def test_get_put(tmp_path):
+    """Test entries are only returned while the modified timestamp matches"""
+
+    cache = MetadataCache(tmp_path / "cache.sqlite")
+    cache.put("abc", "2024-01-01", {"files": {"a.nii.gz": {"info": {"key": 1}}}})
+
+    assert cache.get("abc", "2024-01-01") == {"files": {"a.nii.gz": {"info": {"key": 1}}}}
+    assert cache.get("def", "2024-01-01") is None
+
+    # Persisted across instances
+    assert len(MetadataCache(tmp_path / "cache.sqlite")) == 1
+
+    # Container has since been modified
+    assert cache.get("abc", "2024-02-01") is None
+    assert len(cache) == 0
+
+
+def test_invalidate(tmp_path):
+    """Test invalidating a single entry and the full cache"""
+
+    cache = MetadataCache(tmp_path / "cache.sqlite")
+    for container_id in ["a", "b", "c"]:
+        cache.put(container_id, "mod", {})
+
+    cache.invalidate("a")
+    assert cache.get("a", "mod") is None
+    assert cache.get("b", "mod") == {}
+
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_eviction(tmp_path):
+    """Test expired and least recently used entries are evicted"""
+
+    cache = MetadataCache(tmp_path / "cache.sqlite", max_entries=2)
+    cache.put("a", "mod", {})
+    time.sleep(0.01)
+    cache.put("b", "mod", {})
+    time.sleep(0.01)
+    # Access 'a' so that 'b' is the least recently used
+    cache.get("a", "mod")
+    cache.put("c", "mod", {})
+
+    assert len(cache) == 2
+    assert cache.get("b", "mod") is None
+
+    cache.ttl = 0
+    assert cache.get("a", "mod") is None
+
+
+def test_open_cache(tmp_path):
+    """Test cache is created in the working directory"""
+
+    cache = metadata_cache.open_cache(Context(working_dir=tmp_path))
+
+    assert cache.path == tmp_path / metadata_cache.CACHE_NAME
+    assert cache.path.is_file()
@@ -0,0 +1,113 @@
+"""
+Test for plan.py
+"""
+
+import json
+
+import pytest
+
+from flywheel_utilities import disk_space, plan
+
+from tests import test_download_bids, test_download_dicoms
+from tests.mock_classes import Acquisition, Client, ContainerClient, File, Subject
+from tests.test_download_results import mock_analyses
+
+
+def test_plan_bids_modalities(tmp_path):
+    """Test a plan saved to JSON downloads the same files when executed with a client"""
+
+    subject = test_download_bids.mock_subject()
+    for session in subject.sessions():
+        for acq in session.acquisitions():
+            acq.id = f"acq-{session.label}-{acq.label}"
+        for modality in ["func", "fmap"]:
+            (tmp_path / "sub-00" / f"ses-{session.label}" / modality).mkdir(parents=True)
+    present = tmp_path / "sub-00/ses-01/func/sub-00_ses-01_task-rest_bold.nii.gz"
+    present.write_bytes(b"data")
+
+    planned = plan.plan_bids_modalities(subject, ["func", "fmap"], tmp_path, ["func"])
+
+    assert len(planned.files) == 6
+    assert [one_file.name for one_file in planned.files if one_file.present] == [present.name]
+    assert planned.total_bytes == len(b"data") + 4 * len(b"{}")
+    assert {one_file.action for one_file in planned.files if "epi" in one_file.name} == {"download"}
+
+    planned.save(tmp_path / "plan.json")
+    loaded = plan.DownloadPlan.load(tmp_path / "plan.json")
+    assert loaded == planned
+    assert (
+        json.loads((tmp_path / "plan.json").read_text())["files"][0]["container_id"]
+        == "acq-01-rest"
+    )
+
+    acquisitions = [acq for session in subject.sessions() for acq in session.acquisitions()]
+    client = ContainerClient(acquisitions)
+    plan.execute_plan(loaded, client=client)
+
+    assert sorted(client.requests) == ["acq-01-fmap", "acq-01-rest", "acq-02-fmap", "acq-02-rest"]
+    for one_file in planned.files:
+        assert (tmp_path / one_file.bids_path).is_file()
+    fmap = json.loads((tmp_path / "sub-00/ses-01/fmap/sub-00_ses-01_dir-ap_epi.json").read_text())
+    assert fmap["IntendedFor"] == ["ses-01/func/sub-00_ses-01_task-rest_bold.nii.gz"]
+
+
+def test_resolve_file():
+    """Test files of a loaded plan are matched on their file ID"""
+
+    fw_file = File("sub-00_T1w.nii.gz")
+    fw_file.file_id = "file-1"
+    client = ContainerClient([Acquisition("T1w", [fw_file])])
+    planned = plan.PlannedFile(
+        fw_file.name, "sub-00_T1w.nii.gz", file_id="file-1", container_id="acq-T1w"
+    )
+
+    assert plan.resolve_file(planned, client, {}) is fw_file
+
+    # Re-uploaded since planning
+    fw_file.file_id = "file-2"
+    with pytest.raises(ValueError, match="replaced"):
+        plan.resolve_file(planned, client, {})
+
+
+def test_plan_all_dicoms(tmp_path):
+    """Test zipped series are planned for extraction and other series for moving"""
+
+    subject, _ = test_download_dicoms.mock_subject()
+    dicom_dir = tmp_path / "dicoms"
+    dicom_dir.mkdir()
+
+    planned = plan.plan_all_dicoms(subject, tmp_path, [], dicom_dir)
+
+    assert [(one_file.name, one_file.action) for one_file in planned.files] == [
+        ("2 - T1w.dicom.zip", "unzip"),
+        ("5 - dwi.dicom.zip", "unzip"),
+        ("6 - dwi_phase.dcm", "move"),
+    ]
+
+    required = planned.required_bytes()
+    assert required[tmp_path] == sum(one_file.size for one_file in planned.files)
+    assert required[dicom_dir / "5-dwi"] == int(planned.files[1].size * disk_space.ZIP_EXPANSION)
+
+    plan.execute_plan(planned)
+
+    assert not planned.required_bytes()
+    assert (dicom_dir / "2-T1w" / "t1" / "1.dcm").is_file()
+    assert (dicom_dir / "6-dwi_phase.dcm" / "6_-_dwi_phase.dcm").is_file()
+    assert not any(one_file.needs_transfer() for one_file in planned.files)
+
+
+def test_plan_previous_result(tmp_path):
+    """Test the latest result is planned, and None returned if there is no result"""
+
+    client = Client(mock_analyses())
+    results = {"gear_name": "fmriprep", "filename": "fmriprep", "tag": "rerun"}
+
+    planned = plan.plan_previous_result(Subject("00", []), results, tmp_path, client=client)
+
+    assert [(one_file.name, one_file.container_id) for one_file in planned.files] == [
+        ("fmriprep_sub-00.html", "fmriprep-30")
+    ]
+    assert not (tmp_path / "fmriprep_sub-00.html").exists()
+
+    results["tag"] = "missing"
+    assert plan.plan_previous_result(Subject("00", []), results, tmp_path, client=client) is None
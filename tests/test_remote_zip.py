@@ -0,0 +1,192 @@
+"""
+Test for remote_zip.py
+"""
+
+import errno
+import io
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZIP_STORED, ZipFile
+
+import pytest
+import requests
+
+from flywheel_utilities import disk_space, download_results, remote_zip, retry
+
+from tests.mock_classes import Analysis, File
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve the server's content, honouring Range headers if the server supports them"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the requested byte range"""
+
+        content = self.server.content
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start, end = int(match[1]), min(int(match[2]), len(content) - 1)
+            body = content[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        else:
+            body = content
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes_sent += len(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Silence request logging"""
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """HTTP server supporting range requests, serving a large zip file"""
+
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", compression=ZIP_STORED) as out_zip:
+        out_zip.writestr("freesurfer/", "")
+        out_zip.writestr("freesurfer/sub-00/mri/brain.mgz", os.urandom(4 * 1024 * 1024))
+        out_zip.writestr("freesurfer/sub-00/stats/aseg.stats", b"aseg")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.content = buffer.getvalue()
+    server.ranges = True
+    server.bytes_sent = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def remote_file(server):
+    """Mock Flywheel file served by the server"""
+
+    fw_file = File("freesurfer_sub-00.zip", content=server.content)
+    fw_file.url = lambda: f"http://127.0.0.1:{server.server_address[1]}/file"
+    return fw_file
+
+
+def test_remote_zip(server, tmp_path):
+    """Test listing and extracting a member only transfers a fraction of the zip"""
+
+    with remote_zip.RemoteZip(remote_file(server)) as archive:
+        assert server.bytes_sent == 0
+        assert "freesurfer/sub-00/stats/aseg.stats" in archive.namelist()
+        archive.extract("freesurfer/sub-00/stats/aseg.stats", str(tmp_path))
+
+    assert (tmp_path / "freesurfer/sub-00/stats/aseg.stats").read_bytes() == b"aseg"
+    assert server.bytes_sent < len(server.content) / 4
+
+
+def test_remote_zip_interrupted(server, tmp_path, monkeypatch):
+    """Test a range request interrupted while reading the body is retried"""
+
+    monkeypatch.setattr(retry, "_policy", retry.RetryPolicy(base_delay=0))
+    content = requests.Response.content
+    failures = [requests.exceptions.ChunkedEncodingError("Connection broken")]
+
+    def interrupted_content(resp):
+        if failures:
+            raise failures.pop()
+        return content.fget(resp)
+
+    monkeypatch.setattr(requests.Response, "content", property(interrupted_content))
+
+    with remote_zip.RemoteZip(remote_file(server)) as archive:
+        archive.extract("freesurfer/sub-00/stats/aseg.stats", str(tmp_path))
+
+    assert (tmp_path / "freesurfer/sub-00/stats/aseg.stats").read_bytes() == b"aseg"
+    assert not failures
+
+
+def test_download_specific_result_remote(server, tmp_path, monkeypatch):
+    """Test only the requested members of a remote result are extracted, requiring only the
+    disk space for those members"""
+
+    fw_file = remote_file(server)
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: len(b"aseg"))
+
+    download_results.download_specific_result(
+        Analysis("freesurfer", 1, files=[fw_file]),
+        "freesurfer",
+        tmp_path,
+        False,
+        include=["*/aseg.stats"],
+        remote=True,
+    )
+
+    assert (tmp_path / "freesurfer/sub-00/stats/aseg.stats").is_file()
+    assert not (tmp_path / "freesurfer/sub-00/mri").exists()
+    assert not (tmp_path / fw_file.name).exists()
+    assert fw_file.downloads == 0
+
+
+def test_admit_result(server, tmp_path, monkeypatch):
+    """Test zipped outputs are sized from their selected members, and read remotely if the zip
+    file does not fit alongside them"""
+
+    fw_file = remote_file(server)
+    zipped = len(server.content)
+    extracted = 4 * 1024 * 1024 + len(b"aseg")
+
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: zipped + extracted)
+    assert download_results.admit_result(fw_file, tmp_path, False) is False
+
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: extracted)
+    assert download_results.admit_result(fw_file, tmp_path, False) is True
+
+    # Only the selected members are counted
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: len(b"aseg"))
+    assert download_results.admit_result(fw_file, tmp_path, True, include=["*/aseg.stats"])
+    with pytest.raises(OSError) as err:
+        download_results.admit_result(fw_file, tmp_path, True)
+    assert err.value.errno == errno.ENOSPC
+
+    # Without range requests, the zip file is downloaded even if remote
+    server.ranges = False
+    monkeypatch.setattr(disk_space, "free_bytes", lambda path: zipped)
+    with pytest.raises(OSError) as err:
+        download_results.admit_result(fw_file, tmp_path, True, include=["*/aseg.stats"])
+    assert err.value.errno == errno.ENOSPC
+
+
+def test_remote_result_fallback(server, tmp_path):
+    """Test the zip is downloaded if range requests are not supported"""
+
+    server.ranges = False
+    fw_file = remote_file(server)
+
+    ret = download_results.unzip_remote_result(fw_file, tmp_path, False, include=["*/aseg.stats"])
+
+    assert ret == 0
+    assert fw_file.downloads == 1
+    assert (tmp_path / "freesurfer/sub-00/stats/aseg.stats").is_file()
+
+
+def test_range_not_supported(server, monkeypatch):
+    """Test the body of a response ignoring the Range header is never read"""
+
+    responses = []
+    get = requests.get
+
+    def recording_get(url, timeout, **kwargs):
+        responses.append(get(url, timeout=timeout, **kwargs))
+        return responses[-1]
+
+    server.ranges = False
+    monkeypatch.setattr(remote_zip.requests, "get", recording_get)
+    monkeypatch.setattr(
+        requests.Response, "content", property(lambda resp: pytest.fail("Body was read"))
+    )
+
+    with pytest.raises(remote_zip.RangeNotSupportedError):
+        remote_zip.RangeReader(remote_file(server).url())
+
+    assert [resp.status_code for resp in responses] == [200]
+    assert responses[0].raw.closed
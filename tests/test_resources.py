@@ -2,7 +2,9 @@
 Tests for resources.py
 """
 
+import json
 import os
+import time
 
 from flywheel_utilities import resources
 
@@ -25,7 +27,7 @@ def test_determine_n_cpus():
 
     n_cpus, omp_threads = resources.determine_n_cpus(req_cpus, req_omp)
 
-    avail_cpus = os.cpu_count()
+    avail_cpus, _ = resources.available_cpus()
 
     assert avail_cpus == n_cpus
     assert avail_cpus == omp_threads
@@ -41,3 +43,98 @@ def test_determine_max_mem():
     # Request far too much
     req_mem = 1000000000
     assert resources.determine_max_mem(req_mem) < req_mem
+
+
+def test_cgroup_v2_limits(tmp_path):
+    """Test CPU and memory limits are read from a cgroup v2 hierarchy"""
+
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    (tmp_path / "cpuset.cpus.effective").write_text("0-3,8\n")
+    (tmp_path / "memory.max").write_text(f"{2 * 1024**3}\n")
+    (tmp_path / "memory.current").write_text(f"{1024**3}\n")
+
+    assert resources.cgroup_cpu_quota(tmp_path) == 1.5
+    assert resources.cgroup_cpuset(tmp_path) == 5
+    assert resources.cgroup_memory(tmp_path) == (2 * 1024**3, 1024**3)
+
+    n_cpus, source = resources.available_cpus(tmp_path)
+    assert n_cpus == min(2, os.cpu_count())
+    if os.cpu_count() > 2:
+        assert source == "cgroup CPU quota"
+
+    mem_total, mem_avail, source = resources.available_memory(tmp_path)
+    assert source == "cgroup memory limit"
+    assert mem_total == 2
+    assert mem_avail <= 1
+
+
+def test_cgroup_v1_limits(tmp_path):
+    """Test CPU and memory limits are read from a cgroup v1 hierarchy, and unlimited values"""
+
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text("9223372036854771712\n")
+
+    assert resources.cgroup_cpu_quota(tmp_path) is None
+    assert resources.cgroup_cpuset(tmp_path) is None
+    assert resources.cgroup_memory(tmp_path) is None
+
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("400000\n")
+    assert resources.cgroup_cpu_quota(tmp_path) == 4
+
+
+def test_cgroup_memory_page_cache(tmp_path):
+    """Test inactive page cache (e.g., of downloaded files) is not counted as used memory"""
+
+    (tmp_path / "memory.max").write_text(f"{8 * 1024**3}\n")
+    (tmp_path / "memory.current").write_text(f"{8 * 1024**3 - 4096}\n")
+    (tmp_path / "memory.stat").write_text(
+        f"anon {1024**3}\nfile {7 * 1024**3}\ninactive_file {6 * 1024**3}\n"
+    )
+
+    assert resources.cgroup_memory(tmp_path) == (8 * 1024**3, 2 * 1024**3 - 4096)
+
+    (tmp_path / "memory.max").unlink()
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text(f"{8 * 1024**3}\n")
+    (tmp_path / "memory" / "memory.usage_in_bytes").write_text(f"{8 * 1024**3}\n")
+    (tmp_path / "memory" / "memory.stat").write_text(
+        f"cache {7 * 1024**3}\ninactive_file {1024**3}\ntotal_inactive_file {6 * 1024**3}\n"
+    )
+
+    assert resources.cgroup_memory(tmp_path) == (8 * 1024**3, 2 * 1024**3)
+
+
+def test_resource_monitor(tmp_path):
+    """Test the monitor samples the work directory and writes the time series"""
+
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    with resources.ResourceMonitor(work_dir, interval=0.01, output=tmp_path / "usage.json"):
+        (work_dir / "data.bin").write_bytes(b"0" * 1024**2)
+        time.sleep(0.05)
+
+    with open(tmp_path / "usage.json", encoding="utf-8") as in_json:
+        usage = json.load(in_json)
+
+    assert len(usage["samples"]) >= 2
+    assert usage["summary"]["disk_mb"]["peak"] == 1
+    assert usage["summary"]["rss_mb"]["peak"] > 0
+
+    monitor = resources.ResourceMonitor(work_dir, interval=10)
+    monitor.start()
+    monitor.stop()
+    monitor.write(tmp_path / "usage.csv")
+    assert (tmp_path / "usage.csv").read_text().startswith("time,cpu_percent,rss_mb")
+
+
+def test_percentile():
+    """Test nearest-rank percentiles"""
+
+    values = [float(value) for value in range(1, 101)]
+    assert resources.percentile(values, 50) == 50
+    assert resources.percentile(values, 95) == 95
+    assert resources.percentile([3.0], 95) == 3
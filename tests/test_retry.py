@@ -0,0 +1,111 @@
+"""
+Test for retry.py
+"""
+
+import time
+
+import flywheel
+import pytest
+import requests
+
+from flywheel_utilities import retry, transfer
+
+from tests.fly_server import FIXTURES, FlywheelServer
+
+
+@pytest.fixture(name="sleeps")
+def fixture_sleeps(monkeypatch):
+    """Record the delays between attempts instead of sleeping"""
+
+    sleeps = []
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def http_error(status, headers=None):
+    """HTTP error as raised by requests"""
+
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def test_retry_transient(sleeps):
+    """Test transient errors are retried with increasing delays, honouring Retry-After"""
+
+    errors = [
+        requests.ConnectionError("reset"),
+        http_error(503),
+        http_error(429, {"Retry-After": "7"}),
+    ]
+
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return "done"
+
+    policy = retry.RetryPolicy(base_delay=1.0)
+
+    assert policy.call(flaky) == "done"
+    assert len(sleeps) == 3
+    assert 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+    assert sleeps[2] == 7.0
+
+
+def test_retry_gives_up(sleeps):
+    """Test permanent errors are raised at once, and transient errors after max_attempts"""
+
+    policy = retry.RetryPolicy(max_attempts=3)
+
+    def not_found():
+        raise http_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        policy.call(not_found)
+    assert not sleeps
+
+    def unavailable():
+        raise http_error(503)
+
+    with pytest.raises(requests.HTTPError):
+        policy.call(unavailable)
+    assert len(sleeps) == 2
+
+
+def test_token_bucket():
+    """Test requests beyond the burst are spaced out at the requested rate"""
+
+    bucket = retry.TokenBucket(rate=50, burst=5)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        bucket.acquire()
+
+    assert time.perf_counter() - start >= 5 / 50 * 0.9
+
+
+def test_server_errors_retried(tmp_path):
+    """Test server errors, which the SDK does not retry, are retried for lookups and downloads"""
+
+    retry.set_policy(retry.RetryPolicy(base_delay=0.01))
+    try:
+        with FlywheelServer(FIXTURES) as server:
+            client = server.client()
+            server.errors = [500]
+            acquisition = retry.call(client.get, "acquisition-1")
+
+            server.errors = [500, 502]
+            fw_file = acquisition.files[0]
+            transfer.download_file(fw_file, tmp_path / fw_file.name)
+
+            assert (tmp_path / fw_file.name).read_bytes() == server.files[
+                "acquisition-1", fw_file.name
+            ]
+            assert not server.errors
+
+            server.errors = [404]
+            with pytest.raises(flywheel.ApiException):  # pylint: disable=maybe-no-member
+                retry.call(client.get, "acquisition-1")
+    finally:
+        retry.set_policy(retry.RetryPolicy())
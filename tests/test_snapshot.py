@@ -0,0 +1,56 @@
+"""
+Test for snapshot.py
+"""
+
+from flywheel_utilities import snapshot
+from flywheel_utilities.metadata_cache import MetadataCache
+
+from tests.mock_classes import Acquisition, Session, Subject, bids_file
+
+
+def test_take_snapshot():
+    """Test each acquisition is reloaded once and ignored acquisitions are skipped"""
+
+    anat = Acquisition("T1w", [bids_file("sub-00_T1w.nii.gz", "anat", "sub-00/anat")])
+    ignored = Acquisition("localiser", [], info={"BIDS": {"ignore": True}})
+    session = Session("01", [anat, ignored])
+    subject = Subject("00", [session])
+
+    tree = snapshot.take_snapshot(subject)
+
+    assert tree.label == "00"
+    assert [sesh.label for sesh in tree.sessions] == ["01"]
+    assert [acq.label for acq in tree.sessions[0].acquisitions] == ["T1w", "localiser"]
+    assert tree.sessions[0].acquisitions[0].files[0].name == "sub-00_T1w.nii.gz"
+    assert tree.sessions[0].acquisitions[1].is_ignored() is True
+
+    assert anat.reloads == 1
+    assert ignored.reloads == 0
+    assert session.reloads == 0
+
+    # An existing snapshot is returned as is
+    assert snapshot.get_snapshot(tree) is tree
+    assert anat.reloads == 1
+
+
+def test_take_snapshot_cached(tmp_path):
+    """Test unmodified acquisitions are restored from the metadata cache"""
+
+    anat = Acquisition("T1w", [bids_file("sub-00_T1w.nii.gz", "anat", "sub-00/anat")])
+    subject = Subject("00", [Session("01", [anat])])
+    info = anat.files[0].info
+
+    snapshot.take_snapshot(subject, MetadataCache(tmp_path / "cache.sqlite"))
+    assert anat.reloads == 1
+
+    # Listing endpoints do not return the file info
+    anat.files[0].info = {}
+    tree = snapshot.take_snapshot(subject, MetadataCache(tmp_path / "cache.sqlite"))
+
+    assert anat.reloads == 1
+    assert tree.sessions[0].acquisitions[0].files[0].info == info
+
+    # Modified acquisitions are reloaded
+    anat.modified = "2024-02-01 00:00:00"
+    snapshot.take_snapshot(subject, MetadataCache(tmp_path / "cache.sqlite"))
+    assert anat.reloads == 2
@@ -0,0 +1,162 @@
+"""
+Test for transfer.py
+"""
+
+import pytest
+import requests
+
+from flywheel_utilities import retry, transfer
+
+from tests.mock_classes import File
+
+
+class MockResponse:
+    """Mock requests response serving a byte range"""
+
+    def __init__(self, content, status_code):
+        self.content = content
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        """Raise an error for unsuccessful requests"""
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+    def iter_content(self, chunk_size):
+        """Yield the content in chunks"""
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class InterruptedResponse(MockResponse):
+    """Mock requests response dropping the connection after sending its content"""
+
+    def iter_content(self, chunk_size):
+        """Yield the content, then fail"""
+        yield from super().iter_content(chunk_size)
+        raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+
+def serve(responses, ranges):
+    """Mock requests.get returning the responses in turn, recording the requested ranges"""
+
+    def mock_get(_url, headers, **_kwargs):
+        ranges.append(headers.get("Range"))
+        return responses.pop(0)
+
+    return mock_get
+
+
+def test_iter_chunks_resume(monkeypatch):
+    """Test an interrupted stream is resumed from the last byte received, even if the server
+    does not support range requests"""
+
+    fw_file = File("1 - T1w.dicom.zip", content=b"0123456789")
+    monkeypatch.setattr(retry, "_policy", retry.RetryPolicy(base_delay=0))
+
+    for resumed in [MockResponse(b"456789", 206), MockResponse(b"0123456789", 200)]:
+        responses = [InterruptedResponse(b"0123", 200), resumed]
+        ranges = []
+        monkeypatch.setattr(transfer.requests, "get", serve(responses, ranges))
+
+        assert b"".join(transfer.iter_chunks(fw_file)) == fw_file.content
+        assert ranges == [None, "bytes=4-"]
+
+    # Repeated interruptions are raised
+    monkeypatch.setattr(
+        transfer.requests, "get", lambda *args, **kwargs: InterruptedResponse(b"0", 206)
+    )
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        b"".join(transfer.iter_chunks(fw_file))
+
+
+def test_download_file(tmp_path):
+    """Test successful download leaves no partial file behind"""
+
+    fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+    download_name = tmp_path / fw_file.name
+
+    transfer.download_file(fw_file, download_name)
+
+    assert download_name.read_bytes() == b"0123456789"
+    assert not transfer.part_name(download_name).exists()
+
+
+def test_download_file_corrupt(tmp_path):
+    """Test a download not matching the metadata is rejected"""
+
+    fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+    download_name = tmp_path / fw_file.name
+
+    # Simulate a truncated transfer
+    def truncated_download(dest_file):
+        with open(dest_file, "wb") as out_file:
+            out_file.write(b"01234")
+
+    fw_file.download = truncated_download
+
+    with pytest.raises(OSError):
+        transfer.download_file(fw_file, download_name)
+
+    assert not download_name.exists()
+    assert not transfer.part_name(download_name).exists()
+
+
+def test_download_file_resume(tmp_path, monkeypatch):
+    """Test a partial download is resumed from the last byte received"""
+
+    fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+    download_name = tmp_path / fw_file.name
+    transfer.part_name(download_name).write_bytes(b"0123")
+
+    requests_made = []
+
+    def mock_get(_url, headers, **_kwargs):
+        requests_made.append(headers["Range"])
+        return MockResponse(fw_file.content[4:], 206)
+
+    monkeypatch.setattr(transfer.requests, "get", mock_get)
+
+    transfer.download_file(fw_file, download_name)
+
+    assert requests_made == ["bytes=4-"]
+    assert fw_file.downloads == 0
+    assert download_name.read_bytes() == b"0123456789"
+
+
+def test_download_file_resume_unsupported(tmp_path, monkeypatch):
+    """Test the download restarts if range requests are not supported"""
+
+    fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+    download_name = tmp_path / fw_file.name
+    transfer.part_name(download_name).write_bytes(b"0123")
+
+    monkeypatch.setattr(
+        transfer.requests, "get", lambda *args, **kwargs: MockResponse(fw_file.content, 200)
+    )
+
+    transfer.download_file(fw_file, download_name)
+
+    assert download_name.read_bytes() == b"0123456789"
+
+
+def test_download_file_resume_complete(tmp_path, monkeypatch):
+    """Test a complete partial download of a file of unknown size is verified, not restarted"""
+
+    fw_file = File("sub-00_T1w.nii.gz", content=b"0123456789")
+    download_name = tmp_path / fw_file.name
+    transfer.part_name(download_name).write_bytes(b"0123456789")
+
+    monkeypatch.setattr(File, "size", None)
+    monkeypatch.setattr(transfer.requests, "get", lambda *args, **kwargs: MockResponse(b"", 416))
+
+    transfer.download_file(fw_file, download_name)
+
+    assert fw_file.downloads == 0
+    assert download_name.read_bytes() == b"0123456789"
@@ -30,3 +30,41 @@ def test_zip_save_name():
         utils.zip_save_name(base, label, dest)
         == base + "_" + label + "_" + dest + ".zip"
     )
+
+
+def test_pattern_matcher():
+    """Test PatternMatcher reports the first matching pattern"""
+
+    patterns = ["T1w", r"sub-(?P<label>\d+)_(ses)", ".*_acq-iso.*", "FLAIR"]
+    matcher = utils.PatternMatcher(patterns)
+
+    # Both the first and second patterns match, first in list takes priority
+    assert matcher.search("sub-01_ses_T1w.nii.gz") == "T1w"
+    assert matcher.search("sub-01_ses_dwi.nii.gz") == patterns[1]
+    assert matcher.search("sub-01_acq-iso_T2w.nii.gz") == ".*_acq-iso.*"
+    assert matcher.search("sub-01_bold.nii.gz") is None
+
+    assert matcher.unmatched() == ["FLAIR"]
+
+    # Empty list of patterns never matches
+    assert utils.PatternMatcher([]).search("sub-01_T1w.nii.gz") is None
+
+    # Global flags and repeated group names cannot be combined, so are searched individually
+    matcher = utils.PatternMatcher(["(?i)t1w", "FLAIR"])
+    assert matcher.search("sub-01_T1w.nii.gz") == "(?i)t1w"
+    assert matcher.search("sub-01_T2w.nii.gz") is None
+    assert matcher.unmatched() == ["FLAIR"]
+
+    patterns = [r"sub-(?P<label>\d+)_T1w", r"sub-(?P<label>\d+)_T2w"]
+    matcher = utils.PatternMatcher(patterns)
+    assert matcher.search("sub-01_T2w.nii.gz") == patterns[1]
+    assert matcher.search("sub-01_T1w.nii.gz") == patterns[0]
+    assert not matcher.unmatched()
+
+    # Back references would refer to renumbered groups, so are searched individually
+    patterns = ["FLAIR", r"(run)-\1", r"(?P<ses>ses)-(?P=ses)", r"(acq-)?(?(1)iso|dwi)"]
+    matcher = utils.PatternMatcher(patterns)
+    assert matcher.search("sub-01_run-run_bold.nii.gz") == patterns[1]
+    assert matcher.search("sub-01_ses-ses_bold.nii.gz") == patterns[2]
+    assert matcher.search("sub-01_acq-iso_T1w.nii.gz") == patterns[3]
+    assert matcher.search("sub-01_run-01_bold.nii.gz") is None
@@ -0,0 +1,105 @@
+"""
+Test for zip_stream.py
+"""
+
+import io
+import zipfile
+
+import pytest
+
+from flywheel_utilities import zip_stream
+
+from tests.mock_classes import File
+
+MEMBERS = {
+    "series/1.dcm": b"DICM" * 1000,
+    "series/2.dcm": b"DICM" + bytes(range(256)) * 10,
+    "series/empty.dcm": b"",
+}
+
+
+class NonSeekable(io.RawIOBase):
+    """Write-only stream forcing zipfile to use data descriptors"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        return len(data)
+
+
+def make_zip(compression, seekable=True):
+    """Create zip archive contents"""
+
+    out = io.BytesIO() if seekable else NonSeekable()
+    with zipfile.ZipFile(out, "w", compression=compression) as out_zip:
+        for name, data in MEMBERS.items():
+            out_zip.writestr(name, data)
+
+    return bytes(out.getvalue() if seekable else out.buffer)
+
+
+def chunked(data, size=7):
+    """Split data into small chunks"""
+
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize(
+    "compression, seekable",
+    [
+        (zipfile.ZIP_DEFLATED, True),
+        (zipfile.ZIP_DEFLATED, False),
+        (zipfile.ZIP_STORED, True),
+    ],
+)
+def test_stream_unzip(tmp_path, compression, seekable):
+    """Test extracting archives from a stream of chunks"""
+
+    members = zip_stream.stream_unzip(chunked(make_zip(compression, seekable)), tmp_path)
+
+    assert members == list(MEMBERS)
+    for name, data in MEMBERS.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_stream_unzip_unsupported(tmp_path):
+    """Test stored members of unknown size cannot be streamed"""
+
+    with pytest.raises(zip_stream.UnsupportedZipError):
+        zip_stream.stream_unzip(chunked(make_zip(zipfile.ZIP_STORED, False)), tmp_path)
+
+
+def test_stream_unzip_outside(tmp_path):
+    """Test members outside of the extraction directory are rejected"""
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as out_zip:
+        out_zip.writestr("../escaped.txt", b"data")
+
+    with pytest.raises(zip_stream.UnsupportedZipError):
+        zip_stream.stream_unzip([buffer.getvalue()], tmp_path / "out")
+
+    assert not (tmp_path / "escaped.txt").exists()
+
+
+def test_stream_unzip_file(tmp_path, monkeypatch):
+    """Test extraction of a Flywheel file, falling back to downloading if required"""
+
+    for compression, seekable in [(zipfile.ZIP_DEFLATED, False), (zipfile.ZIP_STORED, False)]:
+        fw_file = File("1 - T1w.dicom.zip", file_type="dicom")
+        fw_file.content = make_zip(compression, seekable)
+        monkeypatch.setattr(
+            zip_stream.transfer, "iter_chunks", lambda fw_file: chunked(fw_file.content, 4096)
+        )
+
+        output_dir = tmp_path / str(compression)
+        zip_stream.stream_unzip_file(fw_file, output_dir)
+
+        assert (output_dir / "series" / "1.dcm").read_bytes() == MEMBERS["series/1.dcm"]
+        assert not zip_stream.transfer.part_name(output_dir).exists()
+        assert list(tmp_path.glob("*.zip")) == []